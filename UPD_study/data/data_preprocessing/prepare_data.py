@@ -2,6 +2,7 @@ import argparse
 from glob import glob
 import os
 import shutil
+from typing import List, Tuple
 
 import nibabel as nib
 import numpy as np
@@ -10,11 +11,27 @@ from tqdm import tqdm
 from tifffile import imread
 from PIL import Image
 
-from UPD_study.data.data_preprocessing.registrators import MRIRegistrator
-from UPD_study.data.data_preprocessing.robex import strip_skull_ROBEX
+from UPD_study.data.data_preprocessing.registrators import MRIRegistrator, registered_path
+from UPD_study.data.data_preprocessing.robex import strip_skull_ROBEX, stripped_path
+from UPD_study.data.dataloaders.manifest import DatasetManifest
 from UPD_study import ROOT
 
 
+def remove_stale(manifest: DatasetManifest, stage: str, inputs: List[List[str]],
+                 outputs: List[List[str]]) -> Tuple[List[List[str]], List[List[str]]]:
+    """
+    Keep only the entries of a stage whose outputs have to be (re)built, see DatasetManifest.stale(),
+    and delete their existing outputs, for tools that skip outputs that already exist.
+    """
+    stale = [(i, o) for i, o in zip(inputs, outputs) if manifest.stale(stage, i, o)]
+    print(f"{stage}: {len(stale)} of {len(inputs)} entries changed.")
+    for _, o in stale:
+        for path in o:
+            if os.path.exists(path):
+                os.remove(path)
+    return [i for i, _ in stale], [o for _, o in stale]
+
+
 class BraTSHandler():
     def __init__(self, args):
         """
@@ -26,25 +43,31 @@ class BraTSHandler():
         if not os.path.exists(os.path.join(args.dataset_path, 'MICCAI_BraTS2020_TrainingData')):
             raise RuntimeError("Run download_BraTS.sh to download and extract dataset or manually download"
                                f'  and extract to {args.dataset_path}')
-        self.rename_lesions(args)
-        self.registerBraTS(args)
+        # only entries whose inputs changed since the last run are processed again
+        manifest = DatasetManifest(args.dataset_path)
+        self.rename_lesions(args, manifest)
+        self.registerBraTS(args, manifest)
 
     @staticmethod
-    def rename_lesions(args):
+    def rename_lesions(args, manifest):
         print("Renaming segmentation files in BraTS to "
               "'anomaly_segmentation_unregistered.nii'")
         lesion_files = sorted(glob(f"{args.dataset_path}/*/*/*_seg.nii"))
         target_files = [
             '/'.join(f.split('/')[:-1] + ['anomaly_segmentation_unregistered.nii']) for f in lesion_files]
         for lesion, target in zip(lesion_files, target_files):
+            if not manifest.stale('rename_lesions', [lesion], [target]):
+                continue
             data = nib.load(lesion, keep_file_open=False)
             volume = data.get_fdata(caching='unchanged',
                                     dtype=np.float32).astype(np.dtype("short"))
             nib.save(nib.Nifti1Image(volume, data.affine), target)
             # shutil.copy(lesion, target)
+            manifest.record('rename_lesions', [lesion], [target])
+        manifest.save()
 
     @staticmethod
-    def registerBraTS(args):
+    def registerBraTS(args, manifest):
         print("Registering BraTS")
 
         # Get all files
@@ -54,14 +77,24 @@ class BraTSHandler():
         if len(files) == 0:
             raise RuntimeError("0 files to be registered")
 
-        # Initialize registrator
-
         template_path = os.path.join(
             ROOT, 'data', 'data_preprocessing', 'BrainAtlases/T1_brain.nii')
+
+        # register only the files whose scans, segmentation or template changed
+        inputs = [[f, f[:f.rfind("t1")] + "t2.nii",
+                   os.path.join(os.path.dirname(f), "anomaly_segmentation_unregistered.nii"),
+                   template_path] for f in files]
+        outputs = [[registered_path(f), f[:f.rfind("t1")] + "t2_registered.nii",
+                    os.path.join(os.path.dirname(f), "anomaly_segmentation.nii")] for f in files]
+        inputs, outputs = remove_stale(manifest, 'register', inputs, outputs)
+        if len(inputs) == 0:
+            return
+
+        # Initialize registrator
         registrator = MRIRegistrator(template_path=template_path)
 
         # Register files
-        transformations = registrator.register_batch(files)
+        transformations = registrator.register_batch([i[0] for i in inputs])
 
         for path, t in tqdm(transformations.items()):
             base = path[:path.rfind("t1")]
@@ -99,6 +132,10 @@ class BraTSHandler():
                 dtype='short'
             )
 
+        for i, o in zip(inputs, outputs):
+            manifest.record('register', i, o)
+        manifest.save()
+
 
 class CamCANHandler():
     def __init__(self, args):
@@ -109,8 +146,10 @@ class CamCANHandler():
         print("Preparing CamCAN directory")
         self.prepare_CamCAN(args)
         print(f"Skull stripping for CamCAN {args.weighting} scans")
-        # self.skull_strip_CamCAN(args)
-        # self.register_CamCAN(args)
+        # only entries whose inputs changed since the last run are processed again
+        manifest = DatasetManifest(args.dataset_path)
+        # self.skull_strip_CamCAN(args, manifest)
+        # self.register_CamCAN(args, manifest)
 
     @staticmethod
     def prepare_CamCAN(args):
@@ -137,7 +176,7 @@ class CamCANHandler():
             shutil.move(d, normal_dir)
 
     @staticmethod
-    def register_CamCAN(args):
+    def register_CamCAN(args, manifest):
 
         print("Registering CamCAN")
 
@@ -149,13 +188,22 @@ class CamCANHandler():
         if len(files) == 0:
             raise RuntimeError("Found 0 files")
 
-        # Initialize the registrator
         template_path = os.path.join(
             ROOT, 'data', 'data_preprocessing', 'BrainAtlases/T1_brain.nii')
+
+        # register only the files whose scans or template changed
+        inputs = [[f, f[:f.rfind("T1")] + "T2w_stripped.nii.gz", template_path] for f in files]
+        outputs = [[registered_path(f), f[:f.rfind("T1")] + "T2w_stripped_registered.nii.gz"]
+                   for f in files]
+        inputs, outputs = remove_stale(manifest, 'register', inputs, outputs)
+        if len(inputs) == 0:
+            return
+
+        # Initialize the registrator
         registrator = MRIRegistrator(template_path=template_path)
 
         # Register files
-        transformations = registrator.register_batch(files)
+        transformations = registrator.register_batch([i[0] for i in inputs])
 
         for path, t in tqdm(transformations.items()):
             base = path[:path.rfind("T1")]
@@ -170,7 +218,11 @@ class CamCANHandler():
                 dtype='short'
             )
 
-    def skull_strip_CamCAN(self, args):
+        for i, o in zip(inputs, outputs):
+            manifest.record('register', i, o)
+        manifest.save()
+
+    def skull_strip_CamCAN(self, args, manifest):
         w = args.weighting
         if not isinstance(w, str):
             raise RuntimeError(f"Invalid value for --weighting {w}")
@@ -183,16 +235,21 @@ class CamCANHandler():
             raise RuntimeError("No paths found")
 
         if w.lower() == 't1':
+            inputs, outputs = remove_stale(manifest, 'skull_strip', [[p] for p in paths],
+                                           [[stripped_path(p)] for p in paths])
             # Run ROBEX
-            strip_skull_ROBEX(paths)
+            strip_skull_ROBEX([i[0] for i in inputs])
+            for i, o in zip(inputs, outputs):
+                manifest.record('skull_strip', i, o)
         elif w.lower() == "t2":
-            self.skull_strip_CamCAN_T2(paths)
+            self.skull_strip_CamCAN_T2(paths, manifest)
         else:
             raise NotImplementedError("CamCAN skull stripping not implemented"
                                       f" for --weighting {w}")
+        manifest.save()
 
     @staticmethod
-    def skull_strip_CamCAN_T2(paths):
+    def skull_strip_CamCAN_T2(paths, manifest):
         """Skull strip the registered CamCAN T2 images with the results
         of the skull stripped registered CamCAN T1 images
         """
@@ -201,6 +258,8 @@ class CamCANHandler():
             t2_stripped_path = f"{path[:path.rfind('T2w')]}T2w_stripped.nii.gz"
             if not os.path.exists(t1_stripped_path):
                 print(f"WARNING: No T1 skull stripped file found for {path}")
+            elif not manifest.stale('skull_strip', [path, t1_stripped_path], [t2_stripped_path]):
+                continue
             # Load T2 weighted scan
             t2_data = nib.load(path)
             affine = t2_data.affine
@@ -213,6 +272,7 @@ class CamCANHandler():
             # Save skull stripped t2
             nib.save(nib.Nifti1Image(t2_stripped.astype(
                 np.short), affine), t2_stripped_path)
+            manifest.record('skull_strip', [path, t1_stripped_path], [t2_stripped_path])
 
 
 class ATLASHandler():
@@ -228,26 +288,32 @@ class ATLASHandler():
             raise RuntimeError("Run download_ATLAS.sh to download and extract dataset or manually download"
                                f' from https://fcon_1000.projects.nitrc.org/indi/retro/atlas_download.html'
                                f' and extract to {args.dataset_path}')
-        self.rename_lesions(args)
-        self.skull_strip_ATLAS(args)
-        self.registerATLAS(args)
+        # only entries whose inputs changed since the last run are processed again
+        manifest = DatasetManifest(args.dataset_path)
+        self.rename_lesions(args, manifest)
+        self.skull_strip_ATLAS(args, manifest)
+        self.registerATLAS(args, manifest)
 
     @staticmethod
-    def rename_lesions(args):
+    def rename_lesions(args, manifest):
         print("Renaming segmentation files in ATLAS to "
               "'anomaly_segmentation_unregistered.nii'")
         lesion_files = sorted(glob(f"{args.dataset_path}/*/*/*/*/*/*/*lesion_mask.nii.gz"))
         target_files = [
             '/'.join(f.split('/')[:-1] + ['anomaly_segmentation_unregistered.nii.gz']) for f in lesion_files]
         for lesion, target in zip(lesion_files, target_files):
+            if not manifest.stale('rename_lesions', [lesion], [target]):
+                continue
             data = nib.load(lesion, keep_file_open=False)
             volume = data.get_fdata(caching='unchanged',
                                     dtype=np.float32).astype(np.dtype("short"))
             nib.save(nib.Nifti1Image(volume, data.affine), target)
             # shutil.copy(lesion, target)
+            manifest.record('rename_lesions', [lesion], [target])
+        manifest.save()
 
     @staticmethod
-    def skull_strip_ATLAS(paths):
+    def skull_strip_ATLAS(args, manifest):
 
         # Get list of all files
         paths = sorted(glob(
@@ -257,11 +323,16 @@ class ATLASHandler():
         if len(paths) == 0:
             raise RuntimeError("No paths found")
 
+        inputs, outputs = remove_stale(manifest, 'skull_strip', [[p] for p in paths],
+                                       [[stripped_path(p)] for p in paths])
         # Run ROBEX
-        strip_skull_ROBEX(paths)
+        strip_skull_ROBEX([i[0] for i in inputs])
+        for i, o in zip(inputs, outputs):
+            manifest.record('skull_strip', i, o)
+        manifest.save()
 
     @staticmethod
-    def registerATLAS(args):
+    def registerATLAS(args, manifest):
         print("Registering skull-striped ATLAS")
 
         # Get all files
@@ -271,13 +342,23 @@ class ATLASHandler():
         if len(files) == 0:
             raise RuntimeError("0 files to be registered")
 
-        # Initialize registrator
         template_path = os.path.join(
             ROOT, 'data', 'data_preprocessing', 'BrainAtlases/T1_brain.nii')
+
+        # register only the files whose scan, segmentation or template changed
+        inputs = [[f, os.path.join(os.path.dirname(f), "anomaly_segmentation_unregistered.nii.gz"),
+                   template_path] for f in files]
+        outputs = [[registered_path(f), os.path.join(os.path.dirname(f), "anomaly_segmentation.nii.gz")]
+                   for f in files]
+        inputs, outputs = remove_stale(manifest, 'register', inputs, outputs)
+        if len(inputs) == 0:
+            return
+
+        # Initialize registrator
         registrator = MRIRegistrator(template_path=template_path)
 
         # Register files
-        transformations = registrator.register_batch(files)
+        transformations = registrator.register_batch([i[0] for i in inputs])
 
         for path, t in tqdm(transformations.items()):
             # base = path[:path.rfind("t1")]
@@ -295,6 +376,10 @@ class ATLASHandler():
                 dtype='short'
             )
 
+        for i, o in zip(inputs, outputs):
+            manifest.record('register', i, o)
+        manifest.save()
+
 
 class DDRHandler():
     def __init__(self, args):
@@ -309,11 +394,13 @@ class DDRHandler():
             raise RuntimeError("Run download_DDR.sh to download and extract dataset or manually download"
                                f' from drive.google.com/drive/folders/1z6tSFmxW_aNayUqVxx6h6bY4kwGzUTEC'
                                f' and extract to {args.dataset_path}.')
-        self.create_train_set(args)
-        self.create_test_set(args)
+        # only entries whose inputs changed since the last run are processed again
+        manifest = DatasetManifest(args.dataset_path)
+        self.create_train_set(args, manifest)
+        self.create_test_set(args, manifest)
 
     @staticmethod
-    def create_train_set(args):
+    def create_train_set(args, manifest):
         # create train set folder
         os.makedirs(os.path.join(args.dataset_path, "DDR-dataset/healthy"), exist_ok=True)
 
@@ -325,10 +412,13 @@ class DDRHandler():
                 for name in normals:
                     current_path = os.path.join(args.dataset_path, f"DDR-dataset/DR_grading/{set}/{name}")
                     target_path = os.path.join(args.dataset_path, f"DDR-dataset/healthy/{name}")
-                    shutil.copyfile(current_path, target_path)
+                    if manifest.stale('train_set', [current_path], [target_path]):
+                        shutil.copyfile(current_path, target_path)
+                        manifest.record('train_set', [current_path], [target_path])
+        manifest.save()
 
     @staticmethod
-    def create_test_set(args):
+    def create_test_set(args, manifest):
         # create test set folders
         os.makedirs(os.path.join(args.dataset_path, "DDR-dataset/unhealthy/images"), exist_ok=True)
         os.makedirs(os.path.join(args.dataset_path, "DDR-dataset/unhealthy/segmentations"), exist_ok=True)
@@ -339,15 +429,19 @@ class DDRHandler():
         for seg in segm_list:
             img_name = seg.split('/')[-1].split('.')[0]
             target_path = os.path.join(args.dataset_path, f'DDR-dataset/unhealthy/images/{img_name}.png')
-            shutil.copyfile(seg, target_path)
             segs = sorted(glob(os.path.join(args.dataset_path,
                           f'DDR-dataset/lesion_segmentation/*/label/*/{img_name}.tif')))
             if len(segs) != 4:
                 raise RuntimeError(seg)
+            save_path = os.path.join(args.dataset_path, f'DDR-dataset/unhealthy/segmentations/{img_name}.png')
+            if not manifest.stale('test_set', [seg] + segs, [target_path, save_path]):
+                continue
+            shutil.copyfile(seg, target_path)
             total = imread(segs[0]) + imread(segs[1]) + imread(segs[2]) + imread(segs[3])
             total = np.where(total != 0, 255, 0)
-            save_path = os.path.join(args.dataset_path, f'DDR-dataset/unhealthy/segmentations/{img_name}.png')
             Image.fromarray(total.astype(np.uint8)).save(save_path)
+            manifest.record('test_set', [seg] + segs, [target_path, save_path])
+        manifest.save()
 
 
 def prepare_data(args):
@@ -19,6 +19,14 @@ import nibabel as nib
 import numpy as np
 
 
+def registered_path(path: str) -> str:
+    """Path of the registration result of a NiFTI file, with a '_registered.nii' suffix"""
+    save_path = path.split('nii')[0][:-1] + '_registered.nii'
+    if path.endswith('.gz'):
+        save_path += '.gz'
+    return save_path
+
+
 class MRIRegistrator:
     def __init__(
         self,
@@ -152,9 +160,7 @@ class MRIRegistrator:
     def _register(self, path: str, i_process: int):
         """Don't call yourself"""
         start = time()
-        save_path = path.split('nii')[0][:-1] + '_registered.nii'
-        if path.endswith('.gz'):
-            save_path += '.gz'
+        save_path = registered_path(path)
         _, transformation = self(moving=path, save_path=save_path)
         print(f"Scan {i_process} done in {time() - start:.02f}s")
 
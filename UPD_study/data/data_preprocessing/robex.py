@@ -7,6 +7,19 @@ from time import time
 from UPD_study import ROOT
 
 
+def stripped_path(path: str, out_dir: Optional[str] = None) -> str:
+    """Path of the skull stripped result of a NiFTI file, with a '_stripped.nii' suffix"""
+    p_split = path.split('/')
+    # Select directory to save the result
+    d = ('/').join(p_split[:-1]) if out_dir is None else out_dir
+    # Build the new file name
+    f_name = p_split[-1].split('.nii')[0] + "_stripped.nii"
+    if path.endswith('.gz'):
+        f_name += '.gz'
+    # Set together to build the path where the stripped file is saved
+    return os.path.join(d, f_name)
+
+
 def strip_skull_ROBEX(paths, out_dir: Optional[str] = None,
                       num_processes: Optional[int] = min(24, os.cpu_count())):
     """Use ROBEX to strip the skull of a T1 weighted brain MR Image. Takes ~100s
@@ -58,15 +71,7 @@ def _strip_skull_ROBEX(paths: List[str], i_process: int,
 
     # Iterate over  all files
     for i, path in enumerate(paths):
-        p_split = path.split('/')
-        # Select directory to save the result
-        d = ('/').join(p_split[:-1]) if out_dir is None else out_dir
-        # Build the new file name
-        f_name = p_split[-1].split('.nii')[0] + "_stripped.nii"
-        if path.endswith('.gz'):
-            f_name += '.gz'
-        # Set together to build the path where the stripped file is saved
-        save_path = os.path.join(d, f_name)
+        save_path = stripped_path(path, out_dir)
         if not os.path.exists(save_path):
             # Run ROBEX
             result = subprocess.run(
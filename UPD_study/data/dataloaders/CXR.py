@@ -6,43 +6,29 @@ from torchvision import transforms as T
 import numpy as np
 from torch import Tensor
 from argparse import Namespace
-from UPD_study.utilities.utils import GenericDataloader
-from glob import glob
+from UPD_study.utilities.utils import GenericDataloader, split_repeated
+from UPD_study.data.dataloaders.image_shards import get_shard
+from UPD_study.data.dataloaders.manifest import DatasetManifest, get_manifest
 import torch
 
 
-def get_files(config: Namespace, train: bool = True) -> Union[List, Tuple[List, ...]]:
-    """
-    Return a list of all the paths of normal files.
-
-    Args:
-        config (Namespace): configuration object
-        train (bool): True for train images, False for test images and labels
-    Returns:
-        images (List): List of paths of normal files.
-        masks (List): (If train == True) List of paths of segmentations.
-
-    """
+def _get_files(config: Namespace, train: bool, manifest: DatasetManifest) -> Union[List, Tuple[List, ...]]:
     ap = "AP_" if config.AP_only else ""
     sup = "sup_" if config.sup_devices else "no_sup_"
     if config.sex == 'both':
         file_name = f'*_normal_train_{ap}{sup}'
-        file = sorted(glob(os.path.join(config.datasets_dir,
-                                        'CXR/normal_splits',
-                                        file_name + '*.txt')))
+        file = sorted(manifest.glob(os.path.join('normal_splits', file_name + '*.txt')))
 
     else:
 
         file_name = f'{config.sex}_normal_train_{ap}{sup}'
 
-        file = sorted(glob(os.path.join(config.datasets_dir,
-                                        'CXR/normal_splits',
-                                        file_name + '*.txt')))
+        file = sorted(manifest.glob(os.path.join('normal_splits', file_name + '*.txt')))
 
-    paths1 = open(file[0]).read().splitlines()
+    paths1 = manifest.lines(file[0])
 
     if config.sex == 'both':
-        paths2 = open(file[1]).read().splitlines()
+        paths2 = manifest.lines(file[1])
 
         # make sure even num of samples for both sexes
 
@@ -73,21 +59,17 @@ def get_files(config: Namespace, train: bool = True) -> Union[List, Tuple[List,
 
         file_name = f'*_anomal_{config.pathology}_{ap}{sup}'
 
-        file = sorted(glob(os.path.join(config.datasets_dir,
-                                        'CXR/anomal_splits',
-                                        file_name + '*.txt')))
+        file = sorted(manifest.glob(os.path.join('anomal_splits', file_name + '*.txt')))
     else:
 
         file_name = f'{config.sex}_anomal_{config.pathology}_{ap}{sup}'
 
-        file = sorted(glob(os.path.join(config.datasets_dir,
-                                        'CXR/anomal_splits',
-                                        file_name + '*.txt')))
+        file = sorted(manifest.glob(os.path.join('anomal_splits', file_name + '*.txt')))
 
-    anom_paths1 = open(file[0]).read().splitlines()
+    anom_paths1 = manifest.lines(file[0])
 
     if config.sex == 'both':
-        anom_paths2 = open(file[1]).read().splitlines()
+        anom_paths2 = manifest.lines(file[1])
 
         # make sure even num of samples for both sexes
 
@@ -114,6 +96,25 @@ def get_files(config: Namespace, train: bool = True) -> Union[List, Tuple[List,
         return paths1[:200], anom_paths1[:200], [0] * 200, [1] * 200
 
 
+def get_files(config: Namespace, train: bool = True) -> Union[List, Tuple[List, ...]]:
+    """
+    Return a list of all the paths of normal files.
+    Split files are found and read through the manifest of the dataset.
+
+    Args:
+        config (Namespace): configuration object
+        train (bool): True for train images, False for test images and labels
+    Returns:
+        images (List): List of paths of normal files.
+        masks (List): (If train == True) List of paths of segmentations.
+
+    """
+    manifest = get_manifest(os.path.join(config.datasets_dir, 'CXR'), config)
+    files = _get_files(config, train, manifest)
+    manifest.save()
+    return files
+
+
 class NormalDataset(Dataset):
     """
     Dataset class for the training set CXR images from CheXpert Dataset.
@@ -128,6 +129,7 @@ class NormalDataset(Dataset):
 
         self.center = config.center
         self.files = files
+        self.shard = get_shard(files, config)
 
         self.transforms = T.Compose([
             T.Resize((config.image_size, config.image_size), T.InterpolationMode.LANCZOS),
@@ -146,8 +148,11 @@ class NormalDataset(Dataset):
             image: image tensor of size []
         """
 
-        image = Image.open(self.files[idx])
-        image = self.transforms(image)
+        if self.shard is not None:
+            image = self.shard.tensor(self.files[idx])
+        else:
+            image = Image.open(self.files[idx])
+            image = self.transforms(image)
         # Center input
         if self.center:
 
@@ -182,6 +187,7 @@ class AnomalDataset(Dataset):
 
         self.images = anomal_paths + normal_paths
         self.labels = labels_anomal + labels_normal
+        self.shard = get_shard(self.images, config)
 
         self.image_transforms = T.Compose([
             T.Resize((config.image_size, config.image_size),
@@ -196,25 +202,22 @@ class AnomalDataset(Dataset):
     def __getitem__(self, idx) -> Tuple[Tensor, Tensor]:
         """
         :param idx: Index of the file to load.
-        :return: The loaded image and the binary segmentation mask.
+        :return: The loaded image and its anomaly label.
         """
 
-        image = Image.open(self.images[idx])
-        image = self.image_transforms(image)
+        if self.shard is not None:
+            image = self.shard.tensor(self.images[idx])
+        else:
+            image = Image.open(self.images[idx])
+            image = self.image_transforms(image)
 
         if self.center:
             # Center input
             image = (image - 0.5) * 2
 
-        # for compatibility with downstream methods that assume the existance
-        # of ground truth segmentation, create fake image masks to provide as labels
-        # negative = zero tensor, positive = Ident tensor
-        if self.labels[idx] != 0:
-            mask = torch.eye(image.shape[-1]).unsqueeze(0)
-        else:
-            mask = torch.zeros_like(image)
-
-        return image, mask
+        # CXR has no ground truth segmentations, so yield the image-level label
+        # instead of a mask, evaluate() then skips pixel-level accumulation
+        return image, torch.tensor(int(self.labels[idx] != 0))
 
 
 def get_dataloaders(config: Namespace,
@@ -244,12 +247,14 @@ def get_dataloaders(config: Namespace,
         # percentage experiment
         # keep a specific percentage of the train files, or a single image.
         # for seed != 10 (stadard seed), index the list backwards
+        repeats = 1
         if config.percentage != 100:
             if config.percentage == -1:  # single img scenario
                 if config.seed == 10:
-                    trainfiles = [trainfiles[0]] * 500
+                    trainfiles = [trainfiles[0]]
                 else:
-                    trainfiles = [trainfiles[-1]] * 500
+                    trainfiles = [trainfiles[-1]]
+                repeats = 500
                 print(
                     f'Number of train samples ({len(trainfiles)}) lower than ',
                     f'batch size ({config.batch_size}). Repeating trainfiles 500 times.')
@@ -262,13 +267,18 @@ def get_dataloaders(config: Namespace,
                     print(
                         f'Number of train samples ({len(trainfiles)}) lower than ',
                         'batch size ({config.batch_size}). Repeating trainfiles 10 times.')
-                    trainfiles = trainfiles * 10
+                    repeats = 10
 
-        # calculate dataset split index
-        split_idx = int(len(trainfiles) * config.normal_split)
+        if repeats > 1:
+            # split as if the files were repeated, without loading them repeatedly
+            trainset, valset = split_repeated(NormalDataset(trainfiles, config),
+                                              repeats, config.normal_split)
+        else:
+            # calculate dataset split index
+            split_idx = int(len(trainfiles) * config.normal_split)
 
-        trainset = NormalDataset(trainfiles[:split_idx], config)
-        valset = NormalDataset(trainfiles[split_idx:], config)
+            trainset = NormalDataset(trainfiles[:split_idx], config)
+            valset = NormalDataset(trainfiles[split_idx:], config)
 
         train_dl = GenericDataloader(trainset, config)
         val_dl = GenericDataloader(valset, config)
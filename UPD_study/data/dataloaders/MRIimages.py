@@ -15,24 +15,26 @@ class NormalDataset(Dataset):
     Dataset class for CamCAN Dataset.
     """
 
-    def __init__(self, files: np.ndarray, config: Namespace):
+    def __init__(self, files: np.ndarray, config: Namespace, indices: np.ndarray = None):
         """
         Args:
             files(nd.array): array of shape [slices,1,H,W] already loaded
-                             to ram with get_camcan_slices()
+                             to ram or memory-mapped with get_camcan_slices()
             config(Namespace): config object
+            indices(np.ndarray): Optional. Indices of the slices of files that belong to the dataset
 
         config should include "sequence" and "stadardize"
         """
 
         self.files = files
+        self.indices = indices if indices is not None else np.arange(len(files))
         self.center = config.center
 
     def __len__(self):
-        return len(self.files)
+        return len(self.indices)
 
     def __getitem__(self, idx) -> Tensor:
-        img = self.files[idx]
+        img = self.files[self.indices[idx]]
         img = torch.FloatTensor(img)
 
         if self.center:
@@ -47,24 +49,28 @@ class AnomalDataset(Dataset):
     Dataset class for the BraTS and ATLAS datasets.
     """
 
-    def __init__(self, files: List, config: Namespace):
+    def __init__(self, files: List, config: Namespace, indices: np.ndarray = None):
         """
         Args:
             files(List[np.ndarray, np.ndarray]): list of two arrays
             (slices and segmentations) of shapes [slices,1,H,W] loaded to ram
+            or memory-mapped
 
             config(Namespace): config object
+            indices(np.ndarray): Optional. Indices of the slices that belong to the dataset
 
         config should include "sequence" and "stadardize"
         """
         self.images = files[0]
         self.segmentations = files[1]
+        self.indices = indices if indices is not None else np.arange(len(self.images))
         self.center = config.center
 
     def __len__(self):
-        return len(self.images)
+        return len(self.indices)
 
     def __getitem__(self, idx) -> Tuple[Tensor, Tensor]:
+        idx = self.indices[idx]
         img = self.images[idx]
         img = torch.FloatTensor(img)
 
@@ -97,6 +103,7 @@ def get_dataloaders(config: Namespace,
 
     if train:
         config.return_volumes = False
+        config.return_stats = False
         config.slice_range = (0, 155)
         # get array of slices
         if config.sequence == 't1+t2':
@@ -109,7 +116,7 @@ def get_dataloaders(config: Namespace,
             slices = np.concatenate([slices_t1, slices_t2, third_empty_channel], axis=1)
             zero_idx_t1 = np.sum(slices_t1[:, 0], axis=(1, 2)) > 0
             zero_idx_t2 = np.sum(slices_t2[:, 0], axis=(1, 2)) > 0
-            slices = slices[zero_idx_t1 * zero_idx_t2]
+            brain_idx = np.flatnonzero(zero_idx_t1 * zero_idx_t2)
             config.sequence = 't1+t2'
         else:
             if config.percentage != 100:
@@ -132,19 +139,20 @@ def get_dataloaders(config: Namespace,
                     else:
                         slices = slices[-int(len(slices) * (config.percentage / 100)):]
 
-                    slices = np.concatenate(slices, axis=0)
+                    # volumes are contiguous, so this is a view for memory-mapped slices
+                    slices = slices.reshape(-1, *slices.shape[2:])
             # if config.norm_vol:
             #     slices = np.concatenate([(volume - np.mean(volume)) / np.std(volume) for volume in slices])
             # keep slices with brain pixels in them
-            slices = slices[np.sum(slices, axis=(1, 2, 3)) > 0]
+            brain_idx = np.flatnonzero(np.sum(slices, axis=(1, 2, 3)) > 0)
 
         # calculate dataset split index
-        split_idx = int(len(slices) * config.normal_split)
+        split_idx = int(len(brain_idx) * config.normal_split)
 
-        if split_idx != len(slices):
+        if split_idx != len(brain_idx):
 
-            trainset = NormalDataset(slices[:split_idx], config)
-            valset = NormalDataset(slices[split_idx:], config)
+            trainset = NormalDataset(slices, config, brain_idx[:split_idx])
+            valset = NormalDataset(slices, config, brain_idx[split_idx:])
 
             train_dl = GenericDataloader(trainset, config)
             val_dl = GenericDataloader(valset, config)
@@ -153,7 +161,7 @@ def get_dataloaders(config: Namespace,
 
         else:
 
-            trainset = NormalDataset(slices, config)
+            trainset = NormalDataset(slices, config, brain_idx)
             train_dl = GenericDataloader(trainset, config)
 
             return train_dl
@@ -162,6 +170,7 @@ def get_dataloaders(config: Namespace,
 
         # split before concating the volumes to keep complete patient samples in each subset
         config.return_volumes = True
+        config.return_stats = False
         if config.get_images:
             config.slice_range = (72, 77)
         if config.sequence == 't1':
@@ -189,37 +198,31 @@ def get_dataloaders(config: Namespace,
         # if small part of anomal set is needed for validation (config.anomal_split != 1.0)
         if split_idx != len(slices):
 
-            slices_big = np.concatenate(slices[:split_idx], axis=0)
-            slices_small = np.concatenate(slices[split_idx:], axis=0)
-            seg_big = np.concatenate(segmentations[:split_idx], axis=0)
-            seg_small = np.concatenate(segmentations[split_idx:], axis=0)
+            # volumes are contiguous, so these are views for memory-mapped slices
+            slices_big = slices[:split_idx].reshape(-1, *slices.shape[2:])
+            slices_small = slices[split_idx:].reshape(-1, *slices.shape[2:])
+            seg_big = segmentations[:split_idx].reshape(-1, *segmentations.shape[2:])
+            seg_small = segmentations[split_idx:].reshape(-1, *segmentations.shape[2:])
 
             # keep slices with brain pixels in them
             if config.sequence == 't1+t2':
                 non_zero_idx_s_t1 = np.sum(slices_small[:, 0], axis=(1, 2)) > 0
                 non_zero_idx_s_t2 = np.sum(slices_small[:, 1], axis=(1, 2)) > 0
-                slices_small = slices_small[non_zero_idx_s_t1 * non_zero_idx_s_t2]
-                seg_small = seg_small[non_zero_idx_s_t1 * non_zero_idx_s_t2]
+                non_zero_idx_s = np.flatnonzero(non_zero_idx_s_t1 * non_zero_idx_s_t2)
 
                 non_zero_idx_b_t1 = np.sum(slices_big[:, 0], axis=(1, 2)) > 0
                 non_zero_idx_b_t2 = np.sum(slices_big[:, 1], axis=(1, 2)) > 0
-                slices_big = slices_big[non_zero_idx_b_t1 * non_zero_idx_b_t2]
-                seg_big = seg_big[non_zero_idx_b_t1 * non_zero_idx_b_t2]
+                non_zero_idx_b = np.flatnonzero(non_zero_idx_b_t1 * non_zero_idx_b_t2)
 
             else:
-                non_zero_idx_s = np.sum(slices_small, axis=(1, 2, 3)) > 0
-                slices_small = slices_small[non_zero_idx_s]
-                seg_small = seg_small[non_zero_idx_s]
-
-                non_zero_idx_b = np.sum(slices_big, axis=(1, 2, 3)) > 0
-                slices_big = slices_big[non_zero_idx_b]
-                seg_big = seg_big[non_zero_idx_b]
-
-            for i in slices_big:
-                if np.count_nonzero(i) < 5:
-                    print(np.count_nonzero(i))
-            big = AnomalDataset([slices_big, seg_big], config)
-            small = AnomalDataset([slices_small, seg_small], config)
+                non_zero_idx_s = np.flatnonzero(np.sum(slices_small, axis=(1, 2, 3)) > 0)
+                non_zero_idx_b = np.flatnonzero(np.sum(slices_big, axis=(1, 2, 3)) > 0)
+
+            for i in non_zero_idx_b:
+                if np.count_nonzero(slices_big[i]) < 5:
+                    print(np.count_nonzero(slices_big[i]))
+            big = AnomalDataset([slices_big, seg_big], config, non_zero_idx_b)
+            small = AnomalDataset([slices_small, seg_small], config, non_zero_idx_s)
 
             big_test_dl = GenericDataloader(big, config, shuffle=config.shuffle)
             small_test_dl = GenericDataloader(small, config, shuffle=config.shuffle)
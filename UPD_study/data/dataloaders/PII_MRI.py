@@ -2,12 +2,15 @@
 import torch
 from torch.utils.data import Dataset
 import numpy as np
-from UPD_study.utilities.utils import GenericDataloader
+from UPD_study.utilities.utils import GenericDataloader, split_repeated
 from UPD_study.models.PII.pii_utils import pii
+from UPD_study.models.PII.anomaly_bank import get_anomaly_bank
 from argparse import Namespace
 from torch.utils.data import DataLoader
 from UPD_study.data.dataloaders.mri_preprocessing import (
     get_camcan_slices, get_brats_slices, get_atlas_slices)
+from UPD_study.data.dataloaders.slice_stats import print_sparse_slices
+from UPD_study.data.dataloaders.storage import to_float32
 
 from torch import Tensor
 from typing import List, Tuple
@@ -18,26 +21,45 @@ class NormalDataset(Dataset):
     Dataset class for the Healthy MRI datasets.
     """
 
-    def __init__(self, files: np.ndarray, config: Namespace):
+    def __init__(self, files: np.ndarray, config: Namespace, indices: np.ndarray = None,
+                 scales: np.ndarray = None):
         """
         Args:
            files(nd.array): array of MRI slices with shape [slices,1,H,W]
             config(Namespace): config object
+            indices(np.ndarray): Optional. Indices of the slices of files that belong to the dataset
+            scales(np.ndarray): Optional. Scale of the stored values of every slice of files,
+                                for reduced-precision storage (see storage.py)
         """
 
         self.files = files
+        self.indices = indices if indices is not None else np.arange(len(files))
+        self.scales = scales if scales is not None else np.ones(len(files), dtype=np.float32)
         self.center = config.center
 
+        # pre-generated anomalies, see anomaly_bank.py
+        self.bank = get_anomaly_bank(self, config)
+        self.bank_fraction = config.pii_bank_fraction if 'pii_bank_fraction' in config else 1.
+
     def __len__(self):
-        return len(self.files)
+        return len(self.indices)
 
-    def __getitem__(self, idx):
+    def source(self, idx) -> np.ndarray:
+        idx = self.indices[idx]
+        return to_float32(self.files[idx], self.scales[idx])
 
-        img = self.files[idx]
+    def generate(self, idx) -> Tuple[np.ndarray, np.ndarray]:
         # index of second image
         idx2 = np.random.randint(0, len(self))
         # create artificial anomaly image and ground truth mask
-        img, mask = pii(img, self.files[idx2], is_mri=True)
+        return pii(self.source(idx), self.source(idx2), is_mri=True)
+
+    def __getitem__(self, idx):
+
+        if self.bank is not None and np.random.rand() < self.bank_fraction:
+            img, mask = self.bank.sample(idx)
+        else:
+            img, mask = self.generate(idx)
         mask = torch.FloatTensor(mask)
         img = torch.FloatTensor(img)
         # Center input
@@ -52,26 +74,33 @@ class AnomalDataset(Dataset):
     Dataset class for the BraTS and ATLAS datasets.
     """
 
-    def __init__(self, files: List, config: Namespace):
+    def __init__(self, files: List, config: Namespace, indices: np.ndarray = None,
+                 scales: np.ndarray = None):
         """
         Args:
             files(List[np.ndarray, np.ndarray]): list of two arrays
             (slices and segmentations) of shapes [slices,1,H,W] loaded to ram
+            or memory-mapped
 
             config(Namespace): config object
+            indices(np.ndarray): Optional. Indices of the slices that belong to the dataset
+            scales(np.ndarray): Optional. Scale of the stored values of every image slice,
+                                for reduced-precision storage (see storage.py)
 
         config should include "sequence" and "stadardize"
         """
         self.images = files[0]
         self.segmentations = files[1]
+        self.indices = indices if indices is not None else np.arange(len(self.images))
+        self.scales = scales if scales is not None else np.ones(len(self.images), dtype=np.float32)
         self.center = config.center
 
     def __len__(self):
-        return len(self.images)
+        return len(self.indices)
 
     def __getitem__(self, idx) -> Tuple[Tensor, Tensor]:
-        img = self.images[idx]
-        img = torch.FloatTensor(img)
+        idx = self.indices[idx]
+        img = torch.FloatTensor(to_float32(self.images[idx], self.scales[idx]))
         # Center input
         if self.center:
             img = (img - 0.5) * 2
@@ -102,35 +131,48 @@ def get_dataloaders(config: Namespace,
         if config.percentage != 100:
             config.return_volumes = True
 
-        # get array of slices
-        slices = get_camcan_slices(config)
+        # get array of slices and their statistics
+        config.return_stats = True
+        slices, stats = get_camcan_slices(config)
 
         # percentage experiment: keep a specific percentage of the volumes, or a single volume.
         # for seed != 10 (stadard seed), take them from the back of the list
+        repeats = 1
         if config.percentage != 100:
             if config.percentage == -1:  # single img scenario
                 if config.seed == 10:
                     slices = slices[0]
+                    stats = stats.select_volumes(slice(None, 1))
                 else:
                     slices = slices[-1]
-                slices = [slices] * 100
-                slices = np.concatenate(slices, axis=0)
+                    stats = stats.select_volumes(slice(-1, None))
+                # the volume is repeated 100 times virtually, see below
+                repeats = 100
             else:
+                num_volumes = int(len(slices) * (config.percentage / 100))
                 if config.seed == 10:
-                    slices = slices[:int(len(slices) * (config.percentage / 100))]
+                    volumes = slice(None, num_volumes)
                 else:
-                    slices = slices[-int(len(slices) * (config.percentage / 100)):]
+                    volumes = slice(-num_volumes, None)
+                slices = slices[volumes]
+                stats = stats.select_volumes(volumes)
 
-                slices = np.concatenate(slices, axis=0)
+                # volumes are contiguous, so this is a view for memory-mapped slices
+                slices = slices.reshape(-1, *slices.shape[2:])
 
         # keep slices with brain pixels in them
-        slices = slices[np.sum(slices, axis=(1, 2, 3)) > 0]
+        brain_idx = stats.foreground_idx()
 
-        # calculate dataset split index
-        split_idx = int(len(slices) * config.normal_split)
+        if repeats > 1:
+            # split as if the slices were repeated, without copying them
+            trainset, valset = split_repeated(NormalDataset(slices, config, brain_idx, stats.scale),
+                                              repeats, config.normal_split)
+        else:
+            # calculate dataset split index
+            split_idx = int(len(brain_idx) * config.normal_split)
 
-        trainset = NormalDataset(slices[:split_idx], config)
-        valset = NormalDataset(slices[split_idx:], config)
+            trainset = NormalDataset(slices, config, brain_idx[:split_idx], stats.scale)
+            valset = NormalDataset(slices, config, brain_idx[split_idx:], stats.scale)
 
         train_dl = GenericDataloader(trainset, config)
         val_dl = GenericDataloader(valset, config)
@@ -142,35 +184,34 @@ def get_dataloaders(config: Namespace,
         # split before concating the volumes to keep complete patient samples in each subset
         config.return_volumes = True
 
+        config.return_stats = True
+
         if config.sequence == 't1':
             if config.brats_t1:
-                slices, segmentations = get_brats_slices(config)
+                slices, segmentations, stats = get_brats_slices(config)
             else:
-                slices, segmentations = get_atlas_slices(config)
+                slices, segmentations, stats = get_atlas_slices(config)
         elif config.sequence == 't2':
-            slices, segmentations = get_brats_slices(config)
+            slices, segmentations, stats = get_brats_slices(config)
 
         split_idx = int(len(slices) * config.anomal_split)
 
-        slices_big = np.concatenate(slices[:split_idx], axis=0)
-        slices_small = np.concatenate(slices[split_idx:], axis=0)
-        seg_big = np.concatenate(segmentations[:split_idx], axis=0)
-        seg_small = np.concatenate(segmentations[split_idx:], axis=0)
+        # volumes are contiguous, so these are views for memory-mapped slices
+        slices_big = slices[:split_idx].reshape(-1, *slices.shape[2:])
+        slices_small = slices[split_idx:].reshape(-1, *slices.shape[2:])
+        seg_big = segmentations[:split_idx].reshape(-1, *segmentations.shape[2:])
+        seg_small = segmentations[split_idx:].reshape(-1, *segmentations.shape[2:])
+
+        stats_big = stats.select_volumes(slice(None, split_idx))
+        stats_small = stats.select_volumes(slice(split_idx, None))
 
         # keep slices with brain pixels in them
-        non_zero_idx_s = np.sum(slices_small, axis=(1, 2, 3)) > 0
-        slices_small = slices_small[non_zero_idx_s]
-        seg_small = seg_small[non_zero_idx_s]
-
-        non_zero_idx_b = np.sum(slices_big, axis=(1, 2, 3)) > 0
-        slices_big = slices_big[non_zero_idx_b]
-        seg_big = seg_big[non_zero_idx_b]
-
-        for i in slices_big:
-            if np.count_nonzero(i) < 5:
-                print(np.count_nonzero(i))
-        big = AnomalDataset([slices_big, seg_big], config)
-        small = AnomalDataset([slices_small, seg_small], config)
+        non_zero_idx_s = stats_small.foreground_idx()
+        non_zero_idx_b = stats_big.foreground_idx()
+
+        print_sparse_slices(stats_big, non_zero_idx_b)
+        big = AnomalDataset([slices_big, seg_big], config, non_zero_idx_b, stats_big.scale)
+        small = AnomalDataset([slices_small, seg_small], config, non_zero_idx_s, stats_small.scale)
 
         big_test_dl = GenericDataloader(big, config, shuffle=config.shuffle)
         small_test_dl = GenericDataloader(small, config, shuffle=config.shuffle)
@@ -5,11 +5,10 @@ from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms as T
 from torch import Tensor
 from argparse import Namespace
-from UPD_study.utilities.utils import GenericDataloader
-from glob import glob
+from UPD_study.utilities.utils import GenericDataloader, split_repeated
 import torch
-from multiprocessing import Pool, cpu_count
-from functools import partial
+from UPD_study.data.dataloaders.image_shards import preload_images
+from UPD_study.data.dataloaders.manifest import get_manifest
 
 
 def get_files(config: Namespace, train: bool = True) -> Union[List, Tuple[List, ...]]:
@@ -27,13 +26,13 @@ def get_files(config: Namespace, train: bool = True) -> Union[List, Tuple[List,
 
     """
 
-    norm_paths = sorted(
-        glob(os.path.join(config.datasets_dir, 'RF', 'DDR-dataset', 'healthy', '*.jpg')))
-    anom_paths = sorted(glob(os.path.join(config.datasets_dir,
-                                          'RF', 'DDR-dataset', 'unhealthy', 'images', '*.png')))
+    # the directory listings are read from the manifest of the dataset
+    manifest = get_manifest(os.path.join(config.datasets_dir, 'RF'), config)
+    norm_paths = sorted(manifest.glob(os.path.join('DDR-dataset', 'healthy', '*.jpg')))
+    anom_paths = sorted(manifest.glob(os.path.join('DDR-dataset', 'unhealthy', 'images', '*.png')))
 
-    segmentations = sorted(glob(os.path.join(config.datasets_dir, 'RF', 'DDR-dataset',
-                                             'unhealthy', 'segmentations', '*.png')))
+    segmentations = sorted(manifest.glob(os.path.join('DDR-dataset', 'unhealthy', 'segmentations', '*.png')))
+    manifest.save()
     if train:
         return norm_paths[757:]
     else:
@@ -58,19 +57,13 @@ class NormalDataset(Dataset):
 
         self.files = files
         self.center = config.center
-        self.transforms = T.Compose([
-            T.Resize((config.image_size), T.InterpolationMode.LANCZOS),
-            T.CenterCrop((config.image_size)),
-            T.ToTensor(),
-        ])
 
-        with Pool(cpu_count()) as pool:
-            self.preload = pool.map(partial(self.load_file), files)
+        # resized images are decoded once into a memory-mapped shard, shared by all workers
+        self.shard = preload_images(files, config, 'train', keep_aspect=True)
 
     def load_file(self, file):
 
-        image = Image.open(file)
-        image = self.transforms(image)
+        image = self.shard.tensor(file)
         if self.center:
             # Center input
             image = (image - 0.5) * 2
@@ -88,7 +81,7 @@ class NormalDataset(Dataset):
             image: image tensor of size []
         """
 
-        return self.preload[idx]
+        return self.load_file(self.files[idx])
 
 
 class AnomalDataset(Dataset):
@@ -179,12 +172,14 @@ def get_dataloaders(config: Namespace,
 
         # percentage experiment: keep a specific percentage of the train files, or a single image.
         # for seed != 10 (stadard seed), take them from the back of the list
+        repeats = 1
         if config.percentage != 100:
             if config.percentage == -1:  # single img scenario
                 if config.seed == 10:
-                    trainfiles = [trainfiles[0]] * 500
+                    trainfiles = [trainfiles[0]]
                 else:
-                    trainfiles = [trainfiles[-1]] * 500
+                    trainfiles = [trainfiles[-1]]
+                repeats = 500
 
             else:
                 if config.seed == 10:
@@ -195,13 +190,18 @@ def get_dataloaders(config: Namespace,
                     print(
                         f'Number of train samples ({len(trainfiles)})',
                         f' lower than batch size ({config.batch_size}). Repeating trainfiles 10 times.')
-                    trainfiles = trainfiles * 10
+                    repeats = 10
 
-        # calculate dataset split index
-        split_idx = int(len(trainfiles) * config.normal_split)
+        if repeats > 1:
+            # split as if the files were repeated, without loading them repeatedly
+            trainset, valset = split_repeated(NormalDataset(trainfiles, config),
+                                              repeats, config.normal_split)
+        else:
+            # calculate dataset split index
+            split_idx = int(len(trainfiles) * config.normal_split)
 
-        trainset = NormalDataset(trainfiles[:split_idx], config)
-        valset = NormalDataset(trainfiles[split_idx:], config)
+            trainset = NormalDataset(trainfiles[:split_idx], config)
+            valset = NormalDataset(trainfiles[split_idx:], config)
 
         train_dl = GenericDataloader(trainset, config)
         val_dl = GenericDataloader(valset, config)
@@ -0,0 +1,196 @@
+"""
+Shards of pre-resized 2D images.
+
+A shard holds the resized and center-cropped uint8 images of one split in a single raw
+file, plus a json index with their shape and source paths (the row of an image is its
+position in the index). Datasets read images from the memory-mapped shard instead of
+decoding and resizing the source JPEG/PNG on every access, and fall back to the source
+files when no shard covers them. Datasets that preload all their images (RF) pack their
+own shard on first use with preload_images().
+
+To pack the CXR splits of a configuration, run:
+
+    python UPD_study/data/dataloaders/image_shards.py -mod CXR --image_size 128
+"""
+import os
+import json
+import hashlib
+from argparse import ArgumentParser, Namespace
+from functools import partial
+from glob import glob
+from multiprocessing import Pool, cpu_count
+from typing import Optional, Sequence
+import numpy as np
+import torch
+from PIL import Image
+from torch import Tensor
+from torchvision import transforms as T
+from UPD_study import ROOT
+
+
+def _load_resized(image_size: int, keep_aspect: bool, path: str) -> np.ndarray:
+    # same resizing as the datasets, without the conversion to tensor
+    transforms = T.Compose([
+        T.Resize(image_size if keep_aspect else (image_size, image_size), T.InterpolationMode.LANCZOS),
+        T.CenterCrop(image_size),
+    ])
+    return np.asarray(transforms(Image.open(path)))
+
+
+def pack_images(paths: Sequence[str], shard_path: str, image_size: int,
+                num_processes: int = cpu_count(), keep_aspect: bool = False) -> None:
+    """
+    Resize and center crop images with a process pool and write them to a new shard.
+    Args:
+        paths (Sequence[str]): paths of the source images, all of the same mode
+        shard_path (str): path of the shard, without extension
+        image_size (int): output size of H and W
+        num_processes (int): number of worker processes
+        keep_aspect (bool): resize the shorter side to image_size before cropping,
+                            instead of resizing both sides
+    """
+    os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+    tmp_path = shard_path + f'.{os.getpid()}.tmp'
+
+    images = None
+    with Pool(num_processes) as pool:
+        for idx, image in enumerate(pool.imap(partial(_load_resized, image_size, keep_aspect),
+                                                    paths, chunksize=16)):
+            if images is None:
+                images = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=(len(paths), *image.shape))
+            images[idx] = image
+
+    shape = images.shape
+    images.flush()
+    del images
+    os.replace(tmp_path, shard_path + '.dat')
+
+    # the index is written last, so its existence marks a complete shard
+    index = {'shape': list(shape),
+             'image_size': image_size,
+             'keep_aspect': keep_aspect,
+             'paths': [os.path.normpath(p) for p in paths]}
+    with open(tmp_path + '.json', 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path + '.json', shard_path + '.json')
+
+
+class ImageShard():
+    """
+    Read-only, memory-mapped shard of uint8 images.
+    """
+
+    def __init__(self, shard_path: str):
+        """
+        Args:
+            shard_path (str): path of the shard, without extension
+        """
+        with open(shard_path + '.json') as f:
+            index = json.load(f)
+
+        self.path = shard_path
+        self.image_size = index['image_size']
+        self.keep_aspect = index.get('keep_aspect', False)
+        self.rows = {p: row for row, p in enumerate(index['paths'])}
+        self.images = np.memmap(shard_path + '.dat', dtype=np.uint8, mode='r',
+                                shape=tuple(index['shape']))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.normpath(path) in self.rows
+
+    def array(self, path: str) -> np.ndarray:
+        """Image as a read-only uint8 view of shape [H, W] or [H, W, C]"""
+        return self.images[self.rows[os.path.normpath(path)]]
+
+    def tensor(self, path: str) -> Tensor:
+        """Image as float tensor of shape [C, H, W] in [0, 1], identical to T.ToTensor()"""
+        image = torch.from_numpy(self.array(path).astype(np.float32)) / 255
+        if image.ndim == 2:
+            return image.unsqueeze(0)
+        return image.permute(2, 0, 1).contiguous()
+
+
+def shard_dir(config: Namespace) -> str:
+    return os.path.join(config.datasets_dir, config.modality, 'shards')
+
+
+def shard_path(config: Namespace, split: str, paths: Sequence[str]) -> str:
+    """Path of the shard of a split, named after its image size and source paths"""
+    digest = hashlib.sha1('\n'.join(os.path.normpath(p) for p in paths).encode()).hexdigest()
+    return os.path.join(shard_dir(config), f'{split}_{config.image_size}_{digest[:12]}')
+
+
+def find_shard(paths: Sequence[str], config: Namespace, keep_aspect: bool = False) -> Optional[ImageShard]:
+    """
+    Return a shard of config.image_size images, resized as given by keep_aspect,
+    that contains all paths, or None if no such shard was packed.
+    """
+    for index_path in sorted(glob(os.path.join(shard_dir(config), f'*_{config.image_size}_*.json'))):
+        shard = ImageShard(index_path[:-len('.json')])
+        if shard.keep_aspect == keep_aspect and all(p in shard for p in paths):
+            print(f'Reading {len(paths)} images from shard {shard.path}.')
+            return shard
+
+    return None
+
+
+def get_shard(paths: Sequence[str], config: Namespace, keep_aspect: bool = False) -> Optional[ImageShard]:
+    """Shard to read paths from, if enabled in config and packed, else None"""
+    if 'image_shards' not in config or not config.image_shards:
+        return None
+    return find_shard(paths, config, keep_aspect)
+
+
+def preload_images(paths: Sequence[str], config: Namespace, split: str,
+                   keep_aspect: bool = False) -> ImageShard:
+    """
+    Return a shard containing all paths, packing a new one in the shard directory if none
+    exists yet. Images are decoded once by the packing processes straight into the shard,
+    and later runs reuse it without decoding. DataLoader workers read the same pages of the
+    memory-mapped shard, instead of each holding a copy of a list of preloaded tensors.
+    Args:
+        paths (Sequence[str]): paths of the images, may contain duplicates
+        config (Namespace): config object, with "datasets_dir", "modality" and "image_size"
+        split (str): name of the split, used in the shard name
+        keep_aspect (bool): see pack_images()
+    Returns:
+        shard (ImageShard): shard containing all paths
+    """
+    shard = find_shard(paths, config, keep_aspect)
+    if shard is None:
+        unique_paths = list(dict.fromkeys(paths))
+        path = shard_path(config, split, unique_paths)
+        print(f'Packing {len(unique_paths)} {split} images to {path}...')
+        pack_images(unique_paths, path, config.image_size, keep_aspect=keep_aspect)
+        shard = ImageShard(path)
+
+    return shard
+
+
+def get_config():
+    from UPD_study.utilities.common_config import common_config
+    parser = ArgumentParser()
+    parser = common_config(parser)
+    parser.add_argument('--num_processes', type=int, default=cpu_count(), help='Number of packing processes')
+    config = parser.parse_args()
+    if config.modality != 'CXR':
+        parser.error(f'packing of {config.modality} images is not supported, use --modality CXR')
+    return config
+
+
+if __name__ == '__main__':
+    config = get_config()
+    config.datasets_dir = os.path.join(ROOT, 'data/datasets')
+
+    from UPD_study.data.dataloaders.CXR import get_files
+    train = get_files(config, train=True)
+    normal, anomal, _, _ = get_files(config, train=False)
+    splits = {'train': train, 'test': normal + anomal}
+
+    for split, paths in splits.items():
+        path = shard_path(config, split, paths)
+        print(f'Packing {len(paths)} {split} images to {path}...')
+        pack_images(paths, path, config.image_size, config.num_processes)
@@ -0,0 +1,222 @@
+"""
+Dataset manifests.
+
+A manifest is a json file in the .manifest directory of a dataset that records, for the files
+the loaders and the preprocessing handlers touch, their size, mtime and content hash, the
+results of the glob patterns used to find them, the lines of split files and the outputs
+of every preprocessing stage together with the hashes of the inputs they were derived from.
+
+Nothing in a manifest is trusted blindly: a file is only re-hashed when its size or mtime
+changed, a glob result is reused as long as none of the directories it listed changed
+(adding or removing an entry updates the mtime of its directory), and a preprocessing
+output is only rebuilt when one of its inputs or the output itself changed. With
+--dataset_manifest, loaders read the manifest instead of walking the dataset tree on every
+run, which requires write access to the dataset directory. Re-running prepare_data.py only
+redoes the entries whose inputs changed.
+"""
+import os
+import json
+import fcntl
+import hashlib
+from glob import glob, has_magic
+from typing import Dict, List, Sequence
+
+# bump when the layout of the manifest changes
+MANIFEST_VERSION = 1
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """sha1 hex digest of the content of a file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DatasetManifest():
+    """
+    Manifest of a dataset directory, stored in <root>/.manifest/manifest.json. It has its
+    own directory, so that writing it does not change the mtime of the dataset root.
+    Paths are recorded relative to root, changes are written with save(), which merges
+    them into the manifest on disk, so that concurrent runs do not drop each other's records.
+    A manifest that is not persistent neither reads nor writes manifest.json, and globs
+    and reads files directly.
+    """
+
+    def __init__(self, root: str, persistent: bool = True):
+        """
+        Args:
+            root (str): root directory of the dataset
+            persistent (bool): read and write manifest.json
+        """
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.root, '.manifest', 'manifest.json')
+        self.lock_path = os.path.join(self.root, '.manifest', 'manifest.lock')
+        self.persistent = persistent
+        self.dirty = False
+        # keys of the files, globs and (stage, output) records changed since the last save
+        self.changed = {'files': set(), 'globs': set(), 'stages': set()}
+        if persistent and os.path.isdir(self.root):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        manifest = self._read()
+        self.files = manifest['files']
+        self.globs = manifest['globs']
+        self.stages = manifest['stages']
+
+    def _read(self) -> Dict:
+        manifest = None
+        if self.persistent and os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+        if manifest is None or manifest.get('version') != MANIFEST_VERSION:
+            manifest = {'version': MANIFEST_VERSION, 'files': {}, 'globs': {}, 'stages': {}}
+        return manifest
+
+    def _rel(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def _abs(self, rel: str) -> str:
+        return os.path.normpath(os.path.join(self.root, rel))
+
+    def entry(self, path: str) -> Dict:
+        """
+        Record of a file with its size, mtime and sha1, hashed only if the file is new
+        or its size or mtime changed since it was recorded.
+        """
+        rel = self._rel(path)
+        stat = os.stat(path)
+        entry = self.files.get(rel)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            sha1 = file_hash(path)
+            if entry is not None and entry['sha1'] == sha1:
+                # touched only, keep the hash
+                entry = dict(entry, mtime=stat.st_mtime_ns)
+            else:
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': sha1}
+            self.files[rel] = entry
+            self.changed['files'].add(rel)
+            self.dirty = True
+        return entry
+
+    def fingerprint(self, path: str) -> str:
+        """Content hash of a file"""
+        return self.entry(path)['sha1']
+
+    def lines(self, path: str) -> List[str]:
+        """Lines of a text file, e.g. a split file, recorded with the file"""
+        if not self.persistent:
+            with open(path) as f:
+                return f.read().splitlines()
+        entry = self.entry(path)
+        if 'lines' not in entry:
+            with open(path) as f:
+                entry['lines'] = f.read().splitlines()
+            self.changed['files'].add(self._rel(path))
+            self.dirty = True
+        return list(entry['lines'])
+
+    def _listed_dirs(self, pattern: str) -> List[str]:
+        # directories glob lists to match pattern: the deepest directory without magic,
+        # and every directory matching a prefix of the pattern that ends in magic
+        parts = os.path.normpath(pattern).split(os.sep)
+        first_magic = next((i for i, p in enumerate(parts) if has_magic(p)), len(parts) - 1)
+        dirs = [os.sep.join(parts[:first_magic]) or os.sep]
+        for i in range(first_magic + 1, len(parts)):
+            dirs += [d for d in glob(os.sep.join(parts[:i])) if os.path.isdir(d)]
+        return dirs
+
+    def glob(self, pattern: str) -> List[str]:
+        """
+        Absolute paths matching pattern, a glob pattern relative to the dataset root, in the
+        order of glob(). The recorded result is returned as long as no directory listed by it
+        changed.
+        """
+        if not self.persistent:
+            return glob(os.path.join(self.root, pattern))
+
+        record = self.globs.get(pattern)
+        if record is not None:
+            try:
+                if all(os.stat(self._abs(d)).st_mtime_ns == m for d, m in record['dirs'].items()):
+                    return [self._abs(p) for p in record['paths']]
+            except FileNotFoundError:
+                pass
+
+        abs_pattern = os.path.join(self.root, pattern)
+        # stat the directories before listing them, so that changes during the glob
+        # invalidate the record on the next call
+        dirs = {self._rel(d): os.stat(d).st_mtime_ns
+                for d in self._listed_dirs(abs_pattern) if os.path.isdir(d)}
+        paths = glob(abs_pattern)
+        self.globs[pattern] = {'dirs': dirs, 'paths': [self._rel(p) for p in paths]}
+        self.changed['globs'].add(pattern)
+        self.dirty = True
+        return paths
+
+    def stale(self, stage: str, inputs: Sequence[str], outputs: Sequence[str]) -> bool:
+        """
+        True if the outputs of a preprocessing stage have to be (re)built from inputs:
+        an output is missing or was modified, or an input changed since record() was called.
+        """
+        record = self.stages.get(stage, {}).get(self._rel(outputs[0]))
+        if record is None or not all(os.path.exists(o) for o in outputs):
+            return True
+        if record['inputs'] != {self._rel(i): self.fingerprint(i) for i in inputs}:
+            return True
+        return record['outputs'] != {self._rel(o): self.fingerprint(o) for o in outputs}
+
+    def record(self, stage: str, inputs: Sequence[str], outputs: Sequence[str]) -> None:
+        """Record that outputs of stage were built from the current version of inputs"""
+        self.stages.setdefault(stage, {})[self._rel(outputs[0])] = {
+            'inputs': {self._rel(i): self.fingerprint(i) for i in inputs},
+            'outputs': {self._rel(o): self.fingerprint(o) for o in outputs}}
+        self.changed['stages'].add((stage, self._rel(outputs[0])))
+        self.dirty = True
+
+    def save(self) -> None:
+        """Write the manifest if it changed. Under an exclusive lock, the records changed
+        since the last save are merged into the manifest on disk, which is written to a
+        temporary file first, so that concurrent runs neither drop each other's records
+        nor observe a partially written manifest."""
+        if not self.persistent or not self.dirty or not os.path.isdir(os.path.dirname(self.path)):
+            return
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                manifest = self._read()
+                for rel in self.changed['files']:
+                    manifest['files'][rel] = self.files[rel]
+                for pattern in self.changed['globs']:
+                    manifest['globs'][pattern] = self.globs[pattern]
+                for stage, rel in self.changed['stages']:
+                    manifest['stages'].setdefault(stage, {})[rel] = self.stages[stage][rel]
+
+                tmp_path = self.path + f'.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(manifest, f)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        # continue from the merged manifest, which includes the records of other runs
+        self.files = manifest['files']
+        self.globs = manifest['globs']
+        self.stages = manifest['stages']
+        self.changed = {'files': set(), 'globs': set(), 'stages': set()}
+        self.dirty = False
+
+
+def get_manifest(root: str, config=None) -> DatasetManifest:
+    """Return the manifest of a dataset, persistent without config or if enabled in config"""
+    persistent = config is None or ('dataset_manifest' in config and config.dataset_manifest)
+    return DatasetManifest(root, persistent)
+
+
+def glob_files(root: str, pattern: str, config=None) -> List[str]:
+    """Paths matching pattern relative to root, see DatasetManifest.glob()"""
+    manifest = get_manifest(root, config)
+    paths = manifest.glob(pattern)
+    manifest.save()
+    return paths
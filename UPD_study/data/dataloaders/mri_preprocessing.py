@@ -1,13 +1,21 @@
 import os
+from contextlib import nullcontext
 from glob import glob
 from functools import partial
+import threading
 from multiprocessing import Pool, cpu_count
-from typing import Callable, List, Sequence, Tuple
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
 import nibabel as nib
 import numpy as np
 from skimage.exposure import equalize_hist
 from skimage.transform import resize
 from UPD_study import ROOT
+from UPD_study.data.dataloaders.volume_cache import (VolumeCache, cache_key,
+                                                     get_cache_dir, get_volume_cache)
+from UPD_study.data.dataloaders.slice_store import SliceStore, SliceStoreWriter, store_path
+from UPD_study.data.dataloaders.slice_stats import get_slice_stats
+from UPD_study.data.dataloaders.storage import QuantizedVolumes, get_storage_dtype
+from UPD_study.data.dataloaders.manifest import glob_files
 
 
 def get_camcan_files(config) -> List[str]:
@@ -18,8 +26,7 @@ def get_camcan_files(config) -> List[str]:
         files (List[str]): List of files
     """
     path = os.path.join(ROOT, 'data', 'datasets', 'MRI/CamCAN')
-    files = glob(os.path.join(path, '*/',
-                              f'*{config.sequence.upper()}w_stripped_registered.*'))
+    files = glob_files(path, os.path.join('*', f'*{config.sequence.upper()}w_stripped_registered.*'), config)
 
     assert len(files) > 0, "No files found in CamCAN"
     return files
@@ -35,8 +42,9 @@ def get_brats_files(config) -> Tuple[List[str], List[str]]:
     """
     # pt = '/u/home/lagi/thesis/UAD_study/Datasets'
 
-    files = glob(os.path.join(ROOT, 'data', 'datasets', 'MRI/BraTS/MICCAI_BraTS2020_TrainingData/*',
-                              f'*{config.sequence.lower()}*registered.*'))
+    path = os.path.join(ROOT, 'data', 'datasets', 'MRI/BraTS')
+    files = glob_files(path, os.path.join('MICCAI_BraTS2020_TrainingData', '*',
+                                          f'*{config.sequence.lower()}*registered.*'), config)
 
     seg_files = [os.path.join(os.path.dirname(f), 'anomaly_segmentation.nii') for f in files]
     assert len(files) > 0, "No files found in BraTS"
@@ -56,14 +64,15 @@ def get_atlas_files(config) -> List[str]:
         path = '/datasets/Datasets/MRI/ATLAS/lesion'
         files = glob(os.path.join(path, '*/*/*stripped_registered*'))
     else:
-        path = os.path.join(ROOT, 'data', 'datasets', 'MRI/ATLAS/ATLAS_2/Training')
-        files = sorted(glob(os.path.join(path, '*/*/*/*/*stripped_registered*')))
+        path = os.path.join(ROOT, 'data', 'datasets', 'MRI/ATLAS')
+        files = sorted(glob_files(path, 'ATLAS_2/Training/*/*/*/*/*stripped_registered*', config))
     seg_files = [os.path.join(os.path.dirname(f), 'anomaly_segmentation.nii.gz') for f in files]
     assert len(files) > 0, "No files found in ATLAS"
     return files, seg_files
 
 
-def load_nii(path: str, size: int = None, primary_axis: int = 0, dtype: str = "float32"):
+def load_nii(path: str, size: int = None, primary_axis: int = 0, dtype: str = "float32",
+             slice_range: Tuple[int, int] = None):
     """Load a neuroimaging file with nibabel, [w, h, slices]
     https://nipy.org/nibabel/reference/nibabel.html
     Args:
@@ -71,6 +80,9 @@ def load_nii(path: str, size: int = None, primary_axis: int = 0, dtype: str = "f
         size (int): Optional. Output size for h and w. Only supports rectangles
         primary_axis (int): Primary axis (the one to slice along, usually 2)
         dtype (str): Numpy datatype
+        slice_range (Tuple[int, int]): Optional. Lower and upper slice index along the
+                                       primary axis. Only these slices are read from disk
+                                       and decoded, before any resizing.
     Returns:
         volume (np.ndarray): Of shape [w, h, slices]
         affine (np.ndarray): Affine coordinates (rotation and translation),
@@ -78,7 +90,13 @@ def load_nii(path: str, size: int = None, primary_axis: int = 0, dtype: str = "f
     """
     # Load file
     data = nib.load(path, keep_file_open=False)
-    volume = data.get_fdata(caching='unchanged')  # [w, h, slices]
+    if slice_range is not None:
+        # slice the array proxy, so that only the requested slices are read and scaled
+        slicer = [slice(None)] * len(data.shape)
+        slicer[primary_axis] = slice(*slice_range)
+        volume = np.asarray(data.dataobj[tuple(slicer)], dtype=np.dtype(dtype))
+    else:
+        volume = data.get_fdata(caching='unchanged')  # [w, h, slices]
     affine = data.affine
 
     # Squeeze optional 4th dimension
@@ -108,12 +126,10 @@ def load_nii_nn(path: str, size: int,
     Load a file for training. Slices should be first dimension, volumes are in
     MNI space and center cropped to the shorter side, then resized to size
     """
-    vol = load_nii(path, primary_axis=2, dtype=dtype)[0]
+    # only the specified range of slices is read
+    vol = load_nii(path, primary_axis=2, dtype=dtype, slice_range=slice_range)[0]
     # if segm:
     #     print(np.unique(vol // 1))
-    # select specified range of slices
-    if slice_range is not None:
-        vol = vol[slice_range[0]:slice_range[1]]
 
     vol = rectangularize(vol)
 
@@ -145,19 +161,112 @@ def load_nii_nn(path: str, size: int,
 def load_segmentation(path: str, size: int,
                       slice_range: Tuple[int, int] = None,
                       threshold: float = 0.4):
-    """Load a segmentation file"""
+    """Load a segmentation file as uint8 binary mask"""
     vol = load_nii_nn(path, size=size, slice_range=slice_range,
                       normalize=False, equalize_histogram=False, segm=True)
 
-    return np.where(vol > threshold, 1, 0)
+    return (vol > threshold).astype(np.uint8)
 
 
-def load_files_to_ram(files: Sequence, load_fn: Callable = load_nii_nn,
-                      num_processes: int = cpu_count()) -> List[np.ndarray]:
+def _load_indexed(load_fn: Callable, item: Tuple[int, str]) -> Tuple[int, np.ndarray]:
+    # keeps track of the position of a file when results arrive unordered
+    idx, path = item
+    return idx, load_fn(path)
+
+
+def stream_files(files: Sequence, load_fn: Callable = load_nii_nn,
+                 num_processes: int = cpu_count(),
+                 cache: VolumeCache = None,
+                 max_in_flight: int = None,
+                 ordered: bool = True) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Load files with load_fn in parallel and yield each volume as soon as it arrives.
+    At most max_in_flight volumes are submitted to, or held by, the pool at any time,
+    so memory held in transit is bounded independently of the number of files.
+    Args:
+        files (Sequence): paths of the files to load
+        load_fn (Callable): load function applied to every path
+        num_processes (int): number of worker processes
+        cache (VolumeCache): Optional. If given, cache hits are yielded first (memory-mapped)
+                             and only cache misses are decoded (and then cached)
+        max_in_flight (int): Optional. Size of the in-flight window, defaults to 2 * num_processes
+        ordered (bool): yield decoded volumes in the order of files (imap) or in order
+                        of completion (imap_unordered)
+    Yields:
+        idx (int): position of the volume in files
+        volume (np.ndarray): loaded volume
+    """
+    pending = list(range(len(files)))
+    if cache is not None:
+        keys = [cache_key(f, load_fn) for f in files]
+        pending = []
+        for idx, key in enumerate(keys):
+            volume = cache.get(key)
+            if volume is None:
+                pending.append(idx)
+            else:
+                yield idx, volume
+
+    if len(pending) == 0:
+        return
+
+    window = threading.BoundedSemaphore(max_in_flight or 2 * num_processes)
+    stop = threading.Event()
+
+    def throttled_items():
+        # consumed by the pool's task handler thread, which blocks here while the window is full
+        for idx in pending:
+            while not window.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            yield idx, files[idx]
+
     with Pool(num_processes) as pool:
-        results = pool.map(load_fn, files)
+        imap = pool.imap if ordered else pool.imap_unordered
+        try:
+            for idx, volume in imap(partial(_load_indexed, load_fn), throttled_items()):
+                window.release()
+                if cache is not None:
+                    cache.put(keys[idx], volume)
+                yield idx, volume
+        finally:
+            # unblock the task handler before the pool is terminated, in case
+            # the consumer stopped early
+            stop.set()
+
+
+def load_files_to_ram(files: Sequence, load_fn: Callable = load_nii_nn,
+                      num_processes: int = cpu_count(),
+                      cache: VolumeCache = None,
+                      allocate: Callable = np.empty,
+                      max_in_flight: int = None) -> np.ndarray:
+    """
+    Load all files with load_fn in parallel, directly into one preallocated array.
+    Volumes are written to the output as they arrive, so peak memory is about one dataset.
+    Returns only once every volume is loaded: the datasets are built from the returned
+    array, since foreground filtering and splitting need all slices.
+    Args:
+        files (Sequence): paths of the files to load
+        load_fn (Callable): load function applied to every path
+        num_processes (int): number of worker processes
+        cache (VolumeCache): Optional. Volume cache, see stream_files()
+        allocate (Callable): called with (shape, dtype) on arrival of the first volume to
+                             allocate the output, e.g. SliceStoreWriter.allocate to write
+                             into a memory-mapped store. Defaults to np.empty
+        max_in_flight (int): Optional. Size of the in-flight window, see stream_files()
+    Returns:
+        volumes (np.ndarray): loaded volumes with shape [volumes, slices, H, W]
+    """
+    volumes = None
+    for idx, volume in stream_files(files, load_fn, num_processes, cache,
+                                    max_in_flight, ordered=False):
+        if volumes is None:
+            volumes = allocate((len(files), *volume.shape), volume.dtype)
+        assert volume.shape == volumes.shape[1:], \
+            f"{files[idx]} has shape {volume.shape}, expected {volumes.shape[1:]}"
+        volumes[idx] = volume
 
-    return results
+    return volumes
 
 
 def histogram_equalization(img):
@@ -214,95 +323,182 @@ def rectangularize(img: np.ndarray) -> np.ndarray:
     return img
 
 
+def slice_store_path(files: Sequence, load_fn: Callable, config,
+                     storage_dtype: str = 'float32') -> Optional[str]:
+    """Path of the slice store of files loaded with load_fn, or None if config.slice_store is off"""
+    if 'slice_store' in config and config.slice_store:
+        path = store_path(os.path.join(get_cache_dir(config), 'stores'), files, load_fn)
+        return path if storage_dtype == 'float32' else f'{path}_{storage_dtype}'
+    return None
+
+
+def load_volumes(files: Sequence, load_fn: Callable, config,
+                 cache: VolumeCache = None,
+                 storage_dtype: str = 'float32') -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load all files with load_fn. If config.slice_store, the volumes are read from a
+    memory-mapped SliceStore, which is built on first use.
+    Args:
+        files (Sequence): paths of the files to load
+        load_fn (Callable): load function applied to every path, see get_load_fns()
+        config (Namespace): configuration object
+        cache (VolumeCache): Optional. Volume cache passed on to load_files_to_ram
+        storage_dtype (str): dtype the volumes are kept in, see storage.py
+    Returns:
+        volumes (np.ndarray): array of shape [volumes, slices, 1, H, W], memory-mapped
+                              if config.slice_store
+        scales (np.ndarray): scale of the stored values of every volume, see storage.py
+    """
+    if 'preprocessing_backend' in config and config.preprocessing_backend == 'torch':
+        from UPD_study.data.dataloaders.mri_preprocessing_torch import load_files_batched as load_files
+    else:
+        load_files = load_files_to_ram
+
+    def load(allocate: Callable) -> Tuple[np.ndarray, np.ndarray]:
+        if storage_dtype == 'float32':
+            volumes = load_files(files, load_fn, cache=cache, allocate=allocate)
+            return volumes, np.ones(len(volumes), dtype=np.float32)
+        quantized = QuantizedVolumes(storage_dtype, allocate)
+        load_files(files, load_fn, cache=cache, allocate=quantized.allocate)
+        return quantized.volumes, quantized.scales
+
+    path = slice_store_path(files, load_fn, config, storage_dtype)
+    if path is not None:
+        if not SliceStore.exists(path):
+            writer = SliceStoreWriter(path)
+            # the store persists the volumes, so they are not written to the volume cache as well
+            with cache.read_only() if cache is not None else nullcontext():
+                _, scales = load(writer.allocate)
+            writer.commit(scales)
+        print(f'Using slice store {path}.')
+        store = SliceStore(path)
+        return store.volumes(), store.volume_scales
+
+    volumes, scales = load(np.empty)
+    return volumes[:, :, None], scales
+
+
+def get_load_fns(config) -> Tuple[Callable, Callable]:
+    """Return the image and segmentation load functions of the configured preprocessing backend"""
+    if 'preprocessing_backend' in config and config.preprocessing_backend == 'torch':
+        from UPD_study.data.dataloaders.mri_preprocessing_torch import (
+            load_nii_nn_torch, load_segmentation_torch)
+        return load_nii_nn_torch, load_segmentation_torch
+
+    return load_nii_nn, load_segmentation
+
+
+def to_slices(volumes: np.ndarray, return_volumes: bool) -> np.ndarray:
+    """
+    Arrange the output of load_volumes as an array of shape [volumes, slices, 1, H, W]
+    if return_volumes, else [slices, 1, H, W]. Volumes are contiguous, so this never copies.
+    """
+    return volumes if return_volumes else volumes.reshape(-1, *volumes.shape[2:])
+
+
 def get_camcan_slices(config):
-    """Get all image slices of the CamCAN brain MRI dataset"""
+    """Get all image slices of the CamCAN brain MRI dataset, and their SliceStats if config.return_stats"""
     # Get all files
     files = get_camcan_files(config)
     hist = config.equalize_histogram if 'equalize_histogram' in config else False
+    cache = get_volume_cache(config)
+    load_nii_fn, load_segmentation_fn = get_load_fns(config)
+    load_fn = partial(load_nii_fn,
+                      size=config.image_size,
+                      slice_range=config.slice_range if 'slice_range' in config else None,
+                      normalize=config.normalize if 'normalize' in config else False,
+                      equalize_histogram=hist
+                      )
+    storage_dtype = get_storage_dtype(config)
     # Load all files
-    volumes = load_files_to_ram(
-        files,
-        partial(load_nii_nn,
-                size=config.image_size,
-                slice_range=config.slice_range if 'slice_range' in config else None,
-                normalize=config.normalize if 'normalize' in config else False,
-                equalize_histogram=hist
-                )
-    )
-    if "return_volumes" in config and config.return_volumes:
-        return np.stack(volumes, axis=0)[:, :, None]
-    else:
-        images = np.concatenate(volumes, axis=0)[:, None]
+    volumes, scales = load_volumes(files, load_fn, config, cache=cache, storage_dtype=storage_dtype)
+    if cache is not None:
+        cache.report()
 
-        return images
+    slices = to_slices(volumes, "return_volumes" in config and config.return_volumes)
+    if "return_stats" in config and config.return_stats:
+        store = slice_store_path(files, load_fn, config, storage_dtype)
+        return slices, get_slice_stats(volumes, scales, store)
+    return slices
 
 
 def get_brats_slices(config):
-    """Get all image slices and segmentations of the BraTS brain MRI dataset"""
+    """
+    Get all image slices and segmentations of the BraTS brain MRI dataset,
+    and the SliceStats of the image slices if config.return_stats
+    """
     # Get all files
     files, seg_files = get_brats_files(config)
     hist = config.equalize_histogram if 'equalize_histogram' in config else False
+    cache = get_volume_cache(config)
+    load_nii_fn, load_segmentation_fn = get_load_fns(config)
+    load_fn = partial(load_nii_fn,
+                      size=config.image_size,
+                      slice_range=config.slice_range if 'slice_range' in config else None,
+                      normalize=config.normalize if 'normalize' in config else False,
+                      equalize_histogram=hist)
+    storage_dtype = get_storage_dtype(config)
     # Load all files
-    volumes = load_files_to_ram(
-        files,
-        partial(load_nii_nn,
-                size=config.image_size,
-                slice_range=config.slice_range if 'slice_range' in config else None,
-                normalize=config.normalize if 'normalize' in config else False,
-                equalize_histogram=hist)
-    )
+    volumes, scales = load_volumes(files, load_fn, config, cache=cache, storage_dtype=storage_dtype)
 
     # Load all files
-    seg_volumes = load_files_to_ram(
+    seg_volumes, _ = load_volumes(
         seg_files,
-        partial(load_segmentation,
+        partial(load_segmentation_fn,
                 size=config.image_size,
-                slice_range=config.slice_range if 'slice_range' in config else None)
+                slice_range=config.slice_range if 'slice_range' in config else None),
+        config,
+        cache=cache
     )
+    if cache is not None:
+        cache.report()
 
-    if "return_volumes" in config and config.return_volumes:
-        return np.stack(volumes, axis=0)[:, :, None], np.stack(seg_volumes, axis=0)[:, :, None]
-    else:
-        imgs = np.concatenate(volumes, axis=0)[:, None]
-        segs = np.concatenate(seg_volumes, axis=0)[:, None]
-
-        return imgs, segs
+    return_volumes = "return_volumes" in config and config.return_volumes
+    slices, segmentations = to_slices(volumes, return_volumes), to_slices(seg_volumes, return_volumes)
+    if "return_stats" in config and config.return_stats:
+        store = slice_store_path(files, load_fn, config, storage_dtype)
+        return slices, segmentations, get_slice_stats(volumes, scales, store)
+    return slices, segmentations
 
 
 def get_atlas_slices(config):
-    """Get all image slices and segmentations of the ATLAS brain MRI dataset"""
+    """
+    Get all image slices and segmentations of the ATLAS brain MRI dataset,
+    and the SliceStats of the image slices if config.return_stats
+    """
     # Get all files
     files, seg_files = get_atlas_files(config)
-    hist = hist = config.equalize_histogram if 'equalize_histogram' in config else False
+    hist = config.equalize_histogram if 'equalize_histogram' in config else False
+    cache = get_volume_cache(config)
+    load_nii_fn, load_segmentation_fn = get_load_fns(config)
+    load_fn = partial(load_nii_fn,
+                      is_atlas=True,
+                      size=config.image_size,
+                      slice_range=config.slice_range if 'slice_range' in config else None,
+                      normalize=config.normalize if 'normalize' in config else False,
+                      equalize_histogram=hist)
+    storage_dtype = get_storage_dtype(config)
     # Load all files
-    volumes = load_files_to_ram(
-        files,
-        partial(load_nii_nn,
-                is_atlas=True,
-                size=config.image_size,
-                slice_range=config.slice_range if 'slice_range' in config else None,
-                normalize=config.normalize if 'normalize' in config else False,
-                equalize_histogram=hist)
-    )
+    volumes, scales = load_volumes(files, load_fn, config, cache=cache, storage_dtype=storage_dtype)
 
     # Load all files
-    seg_volumes = load_files_to_ram(
+    seg_volumes, _ = load_volumes(
         seg_files,
-        partial(load_segmentation,
+        partial(load_segmentation_fn,
                 size=config.image_size,
-                slice_range=config.slice_range if 'slice_range' in config else None)
+                slice_range=config.slice_range if 'slice_range' in config else None),
+        config,
+        cache=cache
     )
-
-    if "return_volumes" in config and config.return_volumes:
-        imgs = np.stack(volumes, axis=0)[:, :, None]
-        segs = np.stack(seg_volumes, axis=0)[:, :, None]
-
-        return imgs, segs
-    else:
-        imgs = np.concatenate(volumes, axis=0)[:, None]
-        segs = np.concatenate(seg_volumes, axis=0)[:, None]
-
-        return imgs, segs
+    if cache is not None:
+        cache.report()
+
+    return_volumes = "return_volumes" in config and config.return_volumes
+    slices, segmentations = to_slices(volumes, return_volumes), to_slices(seg_volumes, return_volumes)
+    if "return_stats" in config and config.return_stats:
+        store = slice_store_path(files, load_fn, config, storage_dtype)
+        return slices, segmentations, get_slice_stats(volumes, scales, store)
+    return slices, segmentations
 
 
 def get_samples(size: int = 128):
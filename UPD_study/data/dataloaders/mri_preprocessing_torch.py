@@ -0,0 +1,237 @@
+"""
+Torch backend of the MRI preprocessing in mri_preprocessing.py.
+
+Volumes are still decoded by a process pool, but removal of interpolation artifacts,
+resizing, percentile normalization and histogram equalization run as torch ops over all
+slices of several volumes at once, in the main process and on all CPU threads. The ops
+reimplement skimage's resize (order 1, anti-aliasing, mode 'reflect') and masked
+equalize_hist, and match the skimage backend up to float32 rounding when downsampling.
+Use `python UPD_study/utilities/benchmarks.py preprocessing` to validate and time both.
+"""
+import math
+from functools import partial
+from multiprocessing import cpu_count
+from typing import Callable, Sequence
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from UPD_study.data.dataloaders.mri_preprocessing import load_nii, rectangularize, stream_files
+from UPD_study.data.dataloaders.volume_cache import VolumeCache, cache_key
+
+
+def gaussian_kernel1d(sigma: float, truncate: float = 4.0) -> Tensor:
+    """1D gaussian kernel, as used by scipy.ndimage.gaussian_filter"""
+    radius = int(truncate * sigma + 0.5)
+    x = torch.arange(-radius, radius + 1, dtype=torch.float64)
+    kernel = torch.exp(-0.5 / sigma ** 2 * x ** 2)
+    return kernel / kernel.sum()
+
+
+def resize_slices(slices: Tensor, size: int) -> Tensor:
+    """
+    Batched skimage.transform.resize of slices to [size, size], with order 1 and
+    anti-aliasing when downsampling. Upsampling clamps at the borders, where skimage
+    mirrors, so the two only agree exactly in the interior in that case.
+    Args:
+        slices (Tensor): slices of shape [N, H, W]
+        size (int): output size of H and W
+    Returns:
+        slices (Tensor): resized slices of shape [N, size, size]
+    """
+    x = slices[:, None]
+    for dim, length in [(-1, x.shape[-1]), (-2, x.shape[-2])]:
+        sigma = max(0, (length / size - 1) / 2)
+        if sigma <= 1e-15:
+            continue
+        kernel = gaussian_kernel1d(sigma).to(x.dtype)
+        radius = len(kernel) // 2
+        # skimage's 'reflect' is ndimage's 'mirror', i.e. torch's 'reflect'
+        if dim == -1:
+            x = F.conv2d(F.pad(x, (radius, radius, 0, 0), mode='reflect'), kernel.view(1, 1, 1, -1))
+        else:
+            x = F.conv2d(F.pad(x, (0, 0, radius, radius), mode='reflect'), kernel.view(1, 1, -1, 1))
+
+    x = F.interpolate(x, size=(size, size), mode='bilinear', align_corners=False)
+    return x[:, 0]
+
+
+def percentile(x: Tensor, q: float) -> Tensor:
+    """np.percentile of a 1D tensor, with linear interpolation"""
+    x = torch.sort(x)[0]
+    pos = q / 100 * (len(x) - 1)
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(x) - 1)
+    return x[lo] + (pos - lo) * (x[hi] - x[lo])
+
+
+def interp(x: Tensor, xp: Tensor, fp: Tensor) -> Tensor:
+    """np.interp for increasing xp, with constant extrapolation"""
+    idx = torch.searchsorted(xp, x.contiguous(), right=True).clamp(1, len(xp) - 1)
+    x0, x1 = xp[idx - 1], xp[idx]
+    y0, y1 = fp[idx - 1], fp[idx]
+    weight = ((x - x0) / (x1 - x0)).clamp(0, 1)
+    return y0 + weight * (y1 - y0)
+
+
+def normalize_percentile(vol: Tensor, q: float = 99) -> Tensor:
+    """Torch version of mri_preprocessing.normalize_percentile"""
+    maxi = percentile(vol[vol > 0], q)
+    return vol.clamp(max=maxi) / maxi
+
+
+def histogram_equalization(vol: Tensor, nbins: int = 256) -> Tensor:
+    """Torch version of mri_preprocessing.histogram_equalization (masked equalize_hist)"""
+    mask = vol > 0
+    values = vol[mask]
+    if values.numel() == 0:
+        return vol
+
+    lo, hi = values.min().item(), values.max().item()
+    if lo == hi:
+        # np.histogram widens empty ranges
+        lo, hi = lo - 0.5, hi + 0.5
+    hist = torch.histc(values, bins=nbins, min=lo, max=hi)
+    cdf = hist.cumsum(0)
+    cdf = cdf / cdf[-1]
+    edges = torch.linspace(lo, hi, nbins + 1, dtype=vol.dtype)
+    bin_centers = (edges[:-1] + edges[1:]) / 2
+
+    return interp(vol.flatten(), bin_centers, cdf).view_as(vol) * mask
+
+
+def preprocess_volumes(volumes: Tensor, size: int = None,
+                       is_atlas: bool = None,
+                       normalize: bool = False,
+                       equalize_histogram: bool = False,
+                       segm: bool = False) -> Tensor:
+    """
+    Batched equivalent of the steps of load_nii_nn that follow decoding and cropping.
+    Args:
+        volumes (Tensor): rectangular volumes of shape [volumes, slices, H, W]
+        size (int): Optional. Output size of H and W
+        is_atlas (bool): Optional. Use the ATLAS threshold for interpolation artifacts
+        normalize (bool): percentile normalization
+        equalize_histogram (bool): histogram equalization
+        segm (bool): volumes are segmentations, do not scale to [0,1]
+    Returns:
+        volumes (Tensor): preprocessed volumes of shape [volumes, slices, size, size]
+    """
+    # fix interpolation artifacts (same condition as load_nii_nn)
+    threshold = 1e-1 if is_atlas is not None or is_atlas else 1e-4
+    volumes = torch.where(volumes < threshold, torch.zeros_like(volumes), volumes)
+
+    if size is not None:
+        v, s = volumes.shape[:2]
+        volumes = resize_slices(volumes.reshape(v * s, *volumes.shape[2:]), size).view(v, s, size, size)
+
+    # percentile normalization and histogram equalization are defined per volume
+    if normalize:
+        volumes = torch.stack([normalize_percentile(vol, 99) for vol in volumes])
+
+    # If not segmentation mask, scale to [0,1]
+    if not segm:
+        maxi = volumes.amax(dim=(1, 2, 3), keepdim=True)
+        volumes = torch.where(maxi > 0, volumes / maxi.clamp(min=1e-12), volumes)
+
+    if equalize_histogram:
+        volumes = torch.stack([histogram_equalization(vol) for vol in volumes])
+
+    return volumes
+
+
+def load_rectangular(path: str, slice_range=None, dtype: str = "float32") -> np.ndarray:
+    """Decode a volume and center crop it to the shorter side, shape [slices, H, W]"""
+    vol = load_nii(path, primary_axis=2, dtype=dtype, slice_range=slice_range)[0]
+    return np.ascontiguousarray(rectangularize(vol))
+
+
+def load_nii_nn_torch(path: str, size: int,
+                      is_atlas: bool = None,
+                      slice_range=None,
+                      normalize: bool = False,
+                      equalize_histogram: bool = False,
+                      dtype: str = "float32", segm=False) -> np.ndarray:
+    """Torch backend version of load_nii_nn, for a single file"""
+    vol = torch.from_numpy(load_rectangular(path, slice_range, dtype))
+    return preprocess_volumes(vol[None], size, is_atlas, normalize,
+                              equalize_histogram, segm)[0].numpy()
+
+
+def load_segmentation_torch(path: str, size: int,
+                            slice_range=None,
+                            threshold: float = 0.4) -> np.ndarray:
+    """Torch backend version of load_segmentation, for a single file"""
+    vol = load_nii_nn_torch(path, size=size, slice_range=slice_range, segm=True)
+    return (vol > threshold).astype(np.uint8)
+
+
+def load_files_batched(files: Sequence, load_fn: Callable,
+                       num_processes: int = cpu_count(),
+                       cache: VolumeCache = None,
+                       allocate: Callable = np.empty,
+                       volumes_per_batch: int = 8) -> np.ndarray:
+    """
+    Torch backend version of load_files_to_ram. Volumes are decoded by the pool and
+    preprocessed in batches of volumes_per_batch in this process.
+    Args:
+        files (Sequence): paths of the files to load
+        load_fn (Callable): functools.partial of load_nii_nn_torch or load_segmentation_torch,
+                            defining the preprocessing parameters (and cache keys)
+        num_processes (int): number of decoding processes
+        cache (VolumeCache): Optional. Volume cache
+        allocate (Callable): allocates the output, see load_files_to_ram()
+        volumes_per_batch (int): number of volumes preprocessed at once
+    Returns:
+        volumes (np.ndarray): loaded volumes with shape [volumes, slices, H, W]
+    """
+    params = dict(load_fn.keywords)
+    if load_fn.func is load_segmentation_torch:
+        threshold = params.pop('threshold', 0.4)
+        params['segm'] = True
+    else:
+        threshold = None
+    dtype = params.pop('dtype', 'float32')
+    slice_range = params.pop('slice_range', None)
+
+    volumes = None
+    keys = [cache_key(f, load_fn) for f in files] if cache is not None else None
+
+    def write(idx: int, volume: np.ndarray) -> None:
+        nonlocal volumes
+        if volumes is None:
+            volumes = allocate((len(files), *volume.shape), volume.dtype)
+        volumes[idx] = volume
+
+    def preprocess(batch: list) -> None:
+        out = preprocess_volumes(torch.from_numpy(np.stack([raw for _, raw in batch])), **params)
+        out = out.numpy() if threshold is None else (out.numpy() > threshold).astype(np.uint8)
+        for (idx, _), volume in zip(batch, out):
+            if cache is not None:
+                cache.put(keys[idx], volume)
+            write(idx, volume)
+
+    pending = []
+    for idx in range(len(files)):
+        volume = cache.get(keys[idx]) if cache is not None else None
+        if volume is None:
+            pending.append(idx)
+        else:
+            write(idx, volume)
+
+    batch = []
+    decode = partial(load_rectangular, slice_range=slice_range, dtype=dtype)
+    for i, raw in stream_files([files[idx] for idx in pending], decode, num_processes, ordered=False):
+        # volumes of different shapes cannot be stacked into one batch
+        if len(batch) > 0 and raw.shape != batch[0][1].shape:
+            preprocess(batch)
+            batch = []
+        batch.append((pending[i], raw))
+        if len(batch) == volumes_per_batch:
+            preprocess(batch)
+            batch = []
+
+    if len(batch) > 0:
+        preprocess(batch)
+
+    return volumes
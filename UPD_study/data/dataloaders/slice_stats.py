@@ -0,0 +1,121 @@
+"""
+Per-slice statistics of MRI datasets.
+
+The statistics are computed in a single pass when the slices are loaded, and stored next
+to the slice store when one is used, so that selecting foreground slices and splitting
+by volume only reads this compact index instead of rescanning the slices.
+"""
+import os
+from typing import Optional, Sequence
+import numpy as np
+
+
+class SliceStats():
+    """
+    Statistics of every slice of an array of shape [volumes, slices, 1, H, W], in the
+    order of the flattened slices. Fields:
+        foreground: number of non-zero voxels
+        minimum, maximum: intensity range
+        volume, position: volume index and position of the slice in its volume
+        scale: scale of the stored values of the slice, see storage.py
+    """
+    fields = ('foreground', 'minimum', 'maximum', 'volume', 'position', 'scale')
+
+    def __init__(self, foreground: np.ndarray, minimum: np.ndarray, maximum: np.ndarray,
+                 volume: np.ndarray, position: np.ndarray, scale: np.ndarray):
+        self.foreground = foreground
+        self.minimum = minimum
+        self.maximum = maximum
+        self.volume = volume
+        self.position = position
+        self.scale = scale
+
+    def __len__(self):
+        return len(self.foreground)
+
+    @staticmethod
+    def compute(volumes: np.ndarray, scales: Optional[np.ndarray] = None) -> 'SliceStats':
+        """
+        Compute the statistics of volumes, one volume at a time.
+        Args:
+            volumes (np.ndarray): array of shape [volumes, slices, 1, H, W], possibly memory-mapped
+            scales (np.ndarray): Optional. Scale of the stored values of every volume
+        """
+        num_volumes, num_slices = volumes.shape[:2]
+        scales = np.ones(num_volumes, dtype=np.float32) if scales is None else np.asarray(scales, np.float32)
+        foreground, minimum, maximum = [], [], []
+        for vol in volumes:
+            vol = np.asarray(vol).reshape(num_slices, -1)
+            foreground.append(np.count_nonzero(vol, axis=1))
+            minimum.append(vol.min(axis=1))
+            maximum.append(vol.max(axis=1))
+
+        scale = np.repeat(scales, num_slices)
+        return SliceStats(foreground=np.concatenate(foreground).astype(np.int32),
+                          minimum=np.concatenate(minimum).astype(np.float32) * scale,
+                          maximum=np.concatenate(maximum).astype(np.float32) * scale,
+                          volume=np.repeat(np.arange(num_volumes, dtype=np.int32), num_slices),
+                          position=np.tile(np.arange(num_slices, dtype=np.int32), num_volumes),
+                          scale=scale)
+
+    def save(self, path: str) -> None:
+        """Save to path.npz"""
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        np.savez(tmp_path + '.npz', **{f: getattr(self, f) for f in self.fields})
+        os.replace(tmp_path + '.npz', path + '.npz')
+
+    @staticmethod
+    def load(path: str) -> 'SliceStats':
+        """Load statistics saved with save()"""
+        with np.load(path + '.npz') as data:
+            stats = {f: data[f] for f in SliceStats.fields if f in data}
+            # statistics saved before quantized storage have no scales
+            stats.setdefault('scale', np.ones(len(stats['foreground']), dtype=np.float32))
+        return SliceStats(**stats)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path + '.npz')
+
+    def select(self, indices: np.ndarray) -> 'SliceStats':
+        """Statistics of the slices at indices (integer or boolean)"""
+        return SliceStats(**{f: getattr(self, f)[indices] for f in self.fields})
+
+    def select_volumes(self, volumes: slice) -> 'SliceStats':
+        """
+        Statistics of the slices of a range of volumes, in the order of the flattened
+        array volumes[volumes].reshape(-1, ...)
+        """
+        selected = np.arange(self.volume.max() + 1 if len(self) > 0 else 0)[volumes]
+        return self.select(np.isin(self.volume, selected))
+
+    def foreground_idx(self, min_voxels: int = 1) -> np.ndarray:
+        """Indices of the slices with at least min_voxels non-zero voxels"""
+        return np.flatnonzero(self.foreground >= min_voxels)
+
+
+def get_slice_stats(volumes: np.ndarray, scales: Optional[np.ndarray] = None,
+                    path: Optional[str] = None) -> SliceStats:
+    """
+    Statistics of volumes. If path is given (the path of the slice store holding the
+    volumes), they are read from path.stats, and computed and saved there on first use.
+    Args:
+        volumes (np.ndarray): array of shape [volumes, slices, 1, H, W]
+        scales (np.ndarray): Optional. Scale of the stored values of every volume
+        path (str): Optional. Path of the slice store of volumes, without extension
+    """
+    if path is None:
+        return SliceStats.compute(volumes, scales)
+
+    stats_path = path + '.stats'
+    if not SliceStats.exists(stats_path):
+        SliceStats.compute(volumes, scales).save(stats_path)
+
+    return SliceStats.load(stats_path)
+
+
+def print_sparse_slices(stats: SliceStats, indices: Sequence[int], min_voxels: int = 5) -> None:
+    """Print the foreground voxel counts of the slices at indices with fewer than min_voxels"""
+    for count in stats.foreground[np.asarray(indices)]:
+        if count < min_voxels:
+            print(count)
@@ -0,0 +1,129 @@
+"""
+Memory-mapped store of MRI slices.
+
+A store is one contiguous raw file holding all slices of a dataset with shape
+[slices, 1, H, W], plus a json index with its shape, dtype and the slice offset of every
+volume. Stores are built with SliceStoreWriter. Datasets index the memory-mapped array
+directly, so slices are only paged in when accessed and DataLoader workers share those
+pages through the OS page cache, instead of each worker holding its own copy of the dataset.
+"""
+import os
+import json
+import hashlib
+from typing import Callable, Optional, Sequence
+import numpy as np
+from UPD_study.data.dataloaders.volume_cache import cache_key
+
+
+def store_path(store_dir: str, files: Sequence[str], load_fn: Callable) -> str:
+    """
+    Path (without extension) of the store holding files loaded with load_fn.
+    The name is derived from the cache keys of all files, so that any change of the
+    source files or of the preprocessing parameters leads to a new store.
+    """
+    keys = ''.join(cache_key(f, load_fn) for f in files)
+    return os.path.join(store_dir, hashlib.sha1(keys.encode()).hexdigest())
+
+
+class SliceStore():
+    """
+    Read-only view of a slice store.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): path of the store, without extension
+        """
+        with open(path + '.json') as f:
+            self.index = json.load(f)
+
+        self.volume_offsets = np.asarray(self.index['volume_offsets'])
+        self.volume_scales = np.asarray(self.index.get('volume_scales', np.ones(len(self))),
+                                        dtype=np.float32)
+        self.slices = np.memmap(path + '.dat', dtype=np.dtype(self.index['dtype']), mode='r',
+                                shape=tuple(self.index['shape']))
+
+    def __len__(self):
+        """Number of volumes in the store"""
+        return len(self.volume_offsets) - 1
+
+    def volume(self, idx: int) -> np.ndarray:
+        """Slices of a single volume, shape [slices, 1, H, W]"""
+        return self.slices[self.volume_offsets[idx]:self.volume_offsets[idx + 1]]
+
+    def volumes(self) -> np.ndarray:
+        """View of all slices with shape [volumes, slices, 1, H, W]"""
+        lengths = np.diff(self.volume_offsets)
+        assert np.all(lengths == lengths[0]), "Volumes of the store have different numbers of slices"
+        return self.slices.reshape(len(self), int(lengths[0]), *self.slices.shape[1:])
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        # the index is written last, so its existence marks a complete store
+        return os.path.exists(path + '.json')
+
+    @staticmethod
+    def write_index(path: str, shape: Sequence[int], dtype: np.dtype,
+                    volume_offsets: Sequence[int],
+                    volume_scales: Optional[Sequence[float]] = None) -> None:
+        index = {'shape': [int(s) for s in shape],
+                 'dtype': np.dtype(dtype).str,
+                 'volume_offsets': [int(o) for o in volume_offsets]}
+        if volume_scales is not None:
+            index['volume_scales'] = [float(s) for s in volume_scales]
+
+        tmp_path = path + f'.{os.getpid()}.json.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, path + '.json')
+
+
+class SliceStoreWriter():
+    """
+    Builds a new slice store from volumes of equal shape. The output is allocated once,
+    so volumes can be written to it as they arrive, and becomes visible to readers
+    only after commit().
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): path of the store, without extension
+        """
+        self.path = path
+        self.tmp_path = path + f'.{os.getpid()}.tmp'
+        self.volumes = None
+
+    def allocate(self, shape: Sequence[int], dtype: np.dtype) -> np.memmap:
+        """
+        Allocate the store as a writable memory-mapped array.
+        Args:
+            shape (Sequence[int]): [volumes, slices, H, W]
+            dtype (np.dtype): dtype of the slices
+        Returns:
+            volumes (np.memmap): writable array of the given shape
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.volumes = np.memmap(self.tmp_path, dtype=dtype, mode='w+', shape=tuple(shape))
+        return self.volumes
+
+    def commit(self, volume_scales: Optional[Sequence[float]] = None) -> SliceStore:
+        """
+        Flush the written volumes, publish the store and open it read-only.
+        Args:
+            volume_scales (Sequence[float]): Optional. Scale of the stored values of every
+                                             volume, for quantized volumes (see storage.py)
+        """
+        num_volumes, num_slices = self.volumes.shape[:2]
+        shape = (num_volumes * num_slices, 1, *self.volumes.shape[2:])
+        dtype = self.volumes.dtype
+
+        self.volumes.flush()
+        self.volumes = None
+        os.replace(self.tmp_path, self.path + '.dat')
+
+        SliceStore.write_index(self.path, shape, dtype,
+                               np.arange(0, shape[0] + 1, num_slices), volume_scales)
+
+        return SliceStore(self.path)
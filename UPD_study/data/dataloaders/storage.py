@@ -0,0 +1,78 @@
+"""
+Reduced-precision storage of preprocessed MRI slices.
+
+With --storage_dtype float16 or uint8, image volumes are converted as they are loaded and
+kept (in RAM or in the slice store) at 2 or 1 bytes per voxel instead of 4. uint8 volumes
+are quantized with a per-volume scale, value = stored * scale. Datasets upcast each sample
+to float32 in __getitem__ with to_float32(), reading the scale of the slice from SliceStats.
+Use `python UPD_study/utilities/benchmarks.py storage` for the footprint and the error.
+"""
+from typing import Callable, Sequence, Tuple, Union
+import numpy as np
+
+STORAGE_DTYPES = ('float32', 'float16', 'uint8')
+
+
+def get_storage_dtype(config) -> str:
+    """
+    Storage dtype of image volumes. Reduced precision is only used by loaders that
+    request SliceStats (config.return_stats), which carry the per-slice scales.
+    """
+    if 'return_stats' not in config or not config.return_stats:
+        return 'float32'
+    return config.storage_dtype if 'storage_dtype' in config else 'float32'
+
+
+def quantize(volume: np.ndarray, dtype: str) -> Tuple[np.ndarray, float]:
+    """
+    Convert a float volume to the storage dtype.
+    Returns:
+        volume (np.ndarray): converted volume
+        scale (float): scale of the stored values, value = stored * scale
+    """
+    if dtype == 'uint8':
+        maxi = float(volume.max())
+        scale = maxi / 255 if maxi > 0 else 1.
+        return np.rint(volume / scale).astype(np.uint8), scale
+
+    return volume.astype(np.dtype(dtype), copy=False), 1.
+
+
+def to_float32(x: np.ndarray, scale: Union[float, np.ndarray] = 1.) -> np.ndarray:
+    """Upcast stored values to float32, inverse of quantize()"""
+    x = np.asarray(x, dtype=np.float32)
+    if np.all(scale == 1.):
+        return x
+    return x * np.asarray(scale, dtype=np.float32)
+
+
+class QuantizedVolumes():
+    """
+    Output of load_files_to_ram/load_files_batched that converts every volume written to
+    it to the storage dtype and records its scale. Pass allocate() as their allocate
+    argument, after loading the converted volumes and their scales are in volumes and scales.
+    """
+
+    def __init__(self, dtype: str, allocate: Callable = np.empty):
+        """
+        Args:
+            dtype (str): storage dtype, one of STORAGE_DTYPES
+            allocate (Callable): allocates the underlying array, see load_files_to_ram()
+        """
+        assert dtype in STORAGE_DTYPES, f"Unknown storage dtype {dtype}"
+        self.dtype = dtype
+        self._allocate = allocate
+        self.volumes = None
+        self.scales = None
+
+    def allocate(self, shape: Sequence[int], dtype: np.dtype) -> 'QuantizedVolumes':
+        self.volumes = self._allocate(shape, np.dtype(self.dtype))
+        self.scales = np.ones(shape[0], dtype=np.float32)
+        return self
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.volumes.shape
+
+    def __setitem__(self, idx: int, volume: np.ndarray) -> None:
+        self.volumes[idx], self.scales[idx] = quantize(volume, self.dtype)
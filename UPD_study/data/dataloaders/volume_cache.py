@@ -0,0 +1,124 @@
+"""
+Persistent on-disk cache of preprocessed MRI volumes.
+
+Entries are content-addressed: the key hashes the source file path and mtime together
+with the load function and every keyword argument it was bound with (image_size,
+slice_range, normalize, equalize_histogram, is_atlas, ...). Changing a preprocessing
+parameter or touching the source file therefore results in a new entry. Entries are
+stored as plain .npy files, so they can be loaded memory-mapped without decoding.
+"""
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Optional
+import numpy as np
+from UPD_study import ROOT
+
+DEFAULT_CACHE_DIR = os.path.join(ROOT, 'data', 'datasets', 'MRI', 'cache')
+
+# bump when the output of the load functions changes for identical arguments
+CACHE_VERSION = 2
+
+
+def cache_key(path: str, load_fn: Callable) -> str:
+    """
+    Compute the cache key of a source file for a given load function.
+    Args:
+        path (str): path of the source file
+        load_fn (Callable): load function, usually a functools.partial of load_nii_nn
+                            or load_segmentation
+    Returns:
+        key (str): hex digest identifying the preprocessed volume
+    """
+    if isinstance(load_fn, partial):
+        fn_name, params = load_fn.func.__name__, dict(load_fn.keywords)
+    else:
+        fn_name, params = load_fn.__name__, {}
+
+    path = os.path.abspath(path)
+    description = json.dumps({'version': CACHE_VERSION,
+                              'path': path,
+                              'mtime': os.stat(path).st_mtime_ns,
+                              'fn': fn_name,
+                              'params': params},
+                             sort_keys=True, default=str)
+
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+class VolumeCache():
+    """
+    Directory of preprocessed volumes, keyed with cache_key().
+    Keeps count of hits, misses and the number of bytes that did not have to be decoded.
+    """
+
+    def __init__(self, cache_dir: str = None):
+        """
+        Args:
+            cache_dir (str): Optional. Cache directory, defaults to data/datasets/MRI/cache
+        """
+        self.cache_dir = cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.writable = True
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the memory-mapped volume stored under key, or None on a miss"""
+        try:
+            volume = np.load(self.path(key), mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            # ValueError: truncated entry of an interrupted run, will be rewritten
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_saved += volume.nbytes
+        return volume
+
+    def put(self, key: str, volume: np.ndarray) -> None:
+        """Store a volume under key. Written to a temporary file first, so that
+        concurrent runs never observe partially written entries."""
+        if not self.writable:
+            return
+        tmp_path = self.path(key) + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, volume)
+        os.replace(tmp_path, self.path(key))
+
+    @contextmanager
+    def read_only(self):
+        """Serve cache hits without storing the misses, e.g. while the loaded
+        volumes are written to a slice store, which persists them already."""
+        self.writable = False
+        try:
+            yield self
+        finally:
+            self.writable = True
+
+    def report(self) -> None:
+        if self.hits + self.misses == 0:
+            return
+        print(f'Volume cache: {self.hits} hits, {self.misses} misses, '
+              f'{self.bytes_saved / 1e9:.2f} GB loaded without decoding.')
+
+
+def get_cache_dir(config) -> str:
+    """Return the cache directory according to config"""
+    if 'cache_dir' in config and config.cache_dir is not None:
+        return config.cache_dir
+    return DEFAULT_CACHE_DIR
+
+
+def get_volume_cache(config) -> Optional[VolumeCache]:
+    """Return a VolumeCache according to config, or None if caching is disabled"""
+    if 'volume_cache' in config and not config.volume_cache:
+        return None
+    return VolumeCache(get_cache_dir(config))
@@ -33,4 +33,16 @@ python UPD_study/models/expVAE/expVAEtrainer.py -space t
 python UPD_study/models/CutPaste/CPtrainer.py -speed t 
 python UPD_study/models/CutPaste/CPtrainer.py -space t 
 python UPD_study/models/CutPaste/CPtrainer.py -speed t -loc f
-python UPD_study/models/CutPaste/CPtrainer.py -space t -loc f
\ No newline at end of file
+python UPD_study/models/CutPaste/CPtrainer.py -space t -loc f
+# data pipeline benchmarks
+python UPD_study/utilities/benchmarks.py nifti --sequence t2 --slice_range 0 155
+python UPD_study/utilities/benchmarks.py nifti --sequence t2 --slice_range 60 100
+python UPD_study/utilities/benchmarks.py preprocessing --sequence t2
+python UPD_study/utilities/benchmarks.py preprocessing --sequence t2 --equalize_histogram t
+python UPD_study/utilities/benchmarks.py segmentations --sequence t2
+python UPD_study/utilities/benchmarks.py storage --sequence t2
+python UPD_study/utilities/benchmarks.py loader --num_slices 20000 --batch_size 32
+python UPD_study/utilities/benchmarks.py pii --image_size 128 --channels 1
+python UPD_study/utilities/benchmarks.py ccd_augmentation --image_size 128 --batch_size 32
+python UPD_study/utilities/benchmarks.py metrics --num_pixels 20000000
+python UPD_study/utilities/benchmarks.py postprocessing --image_size 128 --batch_size 32
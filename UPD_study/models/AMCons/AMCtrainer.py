@@ -15,6 +15,7 @@ from UPD_study.utilities.common_config import common_config
 from UPD_study.utilities.utils import (save_model, test_inference_speed, seed_everything,
                                        load_data, load_pretrained,
                                        misc_settings, load_model, log)
+from UPD_study.utilities.postprocessing import foreground_mask, masked_max, sample_max, sample_mean
 
 from typing import Tuple
 import torch.nn.functional as F
@@ -183,14 +184,14 @@ def val_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
 
     # for MRI apply brainmask
     if config.modality == 'MRI':
-        mask = torch.stack([inp > inp.min() for inp in input])
+        mask = foreground_mask(input)
         anomaly_map *= mask
-        anomaly_score = torch.tensor([map[inp > inp.min()].max() for map, inp in zip(anomaly_map, input)])
+        anomaly_score = masked_max(anomaly_map, mask)
 
     elif config.modality == 'DDR':
-        anomaly_score = torch.tensor([map.max() for map in anomaly_map])
+        anomaly_score = sample_max(anomaly_map)
     else:
-        anomaly_score = torch.tensor([map.mean() for map in anomaly_map])
+        anomaly_score = sample_mean(anomaly_map)
 
     return anomaly_map, anomaly_score, input_recon
 
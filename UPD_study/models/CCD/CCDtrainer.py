@@ -39,6 +39,9 @@ def get_config():
     parser.add_argument('--lr', '-lr', type=float, default=0.01, help='Learning rate')
     parser.add_argument('--max-epochs', type=int, default=200, help='Number of training epochs')
     parser.add_argument('--max-steps', '-ms', type=int, default=20000, help='Number of training steps')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size')
+    parser.add_argument('--batch_augmentation', type=str_to_bool, default=False,
+                        help='Apply the SimCLR augmentations to whole batches on device, instead of per image')
 
     # VAE Hyperparameters
     parser.add_argument('--latent_dim', type=int, default=512, help='Model width')
@@ -107,13 +110,14 @@ misc_settings(config)
 print('Loading dataset...')
 
 if config.modality == 'MRI':
-    from UPD_study.models.CCD.datasets.MRI_CCD import get_train_dataloader
+    from UPD_study.models.CCD.datasets.MRI_CCD import get_train_dataloader, get_batch_augmentation
 elif config.modality == 'CXR':
-    from UPD_study.models.CCD.datasets.CXR_CCD import get_train_dataloader
+    from UPD_study.models.CCD.datasets.CXR_CCD import get_train_dataloader, get_batch_augmentation
 elif config.modality == 'RF':
-    from UPD_study.models.CCD.datasets.RF_CCD import get_train_dataloader
+    from UPD_study.models.CCD.datasets.RF_CCD import get_train_dataloader, get_batch_augmentation
 
 train_dataloader = get_train_dataloader(config)
+batch_augmentation = get_batch_augmentation(config) if config.batch_augmentation else None
 
 """"""""""""""""""""""""""""""""" Init model """""""""""""""""""""""""""""""""
 # Reproducibility
@@ -203,8 +207,13 @@ def train_step(batch):
     optimizer.zero_grad()
 
     # get current batch
-    images = batch['image']
-    images_augmented = batch['image_augmented']
+    if batch_augmentation is not None:
+        # α(x) and α'(x) of the raw images
+        images = batch['image'].to(config.device)
+        images, images_augmented = batch_augmentation(images), batch_augmentation(images)
+    else:
+        images = batch['image']
+        images_augmented = batch['image_augmented']
     b, c, h, w = images.size()
 
     # combine α(x) and α'(x)
@@ -7,6 +7,7 @@ import torch
 import random
 from skimage.util import random_noise
 import torch.nn as nn
+from UPD_study.utilities.color_transforms import color_jitter, rgb_to_grayscale
 
 
 class Cutout1(object):
@@ -194,3 +195,90 @@ class CutPerm(nn.Module):
             inputs = torch.cat((inputs[:, :, :, w_mid:], inputs[:, :, :, 0:w_mid]), dim=3)
 
         return inputs
+
+
+class BatchSimCLRAugmentation(object):
+    """
+    SimCLR augmentations of get_train_dataloader (RandomResizedCrop, RandomHorizontalFlip,
+    ColorJitter with p=0.8, RandomGrayscale and Cutout1) applied to a whole batch of
+    [B, 3, H, W] tensors at once, on their device, with random parameters per sample.
+    Crops are resized bilinearly with grid_sample, and the order of the ColorJitter
+    operations is drawn per batch instead of per image (see color_transforms.py).
+    """
+
+    def __init__(self, image_size, scale=(0.2, 1.0), ratio=(3. / 4., 4. / 3.), jitter=(0.4, 0.4, 0.4, 0.1),
+                 jitter_p=0.8, grayscale_p=0.2, cutout_length=75, center=False):
+        self.image_size = image_size
+        self.scale = scale
+        self.ratio = ratio
+        self.brightness, self.contrast, self.saturation, self.hue = jitter
+        self.jitter_p = jitter_p
+        self.grayscale_p = grayscale_p
+        self.cutout_length = cutout_length
+        self.center = center
+
+    def _uniform(self, n, low, high, device):
+        return low + (high - low) * torch.rand(n, device=device)
+
+    def _resized_crop_flip(self, img):
+        b, _, h, w = img.shape
+        device = img.device
+
+        # as RandomResizedCrop.get_params: first of 10 attempts that fits, else the whole image
+        area = h * w
+        target_area = area * self._uniform((b, 10), self.scale[0], self.scale[1], device)
+        aspect = torch.exp(self._uniform((b, 10), np.log(self.ratio[0]), np.log(self.ratio[1]), device))
+        crop_w = torch.round(torch.sqrt(target_area * aspect))
+        crop_h = torch.round(torch.sqrt(target_area / aspect))
+        fits = (crop_w > 0) & (crop_w <= w) & (crop_h > 0) & (crop_h <= h)
+        first = torch.argmax(fits.int(), dim=1)
+        any_fits = fits.any(dim=1)
+        rows = torch.arange(b, device=device)
+        crop_w = torch.where(any_fits, crop_w[rows, first], torch.full_like(crop_w[:, 0], w))
+        crop_h = torch.where(any_fits, crop_h[rows, first], torch.full_like(crop_h[:, 0], h))
+        top = torch.floor(torch.rand(b, device=device) * (h - crop_h + 1))
+        left = torch.floor(torch.rand(b, device=device) * (w - crop_w + 1))
+
+        # affine map of the output grid to the crop, mirrored for flipped samples
+        flip = torch.where(torch.rand(b, device=device) < 0.5, -1., 1.)
+        theta = torch.zeros(b, 2, 3, device=device)
+        theta[:, 0, 0] = crop_w / w * flip
+        theta[:, 0, 2] = (2 * left + crop_w) / w - 1
+        theta[:, 1, 1] = crop_h / h
+        theta[:, 1, 2] = (2 * top + crop_h) / h - 1
+        grid = nn.functional.affine_grid(theta, (b, img.shape[1], self.image_size, self.image_size),
+                                         align_corners=False)
+        return nn.functional.grid_sample(img, grid, mode='bilinear', align_corners=False)
+
+    def _color_jitter(self, img):
+        jittered = color_jitter(img, self.brightness, self.contrast, self.saturation, self.hue)
+        apply = (torch.rand(img.shape[0], device=img.device) < self.jitter_p).view(-1, 1, 1, 1)
+        return torch.where(apply, jittered, img)
+
+    def _grayscale(self, img):
+        apply = (torch.rand(img.shape[0], device=img.device) < self.grayscale_p).view(-1, 1, 1, 1)
+        return torch.where(apply, rgb_to_grayscale(img).expand_as(img), img)
+
+    def _cutout(self, img):
+        b, _, h, w = img.shape
+        device = img.device
+        # as Cutout1 with one hole of random length
+        length = torch.randint(1, self.cutout_length + 1, (b, 1), device=device)
+        y = torch.randint(h, (b, 1), device=device)
+        x = torch.randint(w, (b, 1), device=device)
+        rows = torch.arange(h, device=device)
+        cols = torch.arange(w, device=device)
+        in_y = (rows >= (y - length // 2).clamp(0, h)) & (rows < (y + length // 2).clamp(0, h))
+        in_x = (cols >= (x - length // 2).clamp(0, w)) & (cols < (x + length // 2).clamp(0, w))
+        mask = ~(in_y[:, :, None] & in_x[:, None, :])
+        return img * mask[:, None].to(img.dtype)
+
+    def __call__(self, img):
+        img = self._resized_crop_flip(img)
+        img = self._color_jitter(img)
+        img = self._grayscale(img)
+        img = self._cutout(img)
+        if self.center:
+            # Center input
+            img = (img - 0.5) * 2
+        return img
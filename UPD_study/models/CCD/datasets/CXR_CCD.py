@@ -6,7 +6,8 @@ import torch
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision import transforms as T
-from augmentations import CutPerm, Cutout1, Cutout, Gaussian_noise, Rotation
+from augmentations import BatchSimCLRAugmentation, CutPerm, Cutout1, Cutout, Gaussian_noise, Rotation
+from UPD_study.utilities.utils import GenericDataloader
 import torchvision.transforms as transforms
 from UPD_study.data.dataloaders.CXR import get_files
 
@@ -44,37 +45,20 @@ class CCD_Dataset(Dataset):
                 img = (img - 0.5) * 2
             self.data.append(img)
 
-        self.data = torch.stack(self.data)
+        self.data = torch.stack(self.data)  # [samples,c,h,w]
 
-        # num of strong augm. versions for the augm. classification task
+        # num of strong augm. versions for the augm. classification task, with labels
+        # [0, 1, 2, 3]. Only the base images are stored, see __getitem__
         self.num_of_strong_aug_classes = 4
-
-        self.augdata = []
-        self.labels = []
-
-        # create strong augment. image tensors for classif. task
-        for i in range(self.data.shape[0]):
-
-            tmp = self.data[i].unsqueeze(0)
-            images = torch.cat([strong_aug(tmp, k)
-                               for k in range(self.num_of_strong_aug_classes)])  # [4,c,h,w]
-
-            # shift_labels = [0., 1., 2., 3.]
-            shift_labels = np.asarray([1. * k for k in range(self.num_of_strong_aug_classes)])
-
-            self.labels.append(shift_labels)
-            self.augdata.append(images)
-
-        self.data = torch.cat(self.augdata, axis=0)  # [samples*4,c,h,w]
-
-        # self.data = self.data.transpose((0, 2, 3, 1))
-        self.labels = np.concatenate(self.labels, axis=0)
+        self.strong_aug = strong_aug
 
     def __getitem__(self, idx):
 
-        img = self.data[idx]
-        label = self.labels[idx]
-        label = torch.as_tensor(label).long()
+        # item idx is strong augmentation k of base image idx // 4, i.e. the order of
+        # all augmented versions concatenated, but augmented on access
+        sample, k = divmod(idx, self.num_of_strong_aug_classes)
+        img = self.strong_aug(self.data[sample].unsqueeze(0), k)[0]
+        label = torch.as_tensor(k).long()
         if img.shape[0] == 1:
             img = img.repeat(3, 1, 1)
 
@@ -85,7 +69,7 @@ class CCD_Dataset(Dataset):
         return out
 
     def __len__(self):
-        return len(self.data)
+        return len(self.data) * self.num_of_strong_aug_classes
 
 
 class AugmentedDataset(Dataset):
@@ -131,11 +115,16 @@ def get_train_dataloader(config):
 
     dataset = CCD_Dataset(config, transform=transform)
 
-    dataset = AugmentedDataset(dataset, config)
+    if config.batch_augmentation:
+        # return the images unaugmented, both views are augmented batch-wise by the
+        # trainer, see get_batch_augmentation()
+        dataset.transform = None
+    else:
+        dataset = AugmentedDataset(dataset, config)
+
+    return GenericDataloader(dataset, config, drop_last=True)
+
 
-    return torch.utils.data.DataLoader(dataset,
-                                       num_workers=8,
-                                       batch_size=32,
-                                       pin_memory=True,
-                                       drop_last=True,
-                                       shuffle=True)
+def get_batch_augmentation(config):
+    # SimCLR transforms of get_train_dataloader, for whole batches
+    return BatchSimCLRAugmentation(config.image_size, scale=(0.1, 1.0), center=config.center)
@@ -36,13 +36,14 @@ from argparse import ArgumentParser
 import numpy as np
 from time import time
 import torch.nn.functional as F
-from scipy.ndimage import gaussian_filter
 import pathlib
 import os
 from model import load_decoder, load_encoder, positionalencoding2d, activation
 from torchinfo import summary
 from UPD_study.utilities.common_config import common_config
 from UPD_study.utilities.evaluate import evaluate
+from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                sample_max, sample_mean, shift_to_foreground_min)
 from UPD_study.utilities.utils import (seed_everything, load_data, load_pretrained,
                                        misc_settings, log)
 
@@ -326,35 +327,29 @@ def val_step(input, test_samples: bool = False):
     # and also have same scaling (instead of per batch sample anom_map.max() - anom_map)
     anomaly_map = 1 - anomaly_map.detach()
     if config.gaussian_blur:
-        anomaly_map = anomaly_map.cpu().numpy()
-        for i in range(anomaly_map.shape[0]):
-            anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)
-        anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
+        anomaly_map = gaussian_blur(anomaly_map, sigma=4)
 
     # apply brainmask for MRI
     if config.modality in ['MRI', 'MRInoram', 'CT']:
         # normalize brain pixels only
         input = input[:, 0].unsqueeze(1)
 
-        mask = torch.stack([inp > inp.min() for inp in input])
+        mask = foreground_mask(input)
         if config.get_images:
             anomaly_map *= mask
-            mins = [(map[map > map.min()]) for map in anomaly_map]
-            mins = [map.min() for map in mins]
-
-            anomaly_map = torch.cat([(map - min) for map, min in zip(anomaly_map, mins)]).unsqueeze(1)
+            anomaly_map = shift_to_foreground_min(anomaly_map)
         anomaly_map *= mask
 
         # mins = [(map[msk].min()) for map, msk in zip(anomaly_map, mask)]
         # anomaly_map = torch.cat([(map - min) for map, min in zip(anomaly_map, mins)]).unsqueeze(1)
         # anomaly_map *= mask
 
-        anomaly_score = torch.tensor([map[inp > inp.min()].max() for map, inp in zip(anomaly_map, input)])
+        anomaly_score = masked_max(anomaly_map, mask)
 
     elif config.modality == 'RF':
-        anomaly_score = torch.tensor([map.max() for map in anomaly_map])
+        anomaly_score = sample_max(anomaly_map)
     else:
-        anomaly_score = torch.tensor([map.mean() for map in anomaly_map])
+        anomaly_score = sample_mean(anomaly_map)
     return anomaly_map, anomaly_score
 
 
@@ -12,12 +12,14 @@ from UPD_study.models.CutPaste.CPmodel import CutPasteNet
 from torchinfo import summary
 from anomaly_detection import Detection
 from localization import Localization
+from cutpaste import BatchCutPaste
 from UPD_study.utilities.evaluate import evaluate
 from UPD_study.utilities.common_config import common_config
 from UPD_study.utilities.utils import (test_inference_speed, save_model, seed_everything,
                                        load_data, load_pretrained,
                                        misc_settings, load_model,
                                        str_to_bool, log)
+from UPD_study.utilities.postprocessing import foreground_mask, shift_to_foreground_min
 
 """"""""""""""""""""""""""""""""""" Config """""""""""""""""""""""""""""""""""
 
@@ -40,6 +42,8 @@ def get_config():
     parser.add_argument('--batch_size', default=32, type=int)
     parser.add_argument('--localization', '-loc', default=True, type=str_to_bool,
                         help='If True train on (32,32) cropped patches and evaluate localization performance')
+    parser.add_argument('--batch_cutpaste', default=False, type=str_to_bool,
+                        help='Apply CutPaste to whole batches on device, instead of per image with PIL')
     return parser.parse_args()
 
 
@@ -61,7 +65,9 @@ if config.localization:
 seed_everything(42)
 
 # use the actual, unaugmented train_loader to fit the GDE
-# Covariance calculation cannot handle more than about 20% of CamCAN samples in our machine
+# Covariance calculation cannot handle more than about 20% of CamCAN samples in our machine.
+# The limit is the patch embeddings of all training samples held for the GDE fit, not the
+# slices, so it holds with --slice_store too
 if config.modality == 'MRI' and config.localization:
     temp = config.normal_split
     config.normal_split = 0.18
@@ -85,6 +91,9 @@ if not config.eval:
     # use the augmented train_loader for the actual training
     cutpaste_train_loader, cutpaste_val_loader = cutpaste_loader(config)
 
+    if config.batch_cutpaste:
+        batch_cutpaste = BatchCutPaste(type=config.cutpaste_type, center=config.center)
+
 """"""""""""""""""""""""""""""""" Init model """""""""""""""""""""""""""""""""
 # Reproducibility
 seed_everything(config.seed)
@@ -174,12 +183,10 @@ def eval_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
         anomaly_map = localization.anomaly_map(input)
         # for MRI apply brainmask
         if config.modality == 'MRI':
-            mask = torch.stack([inp[0].unsqueeze(0) > inp[0].min() for inp in input])
+            mask = foreground_mask(input, first_channel=True)
             if config.get_images:
                 anomaly_map *= mask
-                mins = [(map[map > map.min()]) for map in anomaly_map]
-                mins = [map.min() for map in mins]
-                anomaly_map = torch.cat([(map - min) for map, min in zip(anomaly_map, mins)]).unsqueeze(1)
+                anomaly_map = shift_to_foreground_min(anomaly_map)
             anomaly_map *= mask
         anomaly_score = None
     else:
@@ -199,6 +206,8 @@ def validate() -> None:
     for input in cutpaste_val_loader:
 
         i_val_step += 1
+        if config.batch_cutpaste:
+            input = batch_cutpaste(input.to(config.device))
         loss = val_step(input)
         val_losses.append(loss.item())
 
@@ -236,6 +245,8 @@ def train() -> None:
         for input in cutpaste_train_loader:
 
             config.step += 1
+            if config.batch_cutpaste:
+                input = batch_cutpaste(input.to(config.device))
 
             # Train step
             loss = train_step(input)
@@ -4,7 +4,9 @@ https://github.com/LilitYolyan/CutPaste
 
 import random
 import numpy as np
+import torch
 from torchvision import transforms
+from UPD_study.utilities.color_transforms import color_jitter
 
 
 class CutPaste(object):
@@ -109,3 +111,147 @@ class CutPaste(object):
             cutpaste = self.cutpaste(image)
             scar = self.cutpaste_scar(image)
             return image, cutpaste, scar
+
+
+class BatchCutPaste(object):
+
+    def __init__(self, transform=True, type='binary', center=False):
+        '''
+        Tensor version of CutPaste, that creates the CutPaste and CutPaste-Scar variants of
+        a whole batch of [B, 3, H, W] images in [0, 1] at once, on their device, with random
+        patches, jitter and rotation per sample. Patches are pasted with nearest-neighbour
+        sampling of a rotated grid, like the RGBA rotation and alpha-mask paste of PIL.
+
+        :arg
+        :transform[binary]: - if True use Color Jitter augmentations for patches
+        :type[str]: options ['binary' or '3way'] - classification type
+        :center[binary]: - if True center the returned images to [-1, 1]
+        '''
+        self.type = type
+        self.transform = transform
+        self.center = center
+
+    def crop_and_paste_patch(self, images, patch_w, patch_h, rotation=None):
+        """
+        Crop a patch from every image and paste it randomly on the same image.
+
+        :images: [Tensor] _ original images of shape [B, 3, H, W]
+        :patch_w: [Tensor] _ width of the patch of every image
+        :patch_h: [Tensor] _ height of the patch of every image
+        :rotation: [Tensor] _ Optional. Rotation of the patch of every image, in degrees
+
+        :return: augmented images
+        """
+        b, c, org_h, org_w = images.shape
+        device = images.device
+        patch_w, patch_h = patch_w.float(), patch_h.float()
+
+        def randint(high):
+            # per sample integer in [0, high]
+            return torch.floor(torch.rand(b, device=device) * (high + 1))
+
+        patch_left, patch_top = randint(org_w - patch_w), randint(org_h - patch_h)
+        paste_left, paste_top = randint(org_w - patch_w), randint(org_h - patch_h)
+
+        ys = torch.arange(org_h, device=device).view(1, -1, 1).float()
+        xs = torch.arange(org_w, device=device).view(1, 1, -1).float()
+
+        def view(t):
+            return t.view(-1, 1, 1)
+
+        if self.transform:
+            in_patch = (ys >= view(patch_top)) & (ys < view(patch_top + patch_h)) & \
+                (xs >= view(patch_left)) & (xs < view(patch_left + patch_w))
+            source = color_jitter(images, 0.1, 0.1, 0.1, 0.1, region=in_patch.unsqueeze(1))
+        else:
+            source = images
+
+        # inverse rotation of PIL's Image.rotate(angle, expand=True), with the size of the
+        # expanded patch from its rotated corners
+        angle = torch.zeros(b, device=device) if rotation is None else rotation
+        theta = -torch.deg2rad(angle)
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        if rotation is None:
+            new_w, new_h = patch_w, patch_h
+        else:
+            corners_x = torch.stack([-patch_w, patch_w, patch_w, -patch_w], 1) / 2
+            corners_y = torch.stack([-patch_h, -patch_h, patch_h, patch_h], 1) / 2
+            rotated_x = cos[:, None] * corners_x + sin[:, None] * corners_y + patch_w[:, None] / 2
+            rotated_y = -sin[:, None] * corners_x + cos[:, None] * corners_y + patch_h[:, None] / 2
+            new_w = torch.ceil(rotated_x.max(1).values) - torch.floor(rotated_x.min(1).values)
+            new_h = torch.ceil(rotated_y.max(1).values) - torch.floor(rotated_y.min(1).values)
+
+        # position of every pixel relative to the center of the pasted (expanded) patch
+        u = xs + 0.5 - view(paste_left) - view(new_w) / 2
+        v = ys + 0.5 - view(paste_top) - view(new_h) / 2
+        src_x = torch.floor(view(cos) * u + view(sin) * v + view(patch_w) / 2)
+        src_y = torch.floor(-view(sin) * u + view(cos) * v + view(patch_h) / 2)
+
+        pasted = (u >= -view(new_w) / 2) & (u < view(new_w) / 2) & \
+            (v >= -view(new_h) / 2) & (v < view(new_h) / 2) & \
+            (src_x >= 0) & (src_x < view(patch_w)) & (src_y >= 0) & (src_y < view(patch_h))
+
+        src_x = (src_x + view(patch_left)).clamp(0, org_w - 1).long()
+        src_y = (src_y + view(patch_top)).clamp(0, org_h - 1).long()
+        index = (src_y * org_w + src_x).view(b, 1, -1).expand(-1, c, -1)
+        patches = source.flatten(2).gather(2, index).view(b, c, org_h, org_w)
+        return torch.where(pasted.unsqueeze(1), patches, images)
+
+    def cutpaste(self, images, area_ratio=(0.02, 0.15), aspect_ratio=((0.3, 1), (1, 3.3))):
+        '''
+        CutPaste augmentation
+
+        :images: [Tensor] - original images
+        :area_ratio: [tuple] - range for area ratio for patch
+        :aspect_ratio: [tuple] -  range for aspect ratio
+
+        :return: images after CutPaste transformation
+        '''
+        b, _, h, w = images.shape
+        device = images.device
+
+        def uniform(low, high):
+            return low + (high - low) * torch.rand(b, device=device)
+
+        patch_area = uniform(*area_ratio) * h * w
+        patch_aspect = torch.where(torch.rand(b, device=device) < 0.5,
+                                   uniform(*aspect_ratio[0]), uniform(*aspect_ratio[1]))
+        patch_w = torch.floor(torch.sqrt(patch_area * patch_aspect))
+        patch_h = torch.floor(torch.sqrt(patch_area / patch_aspect))
+        return self.crop_and_paste_patch(images, patch_w, patch_h)
+
+    def cutpaste_scar(self, images, width=[1, 8], length=[5, 13], rotation=(-45, 45)):
+        '''
+
+        :images: [Tensor] - original images
+        :width: [list] - range for width of patch
+        :length: [list] - range for length of patch
+        :rotation: [tuple] - range for rotation
+
+        :return: images after CutPaste-Scar transformation
+        '''
+        b = images.shape[0]
+        device = images.device
+        patch_w = torch.randint(width[0], width[1] + 1, (b,), device=device)
+        patch_h = torch.randint(length[0], length[1] + 1, (b,), device=device)
+        angle = rotation[0] + (rotation[1] - rotation[0]) * torch.rand(b, device=device)
+        return self.crop_and_paste_patch(images, patch_w, patch_h, rotation=angle)
+
+    def __call__(self, images):
+        '''
+
+        :images: [Tensor] - original images
+        :return: if type == 'binary' returns original images and images with a randomly chosen
+                transformation each, else it returns original images, images after CutPaste
+                transformation and images after CutPaste-Scar transformation
+        '''
+        if self.type == 'binary':
+            choice = (torch.rand(images.shape[0], device=images.device) < 0.5).view(-1, 1, 1, 1)
+            out = [images, torch.where(choice, self.cutpaste(images), self.cutpaste_scar(images))]
+
+        elif self.type == '3way':
+            out = [images, self.cutpaste(images), self.cutpaste_scar(images)]
+
+        if self.center:
+            out = [(i - 0.5) * 2 for i in out]
+        return out
@@ -7,6 +7,7 @@ import numpy as np
 from torch import Tensor
 from argparse import Namespace
 from UPD_study.utilities.utils import GenericDataloader
+from UPD_study.data.dataloaders.image_shards import get_shard
 from glob import glob
 import torch
 from cutpaste import CutPaste
@@ -80,7 +81,10 @@ class Cutpaste_Dataset(Dataset):
 
         self.center = config.center
         self.files = files
+        self.shard = get_shard(files, config)
         self.cutpaste_transform = CutPaste(type=config.cutpaste_type)
+        # with batch_cutpaste, return the cropped image, CutPaste is applied batch-wise by the trainer
+        self.batch_cutpaste = 'batch_cutpaste' in config and config.batch_cutpaste
         self.crop_size = (32, 32) if config.localization else (config.image_size, config.image_size)
 
         self.transforms = T.Compose([
@@ -89,6 +93,9 @@ class Cutpaste_Dataset(Dataset):
             T.RandomCrop(self.crop_size)
         ])
 
+        # shard images are already resized and center cropped
+        self.shard_transforms = T.RandomCrop(self.crop_size)
+
         self.to_tensor = T.ToTensor()
 
     def __len__(self):
@@ -102,8 +109,14 @@ class Cutpaste_Dataset(Dataset):
             image: image tensor of size []
         """
 
-        image = Image.open(self.files[idx]).convert('RGB')
-        image = self.transforms(image)
+        if self.shard is not None:
+            image = Image.fromarray(self.shard.array(self.files[idx])).convert('RGB')
+            image = self.shard_transforms(image)
+        else:
+            image = Image.open(self.files[idx]).convert('RGB')
+            image = self.transforms(image)
+        if self.batch_cutpaste:
+            return self.to_tensor(image)
         image = self.cutpaste_transform(image)
         image = [self.to_tensor(i) for i in image]
 
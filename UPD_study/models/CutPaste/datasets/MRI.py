@@ -3,6 +3,7 @@ from torch.utils.data import Dataset
 import numpy as np
 from torch.utils.data import DataLoader
 from UPD_study.data.dataloaders.mri_preprocessing import get_camcan_slices
+from UPD_study.data.dataloaders.storage import to_float32
 from UPD_study.utilities.utils import GenericDataloader
 from torch import Tensor
 from argparse import Namespace
@@ -16,16 +17,24 @@ class Cutpaste_Dataset(Dataset):
     Dataset class for CamCAN Dataset.
     """
 
-    def __init__(self, files: np.ndarray, config: Namespace):
+    def __init__(self, files: np.ndarray, config: Namespace, indices: np.ndarray = None,
+                 scales: np.ndarray = None):
         """
         Args:
             files(nd.array): array of MRI slices with shape [slices,1,H,W]
             config(Namespace): config object
+            indices(np.ndarray): Optional. Indices of the slices of files that belong to the dataset
+            scales(np.ndarray): Optional. Scale of the stored values of every slice of files,
+                                for reduced-precision storage (see storage.py)
         """
 
         self.files = files
+        self.indices = indices if indices is not None else np.arange(len(files))
+        self.scales = scales if scales is not None else np.ones(len(files), dtype=np.float32)
         self.center = config.center
         self.cutpaste_transform = CutPaste(type=config.cutpaste_type)
+        # with batch_cutpaste, return the cropped image, CutPaste is applied batch-wise by the trainer
+        self.batch_cutpaste = 'batch_cutpaste' in config and config.batch_cutpaste
 
         self.crop_size = (32, 32) if config.localization else (config.image_size, config.image_size)
         self.crop = T.RandomCrop(self.crop_size)
@@ -34,16 +43,19 @@ class Cutpaste_Dataset(Dataset):
         ])
 
     def __len__(self):
-        return len(self.files)
+        return len(self.indices)
 
     def __getitem__(self, idx) -> Tensor:
-        img = self.files[idx]
+        idx = self.indices[idx]
+        img = to_float32(self.files[idx], self.scales[idx])
         # slices are returned by get_camcan_slices in 1xhxw numpy format and [0,1] range
         # need to repeat, permute and convert to PIL to apply cutpaste transformations
         img = np.tile(img, (3, 1, 1))
         img = img.transpose(1, 2, 0) * 255
         img = Image.fromarray(img.astype(np.uint8)).convert('RGB')
         img_cropped = self.crop(img)
+        if self.batch_cutpaste:
+            return self.transforms(img_cropped)
         cutpaste_list = self.cutpaste_transform(img_cropped)
         cutpaste_list = [self.transforms(i) for i in cutpaste_list]
 
@@ -67,20 +79,21 @@ def cutpaste_loader(config: Namespace) -> Tuple[DataLoader, DataLoader]:
     """
 
     config.return_volumes = False
+    config.return_stats = True
 
-    # get array of slices
-    slices = get_camcan_slices(config)
+    # get array of slices and their statistics
+    slices, stats = get_camcan_slices(config)
 
     # keep slices with brain pixels in them
-    slices = slices[np.sum(slices, axis=(1, 2, 3)) > 0]
+    brain_idx = stats.foreground_idx()
 
     # calculate dataset split index
-    split_idx = int(len(slices) * config.normal_split)
+    split_idx = int(len(brain_idx) * config.normal_split)
 
-    cutpaste_trainset = Cutpaste_Dataset(slices[:split_idx], config)
+    cutpaste_trainset = Cutpaste_Dataset(slices, config, brain_idx[:split_idx], stats.scale)
     cutpaste_trainloader = GenericDataloader(cutpaste_trainset, config)
 
-    cutpaste_valset = Cutpaste_Dataset(slices[split_idx:], config)
+    cutpaste_valset = Cutpaste_Dataset(slices, config, brain_idx[split_idx:], stats.scale)
     cutpaste_valloader = GenericDataloader(cutpaste_valset, config)
 
     return cutpaste_trainloader, cutpaste_valloader
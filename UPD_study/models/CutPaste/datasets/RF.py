@@ -7,8 +7,7 @@ from torch import Tensor
 from argparse import Namespace
 from UPD_study.utilities.utils import GenericDataloader
 from glob import glob
-from multiprocessing import Pool, cpu_count
-from functools import partial
+from UPD_study.data.dataloaders.image_shards import preload_images
 from cutpaste import CutPaste
 
 
@@ -47,23 +46,23 @@ class Cutpaste_Dataset(Dataset):
         self.files = files
         self.center = config.center
         self.cutpaste_transform = CutPaste(type=config.cutpaste_type)
+        # with batch_cutpaste, return the cropped image, CutPaste is applied batch-wise by the trainer
+        self.batch_cutpaste = 'batch_cutpaste' in config and config.batch_cutpaste
         self.crop_size = (32, 32) if config.localization else (config.image_size, config.image_size)
 
-        self.transforms = T.Compose([
-            T.Resize((config.image_size, config.image_size), T.InterpolationMode.LANCZOS),
-            T.CenterCrop(config.image_size),
-            T.RandomCrop(self.crop_size)
-        ])
+        self.transforms = T.RandomCrop(self.crop_size)
 
         self.to_tensor = T.ToTensor()
 
-        with Pool(cpu_count()) as pool:
-            self.preload = pool.map(partial(self.load_file), files)
+        # resized images are decoded once into a memory-mapped shard, shared by all workers
+        self.shard = preload_images(files, config, 'train')
 
     def load_file(self, file):
 
-        image = Image.open(file)
+        image = Image.fromarray(self.shard.array(file))
         image = self.transforms(image)
+        if self.batch_cutpaste:
+            return self.to_tensor(image)
         image = self.cutpaste_transform(image)
         image = [self.to_tensor(i) for i in image]
         # Center inputs
@@ -83,7 +82,7 @@ class Cutpaste_Dataset(Dataset):
             image: image tensor of size []
         """
 
-        return self.preload[idx]
+        return self.load_file(self.files[idx])
 
 
 def cutpaste_loader(config: Namespace) -> Tuple[DataLoader, DataLoader]:
@@ -11,7 +11,6 @@ from time import time
 from torch import Tensor
 from typing import Tuple
 from unet import UNet
-from scipy.ndimage import gaussian_filter
 from torchinfo import summary
 import pathlib
 from UPD_study.utilities.common_config import common_config
@@ -21,6 +20,9 @@ from UPD_study.utilities.utils import (save_model, seed_everything,
                                        load_model, test_inference_speed,
                                        log, str_to_bool)
 from UPD_study.utilities.evaluate import evaluate
+from UPD_study.utilities.anomaly_cache import CacheSteps, cached_outputs
+from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                sample_max, sample_mean)
 """"""""""""""""""""""""""""""""""" Config """""""""""""""""""""""""""""""""""
 
 
@@ -49,6 +51,9 @@ config.method = 'DAE'
 config.model_dir_path = pathlib.Path(__file__).parents[0]
 misc_settings(config)
 
+# rescoring cached outputs needs neither the test set nor the saved model
+config.cached_outputs = cached_outputs(config)
+
 """"""""""""""""""""""""""""""""" Load data """""""""""""""""""""""""""""""""
 
 # specific seed for deterministic dataloader creation
@@ -75,7 +80,7 @@ optimizer = torch.optim.Adam(model.parameters(), lr=config.lr, amsgrad=True,
 lr_scheduler = CosineAnnealingLR(optimizer=optimizer, T_max=100)
 
 # Load saved model to evaluate
-if config.eval:
+if config.eval and not config.cached_outputs:
     model.load_state_dict(load_model(config))
     print('Saved model loaded.')
 
@@ -110,7 +115,7 @@ def add_noise(input):
 
     # Use foreground mask for MRI, to only apply noise in the foreground.
     if config.modality == 'MRI':
-        mask = torch.cat([inp > inp.min() for inp in input]).unsqueeze(1)
+        mask = foreground_mask(input)
         ns *= mask
     if config.center:
         ns = (ns - 0.5) * 2
@@ -133,45 +138,51 @@ def train_step(input, noisy_input) -> Tuple[float, Tensor, Tensor]:
     return loss.item()
 
 
-def anom_val_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
+def anom_inference_step(input) -> Tensor:
     """
-    Evaluation step.
+    Reconstruction of the input, the raw output of the model on evaluation samples.
     """
     model.eval()
     with torch.no_grad():
         # forward pass
-        input_recon = model(input)
+        return model(input)
 
+
+def anom_postprocess_step(input, input_recon) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Anomaly maps and anomaly scores of the input from its reconstruction.
+    """
     # Anomaly map
     if config.ssim_eval:
         anomaly_map = ssim_map(input_recon, input)
         if config.gaussian_blur:
-            anomaly_map = anomaly_map.cpu().numpy()
-            for i in range(anomaly_map.shape[0]):
-                anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=config.sigma)
-            anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
+            anomaly_map = gaussian_blur(anomaly_map, sigma=config.sigma)
     else:
         anomaly_map = (input - input_recon).abs().mean(1, keepdim=True)
         if config.gaussian_blur:
-            anomaly_map = anomaly_map.cpu().numpy()
-            for i in range(anomaly_map.shape[0]):
-                anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=config.sigma)
-            anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
+            anomaly_map = gaussian_blur(anomaly_map, sigma=config.sigma)
 
     # for MRI, RF apply brainmask
     if config.modality == 'MRI':
-        mask = torch.stack([inp > inp.min() for inp in input])
+        mask = foreground_mask(input)
         anomaly_map *= mask
-        anomaly_score = torch.tensor([map[inp > inp.min()].max() for map, inp in zip(anomaly_map, input)])
+        anomaly_score = masked_max(anomaly_map, mask)
 
     elif config.modality == 'RF':
-        anomaly_score = torch.tensor([map.max() for map in anomaly_map])
+        anomaly_score = sample_max(anomaly_map)
     else:
-        anomaly_score = torch.tensor([map.mean() for map in anomaly_map])
+        anomaly_score = sample_mean(anomaly_map)
 
     return anomaly_map, anomaly_score, input_recon
 
 
+def anom_val_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
+    """
+    Evaluation step.
+    """
+    return anom_postprocess_step(input, anom_inference_step(input))
+
+
 def train():
     """
     Main training logic
@@ -220,7 +231,8 @@ if __name__ == '__main__':
         exit(0)
     if config.eval:
         print('Evaluating model...')
-        evaluate(config, big_testloader, anom_val_step)
+        evaluate(config, big_testloader, anom_val_step,
+                 CacheSteps(anom_inference_step, anom_postprocess_step))
 
     else:
         train()
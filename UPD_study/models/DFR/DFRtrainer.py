@@ -10,15 +10,17 @@ from torch import Tensor
 from torch.nn import functional as F
 from dfr_utils import estimate_latent_channels
 import torch.nn as nn
-from scipy.ndimage import gaussian_filter
 from DFRmodel import Extractor, FeatureAE, _set_requires_grad_false
 from UPD_study.utilities.common_config import common_config
 import pathlib
 from UPD_study.utilities.evaluate import evaluate
+from UPD_study.utilities.anomaly_cache import CacheSteps, cached_outputs
 from UPD_study.utilities.utils import (save_model, seed_everything,
                                        load_data, load_pretrained,
                                        misc_settings, ssim_map,
                                        load_model, log)
+from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                sample_max, sample_mean, shift_to_foreground_min)
 
 """"""""""""""""""""""""""""""""""" Config """""""""""""""""""""""""""""""""""
 
@@ -53,6 +55,14 @@ config.method = 'DFR'
 config.model_dir_path = pathlib.Path(__file__).parents[0]
 misc_settings(config)
 
+if config.image_size == 256:
+    config.stride = 4
+
+# config attributes other than the checkpoint that change the raw anomaly maps
+inference_keys = ['arch', 'start_layer', 'last_layer', 'stride']
+# rescoring cached outputs needs neither the test set nor the saved model
+config.cached_outputs = cached_outputs(config, inference_keys)
+
 """"""""""""""""""""""""""""""""" Load data """""""""""""""""""""""""""""""""
 
 # specific seed for creating the dataloader
@@ -65,9 +75,6 @@ train_loader, val_loader, big_testloader, small_testloader = load_data(config)
 # Reproducibility
 seed_everything(config.seed)
 
-if config.image_size == 256:
-    config.stride = 4
-
 
 if config.modality == 'CXR':
     config.latent_channels = 474
@@ -115,7 +122,7 @@ optimizer = torch.optim.Adam(model.parameters(),
                              lr=config.lr, weight_decay=config.weight_decay)
 
 # Load saved model to evaluate
-if config.eval:
+if config.eval and not config.cached_outputs:
     model.load_state_dict(load_model(config))
     print('Saved model loaded.')
 
@@ -142,6 +149,50 @@ def train_step(input) -> Tuple[float, Tensor]:
     return loss.item(), rec
 
 
+def get_anomaly_map(input, anom_map_small) -> Tuple[Tensor, Tensor]:
+    """
+    Anomaly maps of the input size and anomaly scores from anomaly maps at the resolution of the features.
+    """
+    anomaly_map = F.interpolate(anom_map_small, input.shape[-2:], mode='bilinear', align_corners=True)
+    if config.gaussian_blur:
+        anomaly_map = gaussian_blur(anomaly_map, sigma=config.sigma)
+
+    if config.modality == 'MRI':
+        mask = foreground_mask(input)
+        if config.get_images:
+            anomaly_map *= mask
+            anomaly_map = shift_to_foreground_min(anomaly_map)
+        anomaly_map *= mask
+
+        anomaly_score = masked_max(anomaly_map, mask)
+
+    elif config.modality == 'RF':
+        anomaly_score = sample_max(anomaly_map)
+    else:
+        anomaly_score = sample_mean(anomaly_map)
+
+    return anomaly_map, anomaly_score
+
+
+def inference_step(input) -> Tensor:
+    """
+    Squared error and SSIM maps between the features of the input and their reconstruction,
+    the raw output of the model on evaluation samples. Both are kept, in a tensor of shape
+    [b,2,h,w] at the resolution of the features, so that --ssim_eval can change when rescoring.
+    """
+    model.eval()
+    with torch.no_grad():
+        feats, rec = model(input)
+        return torch.cat([torch.mean((feats - rec) ** 2, dim=1, keepdim=True), ssim_map(feats, rec)], dim=1)
+
+
+def postprocess_step(input, maps_small) -> Tuple[Tensor, Tensor]:
+    """
+    Anomaly maps and anomaly scores of the input from the outputs of inference_step.
+    """
+    return get_anomaly_map(input, maps_small[:, 1:] if config.ssim_eval else maps_small[:, :1])
+
+
 def val_step(input, test_samples: bool = False) -> Tuple[float, Tensor, Tensor]:
     """
     Validation step on validation or evaluation (test samples == True) validation set.
@@ -157,38 +208,9 @@ def val_step(input, test_samples: bool = False) -> Tuple[float, Tensor, Tensor]:
         loss = map_small.mean()
 
         if config.ssim_eval:
-            anom_map_small = ssim_map(feats, rec)
-            anomaly_map = F.interpolate(anom_map_small, input.shape[-2:], mode='bilinear', align_corners=True)
-
-            if config.gaussian_blur:
-                anomaly_map = anomaly_map.cpu().numpy()
-                for i in range(anomaly_map.shape[0]):
-                    anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)
-                anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
-
+            anomaly_map, anomaly_score = get_anomaly_map(input, ssim_map(feats, rec))
         else:
-            anomaly_map = F.interpolate(map_small, input.shape[-2:], mode='bilinear', align_corners=True)
-            if config.gaussian_blur:
-                anomaly_map = anomaly_map.cpu().numpy()
-                for i in range(anomaly_map.shape[0]):
-                    anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)
-                anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
-
-    if config.modality == 'MRI':
-        mask = torch.stack([inp > inp.min() for inp in input])
-        if config.get_images:
-            anomaly_map *= mask
-            mins = [(map[map > map.min()]) for map in anomaly_map]
-            mins = [map.min() for map in mins]
-            anomaly_map = torch.cat([(map - min) for map, min in zip(anomaly_map, mins)]).unsqueeze(1)
-        anomaly_map *= mask
-
-        anomaly_score = torch.tensor([map[inp > inp.min()].max() for map, inp in zip(anomaly_map, input)])
-
-    elif config.modality == 'RF':
-        anomaly_score = torch.tensor([map.max() for map in anomaly_map])
-    else:
-        anomaly_score = torch.tensor([map.mean() for map in anomaly_map])
+            anomaly_map, anomaly_score = get_anomaly_map(input, map_small)
 
     if test_samples:
         return anomaly_map, anomaly_score
@@ -279,7 +301,8 @@ if __name__ == '__main__':
 
     if config.eval:
         print('Evaluating model...')
-        evaluate(config, big_testloader, val_step)
+        evaluate(config, big_testloader, val_step,
+                 CacheSteps(inference_step, postprocess_step, inference_keys))
 
     else:
         train()
@@ -14,6 +14,7 @@ from UPD_study.utilities.utils import (save_model, test_inference_speed, seed_ev
                                        load_data, load_pretrained,
                                        misc_settings, log, load_model)
 from UPD_study.utilities.evaluate import evaluate
+from UPD_study.utilities.postprocessing import foreground_mask, masked_max, sample_max, sample_mean
 from typing import Tuple
 import pathlib
 
@@ -118,15 +119,15 @@ def val_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
 
     # for MRI apply brainmask
     if config.modality == 'MRI':
-        mask = torch.stack([inp > inp.min() for inp in input])
+        mask = foreground_mask(input)
         anomaly_map *= mask
-        anomaly_score = torch.tensor([map[inp > inp.min()].max() for map, inp in zip(anomaly_map, input)])
+        anomaly_score = masked_max(anomaly_map, mask)
 
     elif config.modality == 'RF':
-        anomaly_score = torch.tensor([map.max() for map in anomaly_map])
+        anomaly_score = sample_max(anomaly_map)
 
     elif config.modality == 'CXR':
-        anomaly_score = torch.tensor([map.mean() for map in anomaly_map])
+        anomaly_score = sample_mean(anomaly_map)
 
     if test_samples:
         return anomaly_map, anomaly_score
@@ -8,14 +8,16 @@ import pickle
 from tqdm import tqdm
 from collections import OrderedDict
 from scipy.spatial.distance import mahalanobis
-from scipy.ndimage import gaussian_filter
 import torch
 import torch.nn.functional as F
 from resnet import wide_resnet50_2, resnet18
 from UPD_study.utilities.common_config import common_config
+from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                sample_max, sample_mean)
 from UPD_study.utilities.utils import (seed_everything,
                                        load_data, load_pretrained,
-                                       misc_settings, log, metrics)
+                                       misc_settings, log, metrics, to_uint8_mask,
+                                       target_labels)
 import pathlib
 import os
 """"""""""""""""""""""""""""""""""" Config """""""""""""""""""""""""""""""""""
@@ -40,7 +42,9 @@ config.disable_wandb = True
 misc_settings(config)
 
 """"""""""""""""""""""""""""""""" Load data """""""""""""""""""""""""""""""""
-# PaDiM cannot handle more than 18% of CamCAN samples in our machine
+# PaDiM cannot handle more than 18% of CamCAN samples in our machine.
+# The limit is the embedding vectors of all training samples held for the covariance
+# estimation, several times larger than the slices, so it holds with --slice_store too
 if config.modality == 'MRI' and not config.eval:
     config.normal_split = 0.18
 
@@ -201,12 +205,13 @@ def test(dataloader):
     for batch in tqdm(dataloader, '| feature extraction | test | %s' % config.modality):
 
         input = batch[0]
-        mask = batch[1]
+        target = batch[1]
 
         inputs.append(input)
-        label = torch.where(mask.sum(dim=(1, 2, 3)) > 0, 1, 0)
-        labels.append(label)
-        segmentations.append(mask)
+        labels.append(target_labels(target))
+        # image-level datasets (CXR) yield labels instead of segmentations
+        if target.dim() > 1:
+            segmentations.append(to_uint8_mask(target))
 
         # if grayscale repeat channel dim
         if input.shape[1] == 1:
@@ -259,11 +264,11 @@ def test(dataloader):
         # upsample anoamaly maps
         dist_list = torch.tensor(dist_list)
         anomaly_map = F.interpolate(dist_list.unsqueeze(1), size=input.size(2), mode='bilinear',
-                                    align_corners=False).squeeze().numpy()
+                                    align_corners=False)
         # apply gaussian smoothing on the score map
         if config.gaussian_blur:
-            for i in range(anomaly_map.shape[0]):
-                anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)  # [samples, h , w]
+            anomaly_map = gaussian_blur(anomaly_map, sigma=4)
+        anomaly_map = anomaly_map.squeeze().numpy()  # [samples, h , w]
 
         # prevent a bug for when a single sample batch occures and anomaly_map
         # loses its batch dim somewhere above
@@ -279,29 +284,25 @@ def test(dataloader):
     c.remove()
 
     # Some hacky stuff to get it compatible with function metrics()
-    anomaly_maps = torch.from_numpy(anomaly_maps)
-    s, h, w = anomaly_maps.shape
-    anomaly_maps = anomaly_maps.reshape(s, 1, 1, h, w)
-    anomaly_maps = [map for map in anomaly_maps]
+    anomaly_maps = torch.from_numpy(anomaly_maps).unsqueeze(1)  # tensor of shape num_samples,1,h,w
     inputs2 = torch.cat(inputs)  # tensor of shape num_samples,c,h,w
-    if config.modality == 'RF':  # RGB case
-        inputs2 = inputs2.reshape(s, 1, 3, h, w)
-    else:
-        inputs2 = inputs2.reshape(s, 1, 1, h, w)
-    inputs2 = [inp for inp in inputs2]
-    #
 
     # apply brainmask for MRI
     if config.modality == 'MRI':
-        masks = [inp > inp.min() for inp in inputs2]
-        anomaly_maps = [map * mask for map, mask in zip(anomaly_maps, masks)]
-        anomaly_scores = [torch.Tensor([map[inp > inp.min()].max()
-                                        for map, inp in zip(anomaly_maps, inputs2)])]
+        mask = foreground_mask(inputs2)
+        anomaly_maps = anomaly_maps * mask
+        anomaly_scores = [masked_max(anomaly_maps, mask).float()]
 
     elif config.modality == 'RF':
-        anomaly_scores = [torch.Tensor([map.max() for map in anomaly_maps])]
+        anomaly_scores = [sample_max(anomaly_maps).float()]
     else:
-        anomaly_scores = [torch.tensor([map.mean() for map in anomaly_maps])]
+        anomaly_scores = [sample_mean(anomaly_maps)]
+
+    # list of maps of shape 1,1,h,w, compatible with function metrics()
+    anomaly_maps = [map for map in anomaly_maps.unsqueeze(1)]
+
+    if not segmentations:
+        segmentations = None
 
     return inputs, segmentations, labels, anomaly_maps, anomaly_scores
 
@@ -316,9 +317,10 @@ def evaluation(inputs, segmentations, labels, anomaly_maps, anomaly_scores):
     anomaly_maps = torch.cat(anomaly_maps)[:config.num_images_log]
 
     log({'anom_val/input images': inputs[0],
-         'anom_val/anomaly maps': anomaly_maps,
-         'anom_val/segmentations': segmentations[0]
+         'anom_val/anomaly maps': anomaly_maps
          }, config)
+    if segmentations is not None:
+        log({'anom_val/segmentations': segmentations[0]}, config)
 
 
 def test_inference_speed(inference_fn: Callable,
@@ -0,0 +1,208 @@
+"""
+Offline bank of synthetic PII anomalies.
+
+Instead of blending a new anomaly on the DataLoader critical path for every sample, a bank
+holds bank_size pre-generated (image, mask) pairs per source image of a PII NormalDataset.
+Pair k of source image i is generated by dataset.generate(i) after seeding numpy with
+seed + i * bank_size + k, so every pair can be reproduced from the manifest. The pairs are
+written with a process pool to memory-mapped .npy shards of shard_size pairs, and the
+manifest is written last, so its existence marks a complete bank.
+
+Banks are looked up by a fingerprint of the source images of the dataset, and datasets
+sample from their bank when --pii_bank is set and one was generated, mixed with online
+generation with probability 1 - pii_bank_fraction. To generate the banks of the train and
+validation sets of a configuration, run:
+
+    python UPD_study/models/PII/anomaly_bank.py -mod MRI --sequence t2 --bank_size 8
+"""
+import os
+import json
+import hashlib
+from argparse import ArgumentParser, Namespace
+from multiprocessing import cpu_count, get_context
+from typing import Optional, Tuple
+import numpy as np
+from torch.utils.data import Dataset
+from UPD_study import ROOT
+
+# dataset of the generating worker processes, inherited when they are forked
+_dataset = None
+
+
+def _init_worker(dataset: Dataset) -> None:
+    global _dataset
+    _dataset = dataset
+
+
+def _generate_chunk(args: Tuple[int, int, int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    seed, start, stop, bank_size = args
+    images, masks = [], []
+    for row in range(start, stop):
+        np.random.seed(seed + row)
+        img, mask = _dataset.generate(row // bank_size)
+        images.append(img)
+        masks.append(mask)
+    return np.stack(images), np.stack(masks)
+
+
+def fingerprint(dataset: Dataset, num_samples: int = 64) -> str:
+    """Fingerprint of the source images of a PII NormalDataset, from evenly spaced samples"""
+    digest = hashlib.sha1(str(len(dataset)).encode())
+    for idx in np.unique(np.linspace(0, len(dataset) - 1, num_samples).astype(int)):
+        digest.update(np.ascontiguousarray(dataset.source(idx)).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def bank_path(dataset: Dataset, config: Namespace) -> str:
+    return os.path.join(config.datasets_dir, config.modality, 'pii_bank', fingerprint(dataset))
+
+
+def generate_bank(dataset: Dataset, path: str, bank_size: int, seed: int = 0,
+                  num_processes: int = cpu_count(), shard_size: int = 4096) -> None:
+    """
+    Generate bank_size (image, mask) pairs per source image of dataset with a process pool
+    and write them to a new bank.
+    Args:
+        dataset (Dataset): PII NormalDataset, with source() and generate() methods
+        path (str): directory of the bank
+        bank_size (int): number of pairs per source image
+        seed (int): seed of the first pair, pair row is generated with seed + row
+        num_processes (int): number of worker processes
+        shard_size (int): number of pairs per shard
+    """
+    os.makedirs(path, exist_ok=True)
+    num_rows = len(dataset) * bank_size
+    img, mask = dataset.generate(0)
+    chunk_size = 64
+
+    shards = []
+    # forked workers share the dataset (and its memory-mapped images) without pickling it
+    with get_context('fork').Pool(num_processes, _init_worker, (dataset,)) as pool:
+        for shard, start in enumerate(range(0, num_rows, shard_size)):
+            stop = min(start + shard_size, num_rows)
+            tmp_path = os.path.join(path, f'{shard}.{os.getpid()}.tmp')
+            images = np.lib.format.open_memmap(tmp_path + '.images.npy', mode='w+', dtype=img.dtype,
+                                               shape=(stop - start, *img.shape))
+            masks = np.lib.format.open_memmap(tmp_path + '.masks.npy', mode='w+', dtype=mask.dtype,
+                                              shape=(stop - start, *mask.shape))
+
+            chunks = [(seed, s, min(s + chunk_size, stop), bank_size) for s in range(start, stop, chunk_size)]
+            for (_, s, e, _), (chunk_images, chunk_masks) in zip(chunks, pool.imap(_generate_chunk, chunks)):
+                images[s - start:e - start] = chunk_images
+                masks[s - start:e - start] = chunk_masks
+
+            images.flush()
+            masks.flush()
+            del images, masks
+            os.replace(tmp_path + '.images.npy', os.path.join(path, f'{shard}.images.npy'))
+            os.replace(tmp_path + '.masks.npy', os.path.join(path, f'{shard}.masks.npy'))
+            shards.append(str(shard))
+            print(f'Generated pairs {start}-{stop} of {num_rows}')
+
+    # the manifest is written last, so its existence marks a complete bank
+    manifest = {'num_sources': len(dataset),
+                'bank_size': bank_size,
+                'shard_size': shard_size,
+                'seed': seed,
+                'shards': shards}
+    tmp_path = os.path.join(path, f'manifest.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(path, 'manifest.json'))
+
+
+class AnomalyBank():
+    """
+    Read-only, memory-mapped bank of synthetic (image, mask) pairs.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): directory of the bank
+        """
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        self.path = path
+        self.num_sources = manifest['num_sources']
+        self.bank_size = manifest['bank_size']
+        self.shard_size = manifest['shard_size']
+        self.seed = manifest['seed']
+        self.images = [np.load(os.path.join(path, f'{s}.images.npy'), mmap_mode='r') for s in manifest['shards']]
+        self.masks = [np.load(os.path.join(path, f'{s}.masks.npy'), mmap_mode='r') for s in manifest['shards']]
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, 'manifest.json'))
+
+    def seed_of(self, source: int, k: int) -> int:
+        """Seed of pair k of a source image"""
+        return self.seed + source * self.bank_size + k
+
+    def pair(self, source: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Pair k of a source image, as writable float arrays"""
+        row = source * self.bank_size + k
+        shard, row = divmod(row, self.shard_size)
+        return np.array(self.images[shard][row]), np.array(self.masks[shard][row])
+
+    def sample(self, source: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Random pair of a source image"""
+        return self.pair(source, np.random.randint(self.bank_size))
+
+
+def get_anomaly_bank(dataset: Dataset, config: Namespace) -> Optional[AnomalyBank]:
+    """Bank to sample the anomalies of dataset from, if enabled in config and generated, else None"""
+    if 'pii_bank' not in config or not config.pii_bank or len(dataset) == 0:
+        return None
+    path = bank_path(dataset, config)
+    if not AnomalyBank.exists(path):
+        return None
+    bank = AnomalyBank(path)
+    assert bank.num_sources == len(dataset), f"Anomaly bank {path} does not match the dataset"
+    print(f'Sampling anomalies from bank {path}')
+    return bank
+
+
+def get_config():
+    from UPD_study.utilities.common_config import common_config
+    parser = ArgumentParser()
+    parser = common_config(parser)
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size')
+    parser.add_argument('--bank_size', type=int, default=8, help='Number of pairs per source image')
+    parser.add_argument('--bank_seed', type=int, default=0, help='Seed of the first pair')
+    parser.add_argument('--num_processes', type=int, default=cpu_count(), help='Number of generating processes')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from UPD_study.utilities.utils import RepeatedDataset
+    config = get_config()
+    config.method = 'PII'
+    config.datasets_dir = os.path.join(ROOT, 'data/datasets')
+    config.pii_bank = False
+
+    if config.modality == 'MRI':
+        from UPD_study.data.dataloaders.PII_MRI import get_dataloaders
+    elif config.modality == 'CXR':
+        from UPD_study.data.dataloaders.PII_CXR import get_dataloaders
+    elif config.modality == 'RF':
+        from UPD_study.data.dataloaders.PII_RF import get_dataloaders
+    else:
+        raise ValueError(f'Unknown modality {config.modality}, expected one of MRI, CXR, RF')
+
+    train_loader, val_loader = get_dataloaders(config, train=True)
+
+    datasets = {}
+    for dataset in [train_loader.dataset, val_loader.dataset]:
+        # repeated datasets share the bank of the dataset they repeat
+        while isinstance(dataset, RepeatedDataset):
+            dataset = dataset.dataset
+        datasets[bank_path(dataset, config)] = dataset
+
+    for path, dataset in datasets.items():
+        if AnomalyBank.exists(path):
+            print(f'Anomaly bank {path} exists, skipping.')
+            continue
+        print(f'Generating {config.bank_size} anomalies for each of {len(dataset)} images to {path}...')
+        generate_bank(dataset, path, config.bank_size, config.bank_seed, config.num_processes)
@@ -8,17 +8,19 @@ from argparse import ArgumentParser
 from time import time
 from typing import Tuple
 from torch import Tensor
-from scipy.ndimage import gaussian_filter
 from torchinfo import summary
 import pathlib
 from resnet import resnet18, wide_resnet50_2
 from de_resnet import de_resnet18, de_wide_resnet50_2
 from UPD_study.utilities.evaluate import evaluate
+from UPD_study.utilities.anomaly_cache import CacheSteps, cached_outputs
 from UPD_study.utilities.common_config import common_config
 from UPD_study.utilities.utils import (save_model, test_inference_speed, seed_everything,
                                        load_data, load_pretrained,
                                        misc_settings,
                                        load_model, log)
+from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                sample_max, sample_mean)
 
 """"""""""""""""""""""""""""""""""" Config """""""""""""""""""""""""""""""""""
 
@@ -47,6 +49,11 @@ config.method = 'RD'
 config.model_dir_path = pathlib.Path(__file__).parents[0]
 misc_settings(config)
 
+# config attributes other than the checkpoint that change the raw anomaly maps
+inference_keys = ['arch']
+# rescoring cached outputs needs neither the test set nor the saved model
+config.cached_outputs = cached_outputs(config, inference_keys)
+
 """"""""""""""""""""""""""""""""" Load data """""""""""""""""""""""""""""""""
 
 # specific seed for creating the dataloader
@@ -88,7 +95,7 @@ optimizer = torch.optim.Adam(list(decoder.parameters()) + list(bn.parameters()),
 
 
 # Load saved model to evaluate
-if config.eval:
+if config.eval and not config.cached_outputs:
     load_dec, load_bn = load_model(config)
     decoder.load_state_dict(load_dec)
     bn.load_state_dict(load_bn)
@@ -153,14 +160,42 @@ def get_anomaly_map(enc_output, dec_output, config) -> Tensor:
         a_map = F.interpolate(a_map, size=config.image_size, mode='bilinear', align_corners=True)
         anomaly_map += a_map
 
+    return anomaly_map
+
+
+@ torch.no_grad()
+def inference_step(input) -> Tensor:
+    """
+    Anomaly maps of the input before smoothing and masking, the raw output of the model
+    on evaluation samples.
+    """
+    encoder.eval()
+    decoder.eval()
+    bn.eval()
+    enc_output = encoder(input)
+    dec_output = decoder(bn(enc_output))
+    return get_anomaly_map(enc_output, dec_output, config)
+
+
+def postprocess_step(input, anomaly_map) -> Tuple[Tensor, Tensor]:
+    """
+    Smoothed and masked anomaly maps and anomaly scores of the input from its raw anomaly maps.
+    """
     # apply gaussian smoothing on the score map
     if config.gaussian_blur:
-        anomaly_map = anomaly_map.detach().cpu().numpy()
-        for i in range(anomaly_map.shape[0]):
-            anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)
+        anomaly_map = gaussian_blur(anomaly_map.detach(), sigma=config.sigma)
 
-        anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
-    return anomaly_map
+    if config.modality == 'MRI':
+        mask = foreground_mask(input, first_channel=True)
+        anomaly_map *= mask
+        anomaly_score = masked_max(anomaly_map, mask)
+
+    elif config.modality == 'RF':
+        anomaly_score = sample_max(anomaly_map)
+    else:
+        anomaly_score = sample_mean(anomaly_map)
+
+    return anomaly_map, anomaly_score
 
 
 @ torch.no_grad()
@@ -178,16 +213,7 @@ def val_step(input, test_samples: bool = False) -> Tuple[float, Tensor, Tensor]:
     anomaly_map = get_anomaly_map(enc_output, dec_output, config)
 
     # activations = [enc_output[0][-2, 0:10], enc_output[1][-2, 0:10], enc_output[2][-2, 0:10]]
-    if config.modality == 'MRI':
-        mask = torch.stack([inp[0].unsqueeze(0) > inp[0].min() for inp in input])
-        anomaly_map *= mask
-        anomaly_score = torch.tensor([map[inp[0].unsqueeze(0) > inp[0].min()].max()
-                                      for map, inp in zip(anomaly_map, input)])
-
-    elif config.modality == 'RF':
-        anomaly_score = torch.tensor([map.max() for map in anomaly_map])
-    else:
-        anomaly_score = torch.tensor([map.mean() for map in anomaly_map])
+    anomaly_map, anomaly_score = postprocess_step(input, anomaly_map)
 
     if test_samples:
         return anomaly_map, anomaly_score
@@ -274,7 +300,8 @@ if __name__ == '__main__':
 
     if config.eval:
         print('Evaluating model...')
-        evaluate(config, big_testloader, val_step)
+        evaluate(config, big_testloader, val_step,
+                 CacheSteps(inference_step, postprocess_step, inference_keys))
 
     else:
         train()
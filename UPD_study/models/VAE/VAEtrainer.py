@@ -11,8 +11,8 @@ from torch import Tensor
 from typing import Tuple
 import pathlib
 from torchinfo import summary
-from scipy.ndimage import gaussian_filter
 from UPD_study.utilities.evaluate import evaluate
+from UPD_study.utilities.anomaly_cache import CacheSteps, cached_outputs
 from UPD_study.utilities.common_config import common_config
 from UPD_study.utilities.utils import (save_model, seed_everything,
                                        load_data, load_pretrained,
@@ -75,6 +75,9 @@ if (config.modality == 'MRI' and config.sequence == 't1') or config.modality ==
     config.width = 32
     config.conv1x1 = 64
 
+# rescoring cached outputs needs neither the test set nor the saved model
+config.cached_outputs = cached_outputs(config)
+
 """"""""""""""""""""""""""""""""" Load data """""""""""""""""""""""""""""""""
 
 # specific seed for creating the dataloader
@@ -100,7 +103,7 @@ optimizer = torch.optim.Adam(model.parameters(), lr=config.lr, betas=(0., 0.9),
                              weight_decay=config.weight_decay)
 
 # Load saved model to evaluate
-if config.eval:
+if config.eval and not config.cached_outputs:
     model.load_state_dict(load_model(config))
     print('Saved model loaded.')
 
@@ -128,46 +131,58 @@ def vae_train_step(input) -> dict:
     return loss_dict
 
 
-def vae_val_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
+def vae_inference_step(input) -> Tensor:
     """
-    Validation step on validation or evaluation (test samples == True) set.
+    Reconstruction of the input, the raw output of the model on evaluation samples.
     """
     model.eval()
-
     with torch.no_grad():
-        input_recon, mu, logvar = model(input)
+        input_recon, _, _ = model(input)
+    return input_recon
 
-    loss_dict = model.loss_function(input, input_recon, mu, logvar)  # VAE Loss
 
+def vae_postprocess_step(input, input_recon) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Anomaly maps and anomaly scores of the input from its reconstruction.
+    """
     # Anomaly map
     if config.ssim_eval:
 
         anomaly_map = ssim_map(input_recon, input)
 
         if config.gaussian_blur:
-            anomaly_map = anomaly_map.cpu().numpy()
-            for i in range(anomaly_map.shape[0]):
-                anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=config.sigma)
-            anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
+            anomaly_map = gaussian_blur(anomaly_map, sigma=config.sigma)
     else:
         anomaly_map = (input - input_recon).abs().mean(1, keepdim=True)
         if config.gaussian_blur:
-            anomaly_map = anomaly_map.cpu().numpy()
-            for i in range(anomaly_map.shape[0]):
-                anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=config.sigma)
-            anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
+            anomaly_map = gaussian_blur(anomaly_map, sigma=config.sigma)
 
     # for MRI apply brainmask
     if config.modality == 'MRI':
-        mask = torch.stack([inp[0].unsqueeze(0) > inp[0].min() for inp in input])
+        mask = foreground_mask(input, first_channel=True)
         anomaly_map *= mask
-        anomaly_score = torch.tensor([map[inp[0].unsqueeze(0) > inp[0].min()].max()
-                                     for map, inp in zip(anomaly_map, input)])
+        anomaly_score = masked_max(anomaly_map, mask)
 
     elif config.modality == 'RF':
-        anomaly_score = torch.tensor([map.max() for map in anomaly_map])
+        anomaly_score = sample_max(anomaly_map)
     else:
-        anomaly_score = torch.tensor([map.mean() for map in anomaly_map])
+        anomaly_score = sample_mean(anomaly_map)
+
+    return anomaly_map, anomaly_score, input_recon
+
+
+def vae_val_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
+    """
+    Validation step on validation or evaluation (test samples == True) set.
+    """
+    model.eval()
+
+    with torch.no_grad():
+        input_recon, mu, logvar = model(input)
+
+    loss_dict = model.loss_function(input, input_recon, mu, logvar)  # VAE Loss
+
+    anomaly_map, anomaly_score, input_recon = vae_postprocess_step(input, input_recon)
 
     if test_samples:
         return anomaly_map, anomaly_score, input_recon
@@ -271,12 +286,15 @@ def train() -> None:
 
 
 from UPD_study.utilities.utils import test_inference_speed
+from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                sample_max, sample_mean)
 if __name__ == '__main__':
     if config.speed_benchmark:
         test_inference_speed(vae_val_step)
         exit(0)
     if config.eval:
         print(f'Evaluating {config.name}...')
-        evaluate(config, big_testloader, vae_val_step)
+        evaluate(config, big_testloader, vae_val_step,
+                 CacheSteps(vae_inference_step, vae_postprocess_step))
     else:
         train()
@@ -16,12 +16,14 @@ from VAEmodel import VAE
 from torch import Tensor
 from typing import Tuple
 from torchinfo import summary
-from scipy.ndimage import gaussian_filter
 import pathlib
 from UPD_study.utilities.evaluate import evaluate
+from UPD_study.utilities.anomaly_cache import CacheSteps, cached_outputs
 from UPD_study.utilities.common_config import common_config
 from UPD_study.utilities.utils import (seed_everything, load_data, load_pretrained,
                                        misc_settings, ssim_map, load_model, test_inference_speed)
+from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                sample_max, sample_mean)
 
 """"""""""""""""""""""""""""""""""" Config """""""""""""""""""""""""""""""""""
 
@@ -93,6 +95,11 @@ if config.modality == 'MRI':
 if config.modality == 'RF':
     config.tv_lambda = 1.7
 
+# config attributes other than the checkpoint that change the restorations
+inference_keys = ['tv_lambda', 'num_restoration_steps', 'restore_lr']
+# rescoring cached outputs needs neither the test set nor the saved model,
+# unless tv_lambda still has to be determined on the validation set
+config.cached_outputs = config.tv_lambda >= 0 and cached_outputs(config, inference_keys)
 
 """"""""""""""""""""""""""""""""" Load data """""""""""""""""""""""""""""""""
 
@@ -120,7 +127,7 @@ if config.load_pretrained and not config.eval:
     model = load_pretrained(model, config)
 
 # Load saved model to evaluate
-if config.eval:
+if config.eval and not config.cached_outputs:
     model.load_state_dict(load_model(config))
     print('Saved model loaded.')
 
@@ -188,45 +195,53 @@ def restore(input):
     return restored
 
 
-def restoration_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
+def restoration_inference_step(input) -> Tensor:
     """
-    Iteratively restore input
+    Restoration of the input, the raw output of the model on evaluation samples
     """
     model.eval()
-    input_recon = restore(input)
+    return restore(input).detach()
+
 
+def restoration_postprocess_step(input, input_recon) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Anomaly maps and anomaly scores of the input from its restoration
+    """
     # Anomaly map
     if config.ssim_eval:
         anomaly_map = ssim_map(input_recon, input)
 
         if config.gaussian_blur:
-            anomaly_map = anomaly_map.detach().cpu().numpy()
-            for i in range(anomaly_map.shape[0]):
-                anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)
-            anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
+            anomaly_map = gaussian_blur(anomaly_map.detach(), sigma=config.sigma)
     else:
         anomaly_map = (input - input_recon).abs().mean(1, keepdim=True).detach()
         if config.gaussian_blur:
-            anomaly_map = anomaly_map.cpu().numpy()
-            for i in range(anomaly_map.shape[0]):
-                anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)
-            anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
+            anomaly_map = gaussian_blur(anomaly_map, sigma=config.sigma)
 
     # for MRI, RF apply brainmask
     if config.modality == 'MRI':
-        mask = torch.stack([inp > inp.min() for inp in input])
+        mask = foreground_mask(input)
         anomaly_map *= mask
         input_recon *= mask
-        anomaly_score = torch.tensor([map[inp > inp.min()].max() for map, inp in zip(anomaly_map, input)])
+        anomaly_score = masked_max(anomaly_map, mask)
 
     elif config.modality == 'RF':
-        anomaly_score = torch.tensor([map.max() for map in anomaly_map])
+        anomaly_score = sample_max(anomaly_map)
     else:
-        anomaly_score = torch.tensor([map.mean() for map in anomaly_map])
+        anomaly_score = sample_mean(anomaly_map)
 
     return anomaly_map.detach(), anomaly_score.detach(), input_recon.detach()
 
 
+def restoration_step(input, test_samples: bool = False) -> Tuple[dict, Tensor]:
+    """
+    Iteratively restore input
+    """
+    model.eval()
+    input_recon = restore(input)
+    return restoration_postprocess_step(input, input_recon)
+
+
 if __name__ == '__main__':
     if config.speed_benchmark:
         test_inference_speed(restoration_step, iterations=100, restoration=True)
@@ -237,4 +252,5 @@ if __name__ == '__main__':
     if config.tv_lambda < 0:
         determine_best_lambda()
 
-    evaluate(config, big_testloader, restoration_step)
+    evaluate(config, big_testloader, restoration_step,
+             CacheSteps(restoration_inference_step, restoration_postprocess_step, inference_keys))
@@ -18,7 +18,8 @@ from UPD_study.utilities.utils import (seed_everything, test_inference_speed, st
                                        misc_settings, log, load_model)
 from torchinfo import summary
 from UPD_study.utilities.evaluate import evaluate
-from scipy.ndimage import gaussian_filter
+from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                sample_max, sample_mean)
 """"""""""""""""""""""""""""""""""" Config """""""""""""""""""""""""""""""""""
 
 
@@ -423,13 +424,10 @@ def val_step_encoder(input, test_samples: bool = False):
             anomaly_map = (input - input_recon).abs().mean(1, keepdim=True)
 
         if config.gaussian_blur:
-            anomaly_map = anomaly_map.cpu().numpy()
-            for i in range(anomaly_map.shape[0]):
-                anomaly_map[i] = gaussian_filter(anomaly_map[i], sigma=4)
-            anomaly_map = torch.from_numpy(anomaly_map).to(config.device)
+            anomaly_map = gaussian_blur(anomaly_map, sigma=4)
 
         if config.modality == 'MRI':
-            mask = torch.cat([inp > inp.min() for inp in input]).unsqueeze(1)
+            mask = foreground_mask(input)
             anomaly_map *= mask
 
         # Anomaly score
@@ -439,20 +437,17 @@ def val_step_encoder(input, test_samples: bool = False):
             img_diff = (input - input_recon).pow(2)
 
         if config.gaussian_blur:
-            img_diff = img_diff.cpu().numpy()
-            for i in range(img_diff.shape[0]):
-                img_diff[i] = gaussian_filter(img_diff[i], sigma=4)
-            img_diff = torch.from_numpy(img_diff).to(config.device)
+            img_diff = gaussian_blur(img_diff, sigma=4)
 
         if config.modality == 'MRI':
-            mask = torch.cat([inp > inp.min() for inp in input]).unsqueeze(1)
+            mask = foreground_mask(input)
             img_diff *= mask
-            img_score = torch.tensor([map[inp > inp.min()].max() for map, inp in zip(img_diff, input)])
+            img_score = masked_max(img_diff, mask)
 
         elif config.modality == 'RF':
-            img_score = torch.tensor([map.max() for map in anomaly_map])
+            img_score = sample_max(anomaly_map)
         else:
-            img_score = torch.tensor([map.mean() for map in anomaly_map])
+            img_score = sample_mean(anomaly_map)
 
         feat_diff = (x_feats - x_rec_feats).pow(2).mean((1))
         anomaly_score = img_score.to(config.device) + config.feat_weight * feat_diff
@@ -0,0 +1,242 @@
+"""
+Persistent cache of the raw outputs of a model on a test set.
+
+Evaluation splits into model inference, which produces raw per-pixel outputs (e.g.
+reconstructions, or anomaly maps before smoothing and masking), and post-processing, which
+turns them into anomaly maps and scores (--ssim_eval, --gaussian-blur, --sigma, brain masks and
+the score aggregation). With --anomaly_cache, evaluate() stores the raw outputs together with
+the inputs and targets of the test set in memory-mapped files, keyed by the hash of the
+checkpoint and a fingerprint of the test set. With --rescore, evaluate() reads them back and only
+re-runs post-processing and metrics, so post-processing settings can be swept without inference,
+and the trainers skip loading the test set and the model.
+
+Inputs and outputs are stored in float32 by default, so that rescoring reproduces the evaluation
+it replaces. The metrics of every evaluation with inference are recorded next to the cache for
+its post-processing settings, and a rescore with the same settings is checked against them.
+--anomaly_cache_dtype float16 halves the size of the cache, at the cost of exact reproduction.
+
+A cache consists of one raw file per array plus a json index with their shapes and dtypes,
+written last, so that its existence marks a complete cache.
+"""
+import os
+import json
+import math
+import hashlib
+from argparse import Namespace
+from typing import Callable, Dict, Iterator, Sequence, Tuple
+import numpy as np
+import torch
+from torch import Tensor
+from UPD_study.data.dataloaders.manifest import file_hash
+from UPD_study.utilities.utils import checkpoint_paths, to_uint8_mask
+
+# bump when the layout of the cache changes
+CACHE_VERSION = 1
+
+# config attributes that determine the samples of the test set
+TEST_SET_KEYS = ['modality', 'sequence', 'brats_t1', 'slice_range', 'image_size', 'img_channels',
+                 'normalize', 'equalize_histogram', 'preprocessing_backend', 'storage_dtype',
+                 'center', 'stadardize', 'percentage', 'anomal_split', 'shuffle', 'sup_devices',
+                 'AP_only', 'pathology', 'sex']
+
+# config attributes that determine the metrics computed from the cached outputs
+SCORE_KEYS = ['ssim_eval', 'gaussian_blur', 'sigma', 'get_images', 'no_dice', 'metric_bins']
+
+# largest difference between the recorded and the rescored metrics of a float32 cache
+SCORE_TOLERANCE = 1e-6
+
+
+class CacheSteps():
+    """
+    val_step of a method split into model inference and post-processing, so that the raw
+    outputs of inference can be cached and re-scored without the model.
+    """
+
+    def __init__(self, inference_step: Callable, postprocess_step: Callable,
+                 inference_keys: Sequence[str] = ()):
+        """
+        Args:
+            inference_step (Callable): input -> raw per-pixel outputs of the model, of shape [b,c,h,w]
+            postprocess_step (Callable): input, outputs -> the outputs of val_step(input, test_samples=True)
+            inference_keys (Sequence[str]): config attributes, other than the checkpoint and the
+                                            test set, that change the outputs of inference_step
+        """
+        self.inference_step = inference_step
+        self.postprocess_step = postprocess_step
+        self.inference_keys = list(inference_keys)
+
+
+def cache_path(config: Namespace, inference_keys: Sequence[str] = ()) -> str:
+    """
+    Path (without extension) of the cache of the current checkpoint on the current test set.
+    The name is derived from the hashes of the checkpoint files and the config attributes of the
+    test set and of inference, so that retraining or a different test set leads to a new cache.
+    """
+    settings = {k: getattr(config, k) for k in TEST_SET_KEYS + list(inference_keys) if k in config}
+    key = hashlib.sha1()
+    key.update(config.method.encode())
+    for path in checkpoint_paths(config):
+        key.update(file_hash(path).encode())
+    key.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+    cache_dir = config.anomaly_cache_dir if config.anomaly_cache_dir is not None else \
+        os.path.join(config.model_dir_path, 'anomaly_cache')
+    return os.path.join(cache_dir, config.modality, f'{config.method}_{key.hexdigest()[:16]}')
+
+
+def cached_outputs(config: Namespace, inference_keys: Sequence[str] = ()) -> bool:
+    """
+    True if the run rescores a complete cache, so that neither the test set nor the
+    model have to be loaded.
+    """
+    return 'rescore' in config and config.rescore and AnomalyCache.exists(cache_path(config, inference_keys))
+
+
+def check_scores(config: Namespace, path: str, scores: Dict[str, float]) -> None:
+    """
+    Record the metrics of an evaluation with inference in <path>.scores.json, for the current
+    post-processing settings. When rescoring, check the metrics against the recorded ones
+    instead: a float32 cache must reproduce them up to SCORE_TOLERANCE.
+    """
+    settings = json.dumps({k: getattr(config, k) for k in SCORE_KEYS if k in config},
+                          sort_keys=True, default=str)
+    scores_path = path + '.scores.json'
+    recorded = {}
+    if os.path.exists(scores_path):
+        with open(scores_path) as f:
+            recorded = json.load(f)
+
+    if not config.rescore:
+        recorded[settings] = scores
+        tmp_path = scores_path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(recorded, f)
+        os.replace(tmp_path, scores_path)
+        return
+
+    if settings not in recorded:
+        print('No evaluation with inference was recorded with these settings, rescored metrics not checked')
+        return
+
+    mismatches = {k: (v, scores[k]) for k, v in recorded[settings].items()
+                  if k in scores and not (abs(scores[k] - v) <= SCORE_TOLERANCE or
+                                          (math.isnan(v) and math.isnan(scores[k])))}
+    if not mismatches:
+        print('Rescored metrics match the evaluation with inference')
+        return
+
+    msg = 'Rescored metrics differ from the evaluation with inference: ' + \
+        ', '.join(f'{k} {v:.6f} vs. {rescored:.6f}' for k, (v, rescored) in mismatches.items())
+    if AnomalyCache(path).dtype == np.float32:
+        raise RuntimeError(msg)
+    print(msg + ' (float16 cache)')
+
+
+class AnomalyCache():
+    """
+    Read-only view of the cached inputs, raw outputs and targets of a test set.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): path of the cache, without extension
+        """
+        with open(path + '.json') as f:
+            self.index = json.load(f)
+        assert self.index['version'] == CACHE_VERSION, f'{path} was written by another version, re-run inference'
+
+        self.path = path
+        self.arrays = {name: np.memmap(f'{path}.{name}.dat', dtype=np.dtype(array['dtype']), mode='r',
+                                       shape=tuple(array['shape']))
+                       for name, array in self.index['arrays'].items()}
+
+    def __len__(self):
+        """Number of cached samples"""
+        return len(self.arrays['inputs'])
+
+    @property
+    def dtype(self) -> np.dtype:
+        """dtype of the cached inputs and outputs"""
+        return self.arrays['outputs'].dtype
+
+    def batches(self, batch_size: int) -> Iterator[Tuple[Tensor, Tensor, Tensor]]:
+        """
+        Iterate over the cache in the order it was written.
+        Yields:
+            input (Tensor): float32 inputs of shape [b,c,h,w]
+            target (Tensor): uint8 segmentations of shape [b,1,h,w] or labels of shape [b]
+            outputs (Tensor): float32 raw outputs of the model
+        """
+        for i in range(0, len(self), batch_size):
+            yield (torch.from_numpy(self.arrays['inputs'][i:i + batch_size].astype(np.float32)),
+                   torch.from_numpy(np.array(self.arrays['targets'][i:i + batch_size])),
+                   torch.from_numpy(self.arrays['outputs'][i:i + batch_size].astype(np.float32)))
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        # the index is written last, so its existence marks a complete cache
+        return os.path.exists(path + '.json')
+
+
+class AnomalyCacheWriter():
+    """
+    Builds a new cache batch by batch. The arrays are allocated at the first batch and the
+    cache becomes visible to readers only after commit().
+    """
+
+    def __init__(self, path: str, num_samples: int, dtype: str = 'float32'):
+        """
+        Args:
+            path (str): path of the cache, without extension
+            num_samples (int): number of samples of the test set
+            dtype (str): dtype of the stored inputs and outputs, float32 or float16
+        """
+        self.path = path
+        self.dtype = getattr(torch, dtype)
+        self.tmp_path = path + f'.{os.getpid()}.tmp'
+        self.num_samples = num_samples
+        self.arrays: Dict[str, np.memmap] = {}
+        self.rows = 0
+
+    def _allocate(self, name: str, array: np.ndarray) -> np.memmap:
+        shape = (self.num_samples, *array.shape[1:])
+        return np.memmap(f'{self.tmp_path}.{name}', dtype=array.dtype, mode='w+', shape=shape)
+
+    def append(self, input: Tensor, outputs: Tensor, target: Tensor) -> None:
+        """
+        Add a batch of the test set.
+        Args:
+            input (Tensor): inputs of shape [b,c,h,w]
+            outputs (Tensor): raw outputs of the model of shape [b,c,h,w]
+            target (Tensor): binary segmentations of shape [b,1,h,w] or labels of shape [b]
+        """
+        target = target.long() if target.dim() == 1 else to_uint8_mask(target)
+        batch = {'inputs': input.detach().cpu().to(self.dtype).numpy(),
+                 'outputs': outputs.detach().cpu().to(self.dtype).numpy(),
+                 'targets': target.cpu().numpy()}
+
+        if not self.arrays:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.arrays = {name: self._allocate(name, array) for name, array in batch.items()}
+
+        for name, array in batch.items():
+            self.arrays[name][self.rows:self.rows + len(array)] = array
+        self.rows += len(batch['inputs'])
+
+    def commit(self) -> AnomalyCache:
+        """
+        Flush the written batches, publish the cache and open it read-only.
+        """
+        index = {'version': CACHE_VERSION, 'arrays': {}}
+        for name, array in self.arrays.items():
+            index['arrays'][name] = {'shape': [self.rows, *array.shape[1:]], 'dtype': array.dtype.str}
+            array.flush()
+            os.replace(f'{self.tmp_path}.{name}', f'{self.path}.{name}.dat')
+        self.arrays = {}
+
+        with open(self.tmp_path + '.json', 'w') as f:
+            json.dump(index, f)
+        os.replace(self.tmp_path + '.json', self.path + '.json')
+
+        return AnomalyCache(self.path)
@@ -0,0 +1,369 @@
+"""
+Micro-benchmarks of the data loading and evaluation pipeline.
+
+Usage:
+    python UPD_study/utilities/benchmarks.py nifti --sequence t2 --num_files 20
+    python UPD_study/utilities/benchmarks.py preprocessing --sequence t2 --num_files 20
+    python UPD_study/utilities/benchmarks.py segmentations --sequence t2
+    python UPD_study/utilities/benchmarks.py storage --sequence t2 --num_files 20
+    python UPD_study/utilities/benchmarks.py loader --num_slices 20000 --batch_size 32
+    python UPD_study/utilities/benchmarks.py pii --image_size 128 --channels 1
+    python UPD_study/utilities/benchmarks.py ccd_augmentation --image_size 128 --batch_size 32
+    python UPD_study/utilities/benchmarks.py metrics --num_pixels 20000000
+    python UPD_study/utilities/benchmarks.py postprocessing --image_size 128 --batch_size 32
+"""
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from functools import partial
+from time import perf_counter
+from typing import Callable, Sequence, Tuple
+import numpy as np
+from UPD_study.data.dataloaders.mri_preprocessing import (get_brats_files, get_camcan_files, load_nii,
+                                                          load_nii_nn, load_segmentation,
+                                                          load_files_to_ram)
+from UPD_study.data.dataloaders.mri_preprocessing_torch import load_nii_nn_torch, load_files_batched
+from UPD_study.data.dataloaders.storage import STORAGE_DTYPES, quantize, to_float32
+from UPD_study.utilities.utils import GenericDataloader, str_to_bool
+
+
+def measure(fn: Callable, *args, **kwargs) -> Tuple[float, int]:
+    """
+    Measure wall time and peak traced memory of a single call.
+    Args:
+        fn (Callable): function to call with args and kwargs
+    Returns:
+        seconds (float): wall time of the call
+        peak (int): peak memory allocated during the call, in bytes
+    """
+    tracemalloc.start()
+    start = perf_counter()
+    fn(*args, **kwargs)
+    seconds = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def _load_full_volume(path: str, slice_range: Tuple[int, int]) -> np.ndarray:
+    # previous path: decode the whole volume as float64, then cut the slice range
+    return load_nii(path, primary_axis=2)[0][slice_range[0]:slice_range[1]]
+
+
+def _load_slice_range(path: str, slice_range: Tuple[int, int]) -> np.ndarray:
+    return load_nii(path, primary_axis=2, slice_range=slice_range)[0]
+
+
+def benchmark_nifti_loading(files: Sequence[str], slice_range: Tuple[int, int]) -> None:
+    """
+    Compare wall time and peak memory per volume of decoding full NIfTI volumes
+    against partial reads of slice_range, and check that both give the same slices.
+    """
+    for name, load_fn in [('full volume', _load_full_volume),
+                          ('slice range', _load_slice_range)]:
+        timings, peaks = zip(*[measure(load_fn, f, slice_range) for f in files])
+        print(f'{name:>12}: {np.mean(timings) * 1000:.1f} ms/volume, '
+              f'peak {np.mean(peaks) / 1e6:.1f} MB/volume')
+
+    max_diff = max(np.abs(_load_full_volume(f, slice_range) - _load_slice_range(f, slice_range)).max()
+                   for f in files)
+    print(f'max abs difference: {max_diff:.3g}')
+
+
+def benchmark_preprocessing(files: Sequence[str], image_size: int, slice_range: Tuple[int, int],
+                            normalize: bool, equalize_histogram: bool) -> None:
+    """
+    Compare throughput of the skimage and torch preprocessing backends and validate
+    the torch outputs against the skimage outputs.
+    """
+    params = dict(size=image_size, slice_range=slice_range,
+                  normalize=normalize, equalize_histogram=equalize_histogram)
+
+    outputs = {}
+    for name, load_files, load_fn in [('skimage', load_files_to_ram, load_nii_nn),
+                                      ('torch', load_files_batched, load_nii_nn_torch)]:
+        start = perf_counter()
+        outputs[name] = load_files(files, partial(load_fn, **params))
+        seconds = perf_counter() - start
+        print(f'{name:>8}: {len(files) / seconds:.2f} volumes/s')
+
+    diff = np.abs(outputs['skimage'] - outputs['torch'])
+    print(f'max abs difference: {diff.max():.3g}, mean abs difference: {diff.mean():.3g}, '
+          f'voxels differing by more than 1e-3: {(diff > 1e-3).mean() * 100:.4f}%')
+
+
+def _load_segmentation_int64(path: str, size: int, slice_range: Tuple[int, int]) -> np.ndarray:
+    # previous representation: np.where(vol > threshold, 1, 0)
+    return load_segmentation(path, size=size, slice_range=slice_range).astype(np.int64)
+
+
+def benchmark_segmentations(files: Sequence[str], image_size: int, slice_range: Tuple[int, int]) -> None:
+    """
+    Report the memory held by the segmentations of the BraTS test split as int64 arrays
+    (previous) and as uint8 arrays, and their size if bit-packed for reference.
+    """
+    params = dict(size=image_size, slice_range=slice_range)
+    for name, load_fn in [('int64', partial(_load_segmentation_int64, **params)),
+                          ('uint8', partial(load_segmentation, **params))]:
+        segmentations = load_files_to_ram(files, load_fn)
+        print(f'{name:>12}: {segmentations.nbytes / 1e6:.1f} MB for {len(files)} volumes, '
+              f'shape {segmentations.shape}')
+
+    packed = np.packbits(segmentations.reshape(len(segmentations), -1), axis=1)
+    print(f'{"bit-packed":>12}: {packed.nbytes / 1e6:.1f} MB')
+
+
+def benchmark_storage(files: Sequence[str], image_size: int, slice_range: Tuple[int, int]) -> None:
+    """
+    Report the footprint of CamCAN volumes in every storage dtype, and the error of the
+    values read back by the datasets against the float32 volumes.
+    """
+    volumes = load_files_to_ram(files, partial(load_nii_nn, size=image_size, slice_range=slice_range))
+    for dtype in STORAGE_DTYPES:
+        stored, scales = zip(*[quantize(vol, dtype) for vol in volumes])
+        diff = np.abs(np.stack([to_float32(vol, scale) for vol, scale in zip(stored, scales)]) - volumes)
+        print(f'{dtype:>8}: {sum(vol.nbytes for vol in stored) / 1e6:.1f} MB, '
+              f'max abs error {diff.max():.3g}, mean abs error {diff.mean():.3g}')
+
+
+def benchmark_loader(num_slices: int, image_size: int, batch_size: int, num_workers: int) -> None:
+    """
+    Compare the throughput of GenericDataloader over an in-memory MRI dataset with
+    per-sample loading and with batched loading (get_batch).
+    """
+    from UPD_study.data.dataloaders.MRI import NormalDataset
+    slices = np.random.rand(num_slices, 1, image_size, image_size).astype(np.float32)
+
+    for batched in [False, True]:
+        config = Namespace(batch_size=batch_size, num_workers=num_workers,
+                           center=True, batched_loading=batched)
+        loader = GenericDataloader(NormalDataset(slices, config), config)
+        start = perf_counter()
+        for _ in loader:
+            pass
+        seconds = perf_counter() - start
+        name = 'batched' if batched else 'per-sample'
+        print(f'{name:>12}: {num_slices / seconds:.0f} slices/s')
+
+
+def benchmark_pii(image_size: int, channels: int, num_samples: int, batch_size: int) -> None:
+    """
+    Time of poisson image interpolation per sample, one pair at a time (pii) and
+    in batches (pii_batch).
+    """
+    from UPD_study.models.PII.pii_utils import pii, pii_batch
+    imgs = np.random.rand(2 * num_samples, channels, image_size, image_size).astype(np.float32)
+
+    start = perf_counter()
+    for img1, img2 in zip(imgs[:num_samples], imgs[num_samples:]):
+        pii(img1, img2)
+    print(f'{"pii":>10}: {(perf_counter() - start) / num_samples * 1000:.2f} ms/sample')
+
+    start = perf_counter()
+    for i in range(0, num_samples, batch_size):
+        pii_batch(imgs[i:i + batch_size], imgs[num_samples + i:num_samples + i + batch_size])
+    print(f'{"pii_batch":>10}: {(perf_counter() - start) / num_samples * 1000:.2f} ms/sample')
+
+
+def benchmark_ccd_augmentation(num_images: int, image_size: int, batch_size: int) -> None:
+    """
+    Augmented images per second of the CCD SimCLR augmentations, per image on the CPU
+    (AugmentedDataset) and batch-wise on the available device (BatchSimCLRAugmentation).
+    Both produce two views of every image.
+    """
+    import torch
+    from torchvision import transforms as T
+    from UPD_study.models.CCD.augmentations import BatchSimCLRAugmentation, Cutout1
+    images = torch.rand(num_images, 3, int(image_size // 0.875), int(image_size // 0.875))
+
+    transform = T.Compose([
+        T.RandomResizedCrop(size=image_size, scale=[0.2, 1.0]),
+        T.RandomHorizontalFlip(),
+        T.RandomApply([T.ColorJitter(0.4, 0.4, 0.4, 0.1)], p=0.8),
+        T.RandomGrayscale(0.2),
+        Cutout1(n_holes=1, length=75, random=True)
+    ])
+    start = perf_counter()
+    for image in images:
+        transform(image), transform(image)
+    print(f'{"per image":>10}: {2 * num_images / (perf_counter() - start):.0f} images/s')
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    augmentation = BatchSimCLRAugmentation(image_size, scale=(0.2, 1.0))
+    images = images.to(device)
+    start = perf_counter()
+    for i in range(0, num_images, batch_size):
+        augmentation(images[i:i + batch_size]), augmentation(images[i:i + batch_size])
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    print(f'{"batched":>10}: {2 * num_images / (perf_counter() - start):.0f} images/s ({device})')
+
+
+def benchmark_metrics(num_pixels: int, anomal_fraction: float, num_bins: int) -> None:
+    """
+    Time and values of the pixel-wise metrics on synthetic scores: sklearn, the exact
+    single-sort BinaryCurve and the streaming PixelMetrics histograms.
+    """
+    import torch
+    from sklearn.metrics import average_precision_score, roc_auc_score, roc_curve
+    from UPD_study.utilities.metrics import BinaryCurve, PixelMetrics
+    targets = torch.rand(num_pixels) < anomal_fraction
+    scores = torch.randn(num_pixels) + targets
+
+    start = perf_counter()
+    ap = average_precision_score(targets.numpy(), scores.numpy())
+    auroc = roc_auc_score(targets.numpy(), scores.numpy())
+    roc_curve(targets.numpy(), scores.numpy())
+    print(f'{"sklearn":>12}: {perf_counter() - start:.2f}s, AP {ap:.6f}, AUROC {auroc:.6f}')
+
+    start = perf_counter()
+    curve = BinaryCurve(scores, targets)
+    ap, auroc = curve.average_precision(), curve.auroc()
+    curve.threshold_at_fpr()
+    dice, _ = curve.best_dice()
+    print(f'{"BinaryCurve":>12}: {perf_counter() - start:.2f}s, AP {ap:.6f}, AUROC {auroc:.6f}, Dice {dice:.6f}')
+
+    start = perf_counter()
+    pixel_metrics = PixelMetrics(num_bins)
+    for i in range(0, num_pixels, 2 ** 20):
+        pixel_metrics.update(scores[i:i + 2 ** 20], targets[i:i + 2 ** 20])
+    ap, auroc = pixel_metrics.average_precision(), pixel_metrics.auroc()
+    dice, _ = pixel_metrics.best_dice()
+    print(f'{"PixelMetrics":>12}: {perf_counter() - start:.2f}s, AP {ap:.6f}, AUROC {auroc:.6f}, Dice {dice:.6f}, '
+          f'bounds {pixel_metrics.error_bounds()}')
+
+
+def benchmark_postprocessing(num_batches: int, image_size: int, batch_size: int) -> None:
+    """
+    Time per batch of the MRI post-processing of the val_steps (gaussian blur, brain mask,
+    shift to the foreground minimum and masked max score), per sample with scipy and with the
+    batched functions of utilities.postprocessing, on the available device.
+    """
+    import torch
+    from scipy.ndimage import gaussian_filter
+    from UPD_study.utilities.postprocessing import (foreground_mask, gaussian_blur, masked_max,
+                                                    shift_to_foreground_min)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    input = torch.rand(batch_size, 1, image_size, image_size, device=device)
+    input[..., :image_size // 8, :] = 0
+    anomaly_map = torch.rand_like(input)
+
+    def per_sample():
+        maps = anomaly_map.cpu().numpy()
+        for i in range(maps.shape[0]):
+            maps[i] = gaussian_filter(maps[i], sigma=4)
+        maps = torch.from_numpy(maps).to(device)
+        mask = torch.stack([inp > inp.min() for inp in input])
+        maps = maps * mask
+        mins = [map[map > map.min()].min() for map in maps]
+        maps = torch.cat([(map - min) for map, min in zip(maps, mins)]).unsqueeze(1) * mask
+        return torch.tensor([map[inp > inp.min()].max() for map, inp in zip(maps, input)])
+
+    def batched():
+        mask = foreground_mask(input)
+        maps = shift_to_foreground_min(gaussian_blur(anomaly_map, sigma=4) * mask) * mask
+        return masked_max(maps, mask)
+
+    for name, fn in [('per sample', per_sample), ('batched', batched)]:
+        start = perf_counter()
+        for _ in range(num_batches):
+            scores = fn().cpu()
+        print(f'{name:>10}: {(perf_counter() - start) / num_batches * 1000:.2f} ms/batch ({device})')
+    assert torch.allclose(per_sample().cpu(), scores, atol=1e-6)
+
+
+def get_config():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    nifti = subparsers.add_parser('nifti', help='full volume vs. slice range NIfTI reads')
+    nifti.add_argument('--sequence', '-seq', type=str, default='t2', choices=['t1', 't2'])
+    nifti.add_argument('--num_files', type=int, default=20, help='Number of CamCAN volumes')
+    nifti.add_argument('--slice_range', type=int, nargs='+', default=(0, 155),
+                       help='Lower and Upper slice index')
+
+    preprocessing = subparsers.add_parser('preprocessing', help='skimage vs. torch preprocessing backend')
+    preprocessing.add_argument('--sequence', '-seq', type=str, default='t2', choices=['t1', 't2'])
+    preprocessing.add_argument('--num_files', type=int, default=20, help='Number of CamCAN volumes')
+    preprocessing.add_argument('--image_size', type=int, default=128, help='Image size')
+    preprocessing.add_argument('--slice_range', type=int, nargs='+', default=(0, 155),
+                               help='Lower and Upper slice index')
+    preprocessing.add_argument('--normalize', type=str_to_bool, default=False)
+    preprocessing.add_argument('--equalize_histogram', type=str_to_bool, default=False)
+
+    segmentations = subparsers.add_parser('segmentations', help='memory of int64 vs. uint8 segmentations')
+    segmentations.add_argument('--sequence', '-seq', type=str, default='t2', choices=['t1', 't2'])
+    segmentations.add_argument('--image_size', type=int, default=128, help='Image size')
+    segmentations.add_argument('--slice_range', type=int, nargs='+', default=(0, 155),
+                               help='Lower and Upper slice index')
+
+    storage = subparsers.add_parser('storage', help='footprint and error of the storage dtypes')
+    storage.add_argument('--sequence', '-seq', type=str, default='t2', choices=['t1', 't2'])
+    storage.add_argument('--num_files', type=int, default=20, help='Number of CamCAN volumes')
+    storage.add_argument('--image_size', type=int, default=128, help='Image size')
+    storage.add_argument('--slice_range', type=int, nargs='+', default=(0, 155),
+                         help='Lower and Upper slice index')
+
+    loader = subparsers.add_parser('loader', help='per-sample vs. batched loading of in-memory datasets')
+    loader.add_argument('--num_slices', type=int, default=20000, help='Number of synthetic slices')
+    loader.add_argument('--image_size', type=int, default=128, help='Image size')
+    loader.add_argument('--batch_size', type=int, default=32, help='Batch size')
+    loader.add_argument('--num_workers', type=int, default=4, help='Number of workers')
+
+    pii = subparsers.add_parser('pii', help='poisson image interpolation time per sample')
+    pii.add_argument('--image_size', type=int, default=128, help='Image size')
+    pii.add_argument('--channels', type=int, default=1, help='Number of image channels')
+    pii.add_argument('--num_samples', type=int, default=256, help='Number of synthetic samples')
+    pii.add_argument('--batch_size', type=int, default=32, help='Batch size of pii_batch')
+
+    ccd = subparsers.add_parser('ccd_augmentation', help='per-image vs. batched CCD augmentations')
+    ccd.add_argument('--num_images', type=int, default=1024, help='Number of synthetic images')
+    ccd.add_argument('--image_size', type=int, default=128, help='Image size')
+    ccd.add_argument('--batch_size', type=int, default=32, help='Batch size')
+
+    metrics = subparsers.add_parser('metrics', help='sklearn vs. single-sort vs. streaming pixel metrics')
+    metrics.add_argument('--num_pixels', type=int, default=20000000, help='Number of synthetic pixels')
+    metrics.add_argument('--anomal_fraction', type=float, default=0.02, help='Fraction of anomalous pixels')
+    metrics.add_argument('--num_bins', type=int, default=10000, help='Histogram bins of PixelMetrics')
+
+    postprocessing = subparsers.add_parser('postprocessing', help='per-sample vs. batched anomaly map post-processing')
+    postprocessing.add_argument('--num_batches', type=int, default=100, help='Number of synthetic batches')
+    postprocessing.add_argument('--image_size', type=int, default=128, help='Image size')
+    postprocessing.add_argument('--batch_size', type=int, default=32, help='Batch size')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    config = get_config()
+
+    if config.benchmark == 'nifti':
+        files = get_camcan_files(Namespace(sequence=config.sequence))[:config.num_files]
+        benchmark_nifti_loading(files, config.slice_range)
+
+    elif config.benchmark == 'preprocessing':
+        files = get_camcan_files(Namespace(sequence=config.sequence))[:config.num_files]
+        benchmark_preprocessing(files, config.image_size, config.slice_range,
+                                config.normalize, config.equalize_histogram)
+
+    elif config.benchmark == 'segmentations':
+        _, seg_files = get_brats_files(Namespace(sequence=config.sequence))
+        benchmark_segmentations(seg_files, config.image_size, config.slice_range)
+
+    elif config.benchmark == 'storage':
+        files = get_camcan_files(Namespace(sequence=config.sequence))[:config.num_files]
+        benchmark_storage(files, config.image_size, config.slice_range)
+
+    elif config.benchmark == 'loader':
+        benchmark_loader(config.num_slices, config.image_size, config.batch_size, config.num_workers)
+
+    elif config.benchmark == 'pii':
+        benchmark_pii(config.image_size, config.channels, config.num_samples, config.batch_size)
+
+    elif config.benchmark == 'ccd_augmentation':
+        benchmark_ccd_augmentation(config.num_images, config.image_size, config.batch_size)
+
+    elif config.benchmark == 'metrics':
+        benchmark_metrics(config.num_pixels, config.anomal_fraction, config.num_bins)
+
+    elif config.benchmark == 'postprocessing':
+        benchmark_postprocessing(config.num_batches, config.image_size, config.batch_size)
@@ -0,0 +1,95 @@
+"""
+Batched color transforms of [B, 3, H, W] tensors in [0, 1], with random parameters per
+sample, used by the batch augmentation stages of CCD and CutPaste.
+"""
+from typing import Optional
+import torch
+from torch import Tensor
+
+
+def rgb_to_grayscale(img: Tensor) -> Tensor:
+    r, g, b = img.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def rgb_to_hsv(img: Tensor) -> Tensor:
+    # batched version of torchvision.transforms.functional_tensor._rgb2hsv
+    r, g, b = img.unbind(dim=-3)
+    maxc = torch.max(img, dim=-3).values
+    minc = torch.min(img, dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def hsv_to_rgb(img: Tensor) -> Tensor:
+    # batched version of torchvision.transforms.functional_tensor._hsv2rgb,
+    # selecting the sector of each pixel with gather instead of a one-hot einsum
+    h, s, v = img.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int64) % 6
+    p = torch.clamp((v * (1.0 - s)), 0.0, 1.0)
+    q = torch.clamp((v * (1.0 - s * f)), 0.0, 1.0)
+    t = torch.clamp((v * (1.0 - s * (1.0 - f))), 0.0, 1.0)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    i = i.unsqueeze(dim=-3)
+    return torch.cat([a.gather(-3, i) for a in (a1, a2, a3)], dim=-3)
+
+
+def _uniform(n: int, low: float, high: float, device) -> Tensor:
+    return low + (high - low) * torch.rand(n, device=device)
+
+
+def color_jitter(img: Tensor, brightness: float, contrast: float, saturation: float, hue: float,
+                 region: Optional[Tensor] = None) -> Tensor:
+    """
+    ColorJitter of torchvision with factors drawn per sample, brightness, contrast and
+    saturation from [1 - strength, 1 + strength] and hue from [-hue, hue]. The order of
+    the four operations is drawn per batch.
+
+    Args:
+        img (Tensor): images of shape [B, 3, H, W] in [0, 1]
+        region (Tensor): Optional. Boolean mask of shape [B, 1, H, W] of the pixels the
+                         contrast mean is computed over, the whole image by default
+    """
+    b = img.shape[0]
+    device = img.device
+
+    def factor(strength):
+        return _uniform(b, 1 - strength, 1 + strength, device).view(-1, 1, 1, 1)
+
+    for op in torch.randperm(4).tolist():
+        if op == 0:
+            img = (factor(brightness) * img).clamp(0, 1)
+        elif op == 1:
+            gray = rgb_to_grayscale(img)
+            if region is None:
+                mean = gray.mean(dim=(-3, -2, -1), keepdim=True)
+            else:
+                mean = (gray * region).sum(dim=(-3, -2, -1), keepdim=True) / \
+                    region.sum(dim=(-3, -2, -1), keepdim=True).clamp(min=1)
+            c = factor(contrast)
+            img = (c * img + (1 - c) * mean).clamp(0, 1)
+        elif op == 2:
+            s = factor(saturation)
+            img = (s * img + (1 - s) * rgb_to_grayscale(img)).clamp(0, 1)
+        else:
+            hsv = rgb_to_hsv(img)
+            shift = _uniform(b, -hue, hue, device).view(-1, 1, 1)
+            hsv = torch.stack(((hsv[:, 0] + shift) % 1.0, hsv[:, 1], hsv[:, 2]), dim=-3)
+            img = hsv_to_rgb(hsv)
+
+    return img
@@ -23,6 +23,19 @@ def common_config(parser):
     parser.add_argument('--eval', '-ev', type=str_to_bool, default=False, help='Evaluation mode')
     parser.add_argument('--no_dice', type=str_to_bool, default=False,
                         help='do not calculate dice (used to save inference time)')
+    parser.add_argument('--metric_bins', type=int, default=0,
+                        help='Histogram bins of the pixel-wise metrics, accumulated in constant memory, '
+                        '0 computes them exactly from all anomaly maps')
+    parser.add_argument('--anomaly_cache', '-ac', type=str_to_bool, default=False,
+                        help='Store the raw outputs of the model on the test set for --rescore')
+    parser.add_argument('--rescore', type=str_to_bool, default=False,
+                        help='Re-run post-processing and metrics on the outputs stored with --anomaly_cache, '
+                        'without inference')
+    parser.add_argument('--anomaly_cache_dir', type=str, default=None,
+                        help='Directory of the stored outputs, defaults to anomaly_cache in the method directory')
+    parser.add_argument('--anomaly_cache_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='dtype of the stored inputs and outputs, float16 halves the cache but rescoring '
+                        'no longer reproduces the evaluation exactly')
     parser.add_argument('--restoration', '-res', type=str_to_bool, default=False,
                         help='VAE restoration')
     # Data settings
@@ -35,7 +48,18 @@ def common_config(parser):
     parser.add_argument('--modality', '-mod', type=str, default='MRI', help='MRI sequence')
     parser.add_argument('--normal_split', '-ns', type=float, default=0.95, help='normal set split')
     parser.add_argument('--anomal_split', '-as', type=float, default=0.90, help='anomaly set split')
-    parser.add_argument('--num_workers', type=int, default=4, help='Number of workers')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='Number of workers, -1 to choose from the available cores and the dataset')
+    parser.add_argument('--pin_memory', type=str_to_bool, default=False, help='Pin batches when training on GPU')
+    parser.add_argument('--persistent_workers', type=str_to_bool, default=False,
+                        help='Keep dataloader workers alive between epochs')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches prefetched by each worker')
+    parser.add_argument('--log_data_time', type=str_to_bool, default=False,
+                        help='Print the time spent waiting for data vs. compute every log_frequency batches')
+    parser.add_argument('--batched_loading', type=str_to_bool, default=True,
+                        help='Read whole batches from in-memory datasets instead of single samples')
+    parser.add_argument('--dataset_manifest', type=str_to_bool, default=False,
+                        help='Find and read dataset files through the manifest in <dataset>/.manifest')
 
     # MRI specific settings
     parser.add_argument('--sequence', '-seq', type=str, default='t2',
@@ -48,16 +72,34 @@ def common_config(parser):
                         help='Normalize images to 98th percentile and scale to [0,1]')
     parser.add_argument('--equalize_histogram', type=str_to_bool,
                         default=False, help='Equalize histogram')
+    parser.add_argument('--preprocessing_backend', type=str, default='skimage', choices=['skimage', 'torch'],
+                        help='Backend for resizing, normalizing and equalizing MRI volumes')
+    parser.add_argument('--volume_cache', '-vc', type=str_to_bool, default=False,
+                        help='Cache preprocessed MRI volumes on disk and reuse them in later runs')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Volume cache directory, defaults to data/datasets/MRI/cache')
+    parser.add_argument('--storage_dtype', type=str, default='float32', choices=['float32', 'float16', 'uint8'],
+                        help='Precision of MRI slices kept in memory, uint8 is quantized with a per-volume scale')
+    parser.add_argument('--slice_store', '-ss', type=str_to_bool, default=False,
+                        help='Read MRI slices from a memory-mapped store in the cache directory')
 
     # CXR specific settings
     parser.add_argument('--sup_devices', type=str_to_bool, default=False,
                         help='Whether to include CXRs with support devices')
+    parser.add_argument('--image_shards', type=str_to_bool, default=True,
+                        help='Read pre-resized images from shards packed with image_shards.py, if available')
     parser.add_argument('--AP_only', type=str_to_bool, default=True, help='Whether to include only AP CXRs')
     parser.add_argument('--pathology', type=str, default='effusion',
                         help='Pathology of test set.', choices=['enlarged', 'effusion', 'opacity'])
     parser.add_argument('--sex', type=str, default='both',
                         help='Sex of patients', choices=['male', 'female', 'both'])
 
+    # PII settings
+    parser.add_argument('--pii_bank', type=str_to_bool, default=False,
+                        help='Sample PII anomalies from a bank generated with anomaly_bank.py, if available')
+    parser.add_argument('--pii_bank_fraction', type=float, default=1.,
+                        help='Fraction of PII anomalies sampled from the bank, the rest are generated online')
+
     # Logging settings
     parser.add_argument('--name_add', '-nam', type=str, default='', help='option to add to the name string')
     parser.add_argument('--log_frequency', '-lf', type=int, default=200, help='logging frequency')
@@ -1,67 +1,126 @@
-from typing import Callable
+from typing import Callable, Iterator, Optional, Tuple
 import torch
-from UPD_study.utilities.utils import metrics, log
+from UPD_study.utilities.utils import metrics, log, get_pixel_metrics, target_labels, to_uint8_mask
+from UPD_study.utilities.anomaly_cache import (AnomalyCache, AnomalyCacheWriter, CacheSteps, cache_path,
+                                               check_scores)
 from argparse import Namespace
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 
-def evaluate(config: Namespace, test_loader: DataLoader, val_step: Callable) -> None:
+def _test_outputs(config: Namespace, test_loader: Optional[DataLoader], val_step: Callable,
+                  cache_steps: Optional[CacheSteps],
+                  path: Optional[str]) -> Iterator[Tuple[torch.Tensor, torch.Tensor, tuple]]:
+    """
+    Yields the input, target and val_step outputs of every batch of the test set, either from
+    inference, storing the raw outputs of the model in the cache at path with --anomaly_cache,
+    or from the raw outputs stored before with --rescore, without the test_loader.
+    """
+    if path is not None and config.rescore:
+        assert AnomalyCache.exists(path), f'No cached outputs in {path}, evaluate with --anomaly_cache first'
+        cache = AnomalyCache(path)
+        print(f'Rescoring {len(cache)} samples cached in {path}')
+        # same batches as the test_loader of the evaluation with inference
+        for input, target, outputs in cache.batches(config.batch_size):
+            input = input.to(config.device)
+            yield input, target, cache_steps.postprocess_step(input, outputs.to(config.device))
+        return
+
+    writer = AnomalyCacheWriter(path, len(test_loader.dataset), config.anomaly_cache_dtype) \
+        if path is not None else None
+    for input, target in tqdm(test_loader, desc="Test set", disable=config.speed_benchmark):
+        input = input.to(config.device)
+        if writer is None:
+            yield input, target, val_step(input, test_samples=True)
+        else:
+            outputs = cache_steps.inference_step(input)
+            writer.append(input, outputs, target)
+            yield input, target, cache_steps.postprocess_step(input, outputs)
+
+    if writer is not None:
+        writer.commit()
+        print(f'Cached the outputs of the model in {path}')
+
+
+def evaluate(config: Namespace, test_loader: DataLoader, val_step: Callable,
+             cache_steps: Optional[CacheSteps] = None) -> None:
     """
     Common evaluation method. Handles inference on evaluation set, metric calculation,
     logging and the speed benchmark.
 
     Args:
         config (Namespace): configuration object.
-        test_loader (DataLoader): evaluation set dataloader
+        test_loader (DataLoader): evaluation set dataloader, None when rescoring cached outputs
         val_step (Callable): validation step function
+        cache_steps (CacheSteps): Optional. val_step split into inference and post-processing,
+                                  required for --anomaly_cache and --rescore
     """
 
+    # only evaluation of a saved checkpoint is cached, not the evaluations during training
+    path = None
+    if 'anomaly_cache' in config and config.eval and (config.anomaly_cache or config.rescore):
+        assert cache_steps is not None, f'{config.method} does not support --anomaly_cache and --rescore'
+        path = cache_path(config, cache_steps.inference_keys)
+
     labels = []
     anomaly_scores = []
     anomaly_maps = []
-    inputs = []
     segmentations = []
+    # with --metric_bins, pixel-wise metrics are accumulated batch by batch, in constant memory,
+    # instead of storing the anomaly maps
+    pixel_metrics = get_pixel_metrics(config)
 
     # forward pass the testloader to extract anomaly maps, scores, masks, labels
-    for input, mask in tqdm(test_loader, desc="Test set", disable=config.speed_benchmark):
-        input = input.to(config.device)
-        output = val_step(input, test_samples=True)
+    # image-level datasets (CXR) yield per-sample labels instead of segmentation masks,
+    # in which case no pixel-wise metrics are accumulated
+    first_batch = None
+    for input, target, output in _test_outputs(config, test_loader, val_step, cache_steps, path):
+        if first_batch is None:
+            first_batch = input, target, output
 
         anomaly_map, anomaly_score = output[:2]
-        inputs.append(input.cpu())
 
-        if config.method == 'Cutpaste' and config.localization:
-            anomaly_maps.append(anomaly_map.cpu())
-            segmentations.append(mask)
+        label = target_labels(target)
+        labels.append(label)
+
+        if target.dim() > 1 and not (config.method == 'Cutpaste' and not config.localization):
+            if pixel_metrics is not None:
+                pixel_metrics.update(anomaly_map, target)
+            else:
+                anomaly_maps.append(anomaly_map.cpu())
+                segmentations.append(to_uint8_mask(target))
 
-            label = torch.where(mask.sum(dim=(1, 2, 3)) > 0, 1, 0)
-            labels.append(label)
+        if config.method == 'Cutpaste' and config.localization:
             anomaly_scores.append(torch.zeros_like(label))
-        elif config.method == 'Cutpaste' and not config.localization:
-            segmentations = None
-            anomaly_scores.append(anomaly_score.cpu())
-            label = torch.where(mask.sum(dim=(1, 2, 3)) > 0, 1, 0)
-            labels.append(label)
         else:
-            anomaly_maps.append(anomaly_map.cpu())
-            segmentations.append(mask)
             anomaly_scores.append(anomaly_score.cpu())
-            label = torch.where(mask.sum(dim=(1, 2, 3)) > 0, 1, 0)
-            labels.append(label)
 
-    metrics(config, anomaly_maps, segmentations, anomaly_scores, labels)
+    # without pixel-level targets, there are no pixel-wise metrics
+    if pixel_metrics is not None and pixel_metrics.counts is None:
+        pixel_metrics = None
+    results = {}
+    metrics(config, anomaly_maps or None, segmentations or None, anomaly_scores, labels,
+            pixel_metrics=pixel_metrics, results=results)
+
+    # record the metrics of the cached outputs, or check that rescoring reproduces them
+    if path is not None:
+        check_scores(config, path, results)
 
     # do a single forward pass to extract images to log
     # the batch size is num_images_log for test_loaders, so only a single forward pass necessary
-    input, mask = next(iter(test_loader))
-    output = val_step(input.to(config.device), test_samples=True)
+    # when rescoring, the images are taken from the first cached batch instead
+    if 'rescore' in config and config.rescore:
+        input, target, output = first_batch
+    else:
+        input, target = next(iter(test_loader))
+        output = val_step(input.to(config.device), test_samples=True)
 
     anomaly_maps = output[0]
 
     log({'anom_val/input images': input,
-        'anom_val/targets': mask,
          'anom_val/anomaly maps': anomaly_maps}, config)
+    if target.dim() > 1:
+        log({'anom_val/targets': target}, config)
 
     # if recon based method, len(x)==3 because val_step returns reconstructions.
     # if thats the case log the reconstructions
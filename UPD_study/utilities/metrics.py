@@ -1,11 +1,121 @@
 """
 Author: Felix Meissen - https://github.com/FeliMe
 """
-from functools import partial
-from multiprocessing import Pool
-from typing import Tuple
+import warnings
+from typing import Dict, Optional, Tuple
 import numpy as np
-from sklearn.metrics import average_precision_score, roc_auc_score, roc_curve
+import torch
+
+
+def _is_binary(targets) -> bool:
+    """Check that targets are 0 or 1, without upcasting integer or boolean targets"""
+    if targets.dtype in (torch.bool, torch.uint8):
+        return targets.numel() == 0 or bool(targets.max() <= 1)
+    return not bool(((targets != 0) & (targets != 1)).any())
+
+
+class BinaryCurve():
+    """
+    Exact classification curve of binary targets ranked by predictions, from a single sort.
+
+    For every distinct prediction, in decreasing order, thresholds[i] is the prediction and
+    tps[i], fps[i] are the numbers of positives and negatives predicted >= thresholds[i],
+    as in sklearn's _binary_clf_curve. AP, AUROC, the threshold at a given FPR and Dice
+    scores at any threshold are all derived from these cumulative counts. The sort and the
+    cumulative sums run in torch, on all intra-op threads.
+    """
+
+    def __init__(self, predictions, targets):
+        """
+        Args:
+            predictions (torch.Tensor or np.ndarray): anomaly scores
+            targets (torch.Tensor or np.ndarray): segmentation map or target label, must be binary
+        """
+        predictions = torch.as_tensor(predictions).reshape(-1)
+        targets = torch.as_tensor(targets).reshape(-1)
+        if not _is_binary(targets):
+            raise RuntimeError("targets must be binary")
+
+        # dtype in which thresholds are compared to the predictions
+        self.dtype = predictions[:0].numpy().dtype
+        predictions, order = torch.sort(predictions, descending=True)
+        tps = torch.cumsum(targets[order], 0, dtype=torch.int64)
+        del order
+
+        # last index of every run of equal predictions
+        idx = torch.nonzero(predictions[1:] != predictions[:-1]).reshape(-1)
+        idx = torch.cat([idx, torch.tensor([predictions.numel() - 1])])
+
+        self.thresholds = predictions[idx].double().numpy()
+        self.tps = tps[idx].double().numpy()
+        self.fps = (idx + 1).double().numpy() - self.tps
+        self.num_pos = self.tps[-1]
+        self.num_neg = self.fps[-1]
+
+    def average_precision(self) -> float:
+        """Average precision, identical to sklearn's average_precision_score, nan without positives"""
+        if self.num_pos == 0:
+            warnings.warn("No positive class found in y_true, average precision is not defined "
+                          "in that case")
+            return float('nan')
+        precision = self.tps / (self.tps + self.fps)
+        recall_steps = np.diff(self.tps, prepend=0) / self.num_pos
+        return float(np.sum(recall_steps * precision))
+
+    def roc(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """fpr, tpr and thresholds, identical to sklearn's roc_curve (drop_intermediate=True)"""
+        tps, fps, thresholds = self.tps, self.fps, self.thresholds
+        # keep the corners of the curve only
+        keep = np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True]
+        tps, fps, thresholds = tps[keep], fps[keep], thresholds[keep]
+        # start the curve at (0, 0)
+        tps, fps = np.r_[0, tps], np.r_[0, fps]
+        thresholds = np.r_[thresholds[0] + 1, thresholds]
+        return fps / self.num_neg, tps / self.num_pos, thresholds
+
+    def auroc(self) -> float:
+        """Area under the ROC curve, identical to sklearn's roc_auc_score"""
+        if self.num_pos == 0 or self.num_neg == 0:
+            raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
+        fpr = np.r_[0, self.fps / self.num_neg]
+        tpr = np.r_[0, self.tps / self.num_pos]
+        # trapezoidal rule
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def threshold_at_fpr(self, max_fpr: float = 0.05) -> float:
+        """Threshold of the last point of the ROC curve with an FPR of at most max_fpr"""
+        fpr, _, thresholds = self.roc()
+        return thresholds[max(0, fpr.searchsorted(max_fpr, 'right') - 1)]
+
+    def dice_above(self, threshold: float) -> float:
+        """Dice score of predicting every sample with a prediction > threshold positive"""
+        # number of distinct predictions above threshold
+        above = np.searchsorted(-self.thresholds, -threshold, 'left')
+        if above == 0:
+            return 0.
+        tp, fp = self.tps[above - 1], self.fps[above - 1]
+        return float(2 * tp / (tp + fp + self.num_pos))
+
+    def best_dice(self, n_thresh: Optional[int] = None) -> Tuple[float, float]:
+        """
+        Best Dice score and its threshold, such that predicting every sample with a
+        prediction > threshold positive reaches it. Over all distinct thresholds, or over
+        n_thresh thresholds evenly spaced from the highest to the lowest prediction.
+        """
+        if n_thresh is not None:
+            thresholds = np.linspace(self.thresholds[0], self.thresholds[-1], n_thresh)
+            # number of distinct predictions above each threshold
+            above = np.searchsorted(-self.thresholds, -thresholds.astype(self.dtype), 'left')
+            tp, fp = np.r_[0, self.tps][above], np.r_[0, self.fps][above]
+            dice = 2 * tp / (tp + fp + self.num_pos)
+            best = dice.argmax()
+            return float(dice[best]), float(thresholds[best])
+
+        dice = 2 * self.tps / (self.tps + self.fps + self.num_pos)
+        best = dice.argmax()
+        # the next lower prediction, so that "> threshold" includes thresholds[best]
+        threshold = self.thresholds[best + 1] if best + 1 < len(self.thresholds) else -np.inf
+        return float(dice[best]), float(threshold)
 
 
 def compute_average_precision(predictions, targets):
@@ -15,10 +125,7 @@ def compute_average_precision(predictions, targets):
         predictions (torch.Tensor): Anomaly scores
         targets (torch.Tensor): Segmentation map or target label, must be binary
     """
-    if (targets - targets.int()).sum() > 0.:
-        raise RuntimeError("targets for AP must be binary")
-    ap = average_precision_score(targets.reshape(-1), predictions.reshape(-1))
-    return ap
+    return BinaryCurve(predictions, targets).average_precision()
 
 
 def compute_auroc(predictions, targets) -> float:
@@ -28,10 +135,7 @@ def compute_auroc(predictions, targets) -> float:
         predictions (torch.Tensor): Anomaly scores
         targets (torch.Tensor): Segmentation map or target label, must be binary
     """
-    if (targets - targets.int()).sum() > 0.:
-        raise RuntimeError("targets for AUROC must be binary")
-    auc = roc_auc_score(targets.reshape(-1), predictions.reshape(-1))
-    return auc
+    return BinaryCurve(predictions, targets).auroc()
 
 
 def compute_dice(preds: np.ndarray, targets: np.ndarray) -> float:
@@ -40,19 +144,20 @@ def compute_dice(preds: np.ndarray, targets: np.ndarray) -> float:
 
     dice = 2 * TP / (2 * TP + FP + FN)
 
-    :param preds: An array of predicted anomaly scores.
-    :param targets: An array of ground truth labels.
+    :param preds: An array of binary predictions (bool, uint8 or any 0/1 array).
+    :param targets: An array of ground truth labels (bool, uint8 or any 0/1 array).
     """
-    preds, targets = np.array(preds), np.array(targets)
+    preds, targets = np.asarray(preds), np.asarray(targets)
 
     # Check if predictions and targets are binary
-    if not np.all(np.logical_or(preds == 0, preds == 1)):
+    if preds.dtype != bool and not np.all(np.logical_or(preds == 0, preds == 1)):
         raise ValueError('Predictions must be binary')
-    if not np.all(np.logical_or(targets == 0, targets == 1)):
+    if targets.dtype != bool and not np.all(np.logical_or(targets == 0, targets == 1)):
         raise ValueError('Targets must be binary')
 
-    # Compute Dice
-    dice = 2 * np.sum(preds[targets == 1]) / \
+    # Compute Dice on boolean masks
+    preds, targets = preds.astype(bool, copy=False), targets.astype(bool, copy=False)
+    dice = 2 * np.sum(preds & targets) / \
         (np.sum(preds) + np.sum(targets))
 
     return dice
@@ -66,16 +171,9 @@ def compute_dice_at_nfpr(preds: np.ndarray, targets: np.ndarray,
     :param preds: An array of predicted anomaly scores.
     :param targets: An array of ground truth labels.
     :param max_fpr: Maximum false positive rate.
-    :param n_threshs: Maximum number of thresholds to check.
     """
-    preds, targets = np.array(preds), np.array(targets)
-
-    # Find threshold for 5% FPR
-    fpr, _, thresholds = roc_curve(targets.reshape(-1), preds.reshape(-1))
-    t = thresholds[max(0, fpr.searchsorted(max_fpr, 'right') - 1)]
-
-    # Compute Dice
-    return compute_dice(np.where(preds > t, 1, 0), targets)
+    curve = BinaryCurve(preds, targets)
+    return curve.dice_above(curve.threshold_at_fpr(max_fpr))
 
 
 def compute_thresh_at_nfpr(preds: np.ndarray, targets: np.ndarray,
@@ -87,40 +185,141 @@ def compute_thresh_at_nfpr(preds: np.ndarray, targets: np.ndarray,
     :param targets: An array of ground truth labels.
     :param max_fpr: Maximum false positive rate.
     """
-    preds, targets = np.array(preds), np.array(targets)
-
-    # Find threshold for 5% FPR
-    fpr, _, thresholds = roc_curve(targets.reshape(-1), preds.reshape(-1))
-    t = thresholds[max(0, fpr.searchsorted(max_fpr, 'right') - 1)]
-
-    # Return threshold
-    return t
+    return BinaryCurve(preds, targets).threshold_at_fpr(max_fpr)
 
 
 def compute_best_dice(preds: np.ndarray, targets: np.ndarray,
-                      n_thresh: float = 100,
-                      num_processes: int = 4) -> Tuple[float, float]:
+                      n_thresh: Optional[int] = 100) -> Tuple[float, float]:
     """
     Compute the best dice score for n_thresh thresholds.
 
     :param predictions: An array of predicted anomaly scores.
     :param targets: An array of ground truth labels.
-    :param n_thresh: Number of thresholds to check.
+    :param n_thresh: Number of thresholds to check, None for all distinct thresholds.
+    :return: The best dice score and its threshold, predictions > threshold are positive.
+    """
+    return BinaryCurve(preds, targets).best_dice(n_thresh)
+
+
+class PixelMetrics():
+    """
+    Streaming pixel-wise AP, AUROC and best Dice with bounded memory.
+
+    Each batch of anomaly maps and segmentations is reduced to two histograms of fixed
+    resolution, of the scores of positive and of negative pixels, so the state is
+    2 * num_bins counts regardless of the size of the evaluation set. The range of the
+    histograms starts at the scores of the first batch and is doubled (merging pairs of
+    bins) whenever a batch falls outside of it, so its bins are at most 4x wider than
+    num_bins bins over the final score range.
+
+    The metrics are exact up to the order of the pixels within a bin, which the histograms
+    lose. error_bounds() returns the largest possible deviation from the metrics computed on
+    the raw scores (each is 0 when every bin holds only positives or only negatives):
+        AUROC: half the fraction of (positive, negative) pairs that share a bin
+        AP: sum over the positives of the range of precisions they can have within their bin
+        best Dice: the highest Dice any threshold within a bin can reach, minus best_dice()
     """
-    preds, targets = np.array(preds), np.array(targets)
 
-    thresholds = np.linspace(preds.max(), preds.min(), n_thresh)
+    def __init__(self, num_bins: int = 10000):
+        """
+        Args:
+            num_bins (int): number of histogram bins, must be even
+        """
+        assert num_bins % 2 == 0, "num_bins must be even"
+        self.num_bins = num_bins
+        self.counts = None  # [2, num_bins], row 0 negatives, row 1 positives
+        self.low = None
+        self.width = None
+
+    def _extend(self, mini: float, maxi: float) -> None:
+        # double the range until it covers [mini, maxi], bin edges stay aligned
+        n = self.num_bins
+        while mini < self.low or maxi > self.low + n * self.width:
+            merged = self.counts.view(2, n // 2, 2).sum(-1)
+            zeros = torch.zeros_like(merged)
+            if mini < self.low:
+                self.counts = torch.cat([zeros, merged], dim=1)
+                self.low -= n * self.width
+            else:
+                self.counts = torch.cat([merged, zeros], dim=1)
+            self.width *= 2
+
+    def update(self, anomaly_maps: torch.Tensor, segmentations: torch.Tensor) -> None:
+        """
+        Add a batch to the histograms.
+        Args:
+            anomaly_maps (torch.Tensor): anomaly scores of shape [b,c,h,w]
+            segmentations (torch.Tensor): binary segmentations of the same shape
+        """
+        if not _is_binary(segmentations):
+            raise RuntimeError("segmentations must be binary")
+        scores = anomaly_maps.reshape(-1).float()
+        targets = segmentations.reshape(-1).to(scores.device, torch.long)
+        if scores.numel() == 0:
+            return
+        mini, maxi = scores.min().item(), scores.max().item()
+
+        if self.counts is None:
+            self.low = mini
+            self.width = (maxi - mini) / self.num_bins
+            if self.width == 0:
+                self.width = max(abs(mini), 1.) * 2 ** -20 / self.num_bins
+            self.counts = torch.zeros(2, self.num_bins, dtype=torch.long, device=scores.device)
+        else:
+            self._extend(mini, maxi)
+
+        bins = ((scores - self.low) / self.width).long().clamp_(0, self.num_bins - 1)
+        self.counts += torch.bincount(bins + targets * self.num_bins,
+                                      minlength=2 * self.num_bins).view(2, -1).to(self.counts.device)
+
+    def _curve(self) -> Tuple[np.ndarray, ...]:
+        # counts and cumulative counts over the bins in order of decreasing score
+        if self.counts is None:
+            raise RuntimeError("no pixels were added")
+        neg, pos = self.counts.cpu().numpy().astype(np.float64)[:, ::-1]
+        tp, fp = np.cumsum(pos), np.cumsum(neg)
+        return pos, neg, tp, fp, tp - pos, fp - neg
+
+    def average_precision(self) -> float:
+        pos, neg, tp, fp, _, _ = self._curve()
+        if tp[-1] == 0:
+            warnings.warn("No positive class found in y_true, average precision is not defined "
+                          "in that case")
+            return float('nan')
+        hit = pos > 0
+        return float(np.sum(pos[hit] * tp[hit] / (tp[hit] + fp[hit])) / tp[-1])
+
+    def auroc(self) -> float:
+        pos, neg, tp, fp, tp_prev, _ = self._curve()
+        if tp[-1] == 0 or fp[-1] == 0:
+            raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
+        return float(np.sum(neg * (tp_prev + pos / 2)) / (tp[-1] * fp[-1]))
+
+    def best_dice(self) -> Tuple[float, float]:
+        """
+        Best Dice score over the thresholds at the bin edges, and its threshold.
+        Pixels with scores above the threshold are predicted anomalous.
+        """
+        _, _, tp, fp, _, _ = self._curve()
+        dice = 2 * tp / (tp + fp + tp[-1])
+        best = dice.argmax()
+        # lower edge of the lowest bin predicted anomalous
+        threshold = self.low + (self.num_bins - 1 - best) * self.width
+        return float(dice[best]), float(threshold)
+
+    def error_bounds(self) -> Dict[str, float]:
+        """Largest deviation of each metric from its value on the raw scores"""
+        pos, neg, tp, fp, tp_prev, fp_prev = self._curve()
+        num_pos = tp[-1]
+        hit = pos > 0
 
-    with Pool(num_processes) as pool:
-        fn = partial(_dice_multiprocessing, preds, targets)
-        scores = pool.map(fn, thresholds)
+        precision = tp[hit] / (tp[hit] + fp[hit])
+        highest = tp[hit] / (tp[hit] + fp_prev[hit])
+        lowest = (tp_prev[hit] + 1) / (tp_prev[hit] + 1 + fp[hit])
+        ap_bound = np.sum(pos[hit] * np.maximum(highest - precision, precision - lowest)) / num_pos
 
-    scores = np.stack(scores, 0)
-    max_dice = scores.max()
-    max_thresh = thresholds[scores.argmax()]
-    return max_dice, max_thresh
+        auroc_bound = np.sum(pos * neg) / (2 * num_pos * fp[-1])
 
+        dice_bound = np.max(2 * tp / (tp + fp_prev + num_pos)) - self.best_dice()[0]
 
-def _dice_multiprocessing(preds: np.ndarray, targets: np.ndarray,
-                          threshold: float) -> float:
-    return compute_dice(np.where(preds > threshold, 1, 0), targets)
+        return {'ap': float(ap_bound), 'auroc': float(auroc_bound), 'dice': float(dice_bound)}
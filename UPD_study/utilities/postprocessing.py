@@ -0,0 +1,113 @@
+"""
+Batched post-processing of anomaly maps, shared by the val_steps of all methods.
+
+Every function reduces the whole batch with tensor operations on the device of its inputs,
+and returns the same values as the per-sample loops it replaces, e.g.
+foreground_mask(input) == torch.stack([inp > inp.min() for inp in input]) and
+masked_max(anomaly_map, mask) == [map[msk].max() for map, msk in zip(anomaly_map, mask)].
+gaussian_blur(maps, sigma) smooths the maps like scipy.ndimage.gaussian_filter applied to
+every sample. Use `python UPD_study/utilities/benchmarks.py postprocessing` for the per-batch overhead.
+"""
+from functools import lru_cache
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+
+def _per_sample(values: Tensor, like: Tensor) -> Tensor:
+    # reshape per-sample values of shape [b] to broadcast against a batch like [b,c,h,w]
+    return values.view(-1, *[1] * (like.dim() - 1))
+
+
+def foreground_mask(input: Tensor, first_channel: bool = False) -> Tensor:
+    """
+    Mask of the pixels above the minimum of their sample, e.g. the brain in MRI slices.
+    Args:
+        input (Tensor): batch of shape [b,c,h,w]
+        first_channel (bool): mask from the first channel only, of shape [b,1,h,w]
+    Returns:
+        mask (Tensor): boolean mask of shape [b,c,h,w], or [b,1,h,w] if first_channel
+    """
+    if first_channel:
+        input = input[:, :1]
+    return input > _per_sample(input.flatten(1).amin(1), input)
+
+
+def masked_max(maps: Tensor, mask: Tensor) -> Tensor:
+    """Maximum of every map within its mask, of shape [b]. -inf for empty masks."""
+    return maps.masked_fill(~mask, float('-inf')).flatten(1).amax(1)
+
+
+def masked_mean(maps: Tensor, mask: Tensor) -> Tensor:
+    """Mean of every map within its mask, of shape [b]. nan for empty masks."""
+    mask = mask.expand_as(maps)
+    return (maps * mask).flatten(1).sum(1) / mask.flatten(1).sum(1)
+
+
+def masked_quantile(maps: Tensor, mask: Tensor, q: float) -> Tensor:
+    """q-th quantile of every map within its mask, of shape [b]. nan for empty masks."""
+    values = maps.masked_fill(~mask, float('nan')).flatten(1)
+    return torch.nanquantile(values.float(), q, dim=1).to(maps.dtype)
+
+
+def sample_max(maps: Tensor) -> Tensor:
+    """Maximum of every map, of shape [b]"""
+    return maps.flatten(1).amax(1)
+
+
+def sample_mean(maps: Tensor) -> Tensor:
+    """Mean of every map, of shape [b]"""
+    return maps.flatten(1).mean(1)
+
+
+def shift_to_foreground_min(maps: Tensor) -> Tensor:
+    """
+    Subtract from every map the smallest of its values above its minimum, the lowest value
+    within the foreground of maps masked with foreground_mask().
+    """
+    mins = maps.flatten(1).amin(1)
+    above_min = maps.masked_fill(maps <= _per_sample(mins, maps), float('inf'))
+    return maps - _per_sample(above_min.flatten(1).amin(1), maps)
+
+
+@lru_cache(maxsize=None)
+def _gaussian_kernel(sigma: float, truncate: float, device: torch.device, dtype: torch.dtype) -> Tensor:
+    # the kernel of scipy.ndimage.gaussian_filter1d, of shape [1,1,2*radius+1]
+    radius = int(truncate * sigma + 0.5)
+    x = torch.arange(-radius, radius + 1, dtype=torch.float64)
+    kernel = torch.exp(-0.5 / sigma ** 2 * x ** 2)
+    return (kernel / kernel.sum()).to(device=device, dtype=dtype).view(1, 1, -1)
+
+
+def _reflect_indices(size: int, radius: int, device: torch.device) -> Tensor:
+    # indices of an axis of length size padded by radius in scipy's 'reflect' mode (d c b a | a b c d | d c b a),
+    # valid for radii larger than the axis as well
+    idx = torch.arange(-radius, size + radius, device=device) % (2 * size)
+    return torch.where(idx >= size, 2 * size - 1 - idx, idx)
+
+
+def gaussian_blur(maps: Tensor, sigma: float, truncate: float = 4.0) -> Tensor:
+    """
+    Separable gaussian smoothing of every sample in a batch, on the device of maps.
+    Equivalent to scipy.ndimage.gaussian_filter(map, sigma, mode='reflect', truncate=truncate)
+    for every map, i.e. all axes but the batch axis are smoothed, channels included.
+    Args:
+        maps (Tensor): batch of shape [b,c,h,w]
+        sigma (float): standard deviation of the gaussian kernel
+        truncate (float): truncate the kernel at this many standard deviations
+    Returns:
+        maps (Tensor): smoothed batch of shape [b,c,h,w]
+    """
+    if sigma <= 1e-15:
+        return maps
+    kernel = _gaussian_kernel(float(sigma), float(truncate), maps.device, maps.dtype)
+    radius = kernel.shape[-1] // 2
+    for dim in range(1, maps.dim()):
+        size = maps.shape[dim]
+        if size == 1 or radius == 0:
+            # reflecting a single value leaves it unchanged
+            continue
+        padded = maps.index_select(dim, _reflect_indices(size, radius, maps.device)).movedim(dim, -1)
+        smoothed = F.conv1d(padded.reshape(-1, 1, padded.shape[-1]), kernel)
+        maps = smoothed.view(*padded.shape[:-1], size).movedim(-1, dim)
+    return maps
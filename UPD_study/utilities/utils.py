@@ -3,10 +3,10 @@ import torch.multiprocessing
 torch.multiprocessing.set_sharing_strategy('file_system')
 import numpy as np
 import torch
-from time import time
+from time import time, perf_counter
 from argparse import Namespace
-from torch.utils.data import DataLoader, Dataset
-from typing import Union, Tuple, Dict, Callable
+from torch.utils.data import DataLoader, Dataset, BatchSampler, RandomSampler, SequentialSampler
+from typing import Union, Tuple, Dict, Callable, List, Optional
 from torch import Tensor
 import random
 import wandb
@@ -15,10 +15,7 @@ import torchgeometry as tgm
 from torch import nn
 import torch
 from UPD_study import ROOT
-from UPD_study.utilities.metrics import (
-    compute_average_precision,
-    compute_auroc, compute_best_dice
-)
+from UPD_study.utilities.metrics import BinaryCurve, PixelMetrics
 from tqdm import tqdm
 
 
@@ -175,56 +172,57 @@ def save_model(model: Union[nn.Module, Dict[str, nn.Module]], config: Namespace)
         torch.save(model.state_dict(), f'{save_path}/{config.modality}/{config.name}_.pth')
 
 
-def load_model(config: Namespace) -> Tuple[nn.Module, ...]:
+def checkpoint_paths(config: Namespace) -> List[str]:
     """
-    Handles model loading for every method.
+    Paths of the saved weights loaded by load_model() for every method.
 
     Args:
         config (Namespace): configuration object.
     Returns:
-        nn.Module model instances for every method, loaded with saved weights
+        paths of the saved weights, in the order load_model() returns them
     """
 
-    save_path = os.path.join(config.model_dir_path, 'saved_models')
+    save_path = os.path.join(config.model_dir_path, 'saved_models', config.modality)
 
     if config.method == 'RD':
-
-        load_dec = torch.load(f'{save_path}/{config.modality}/{config.name}_dec_.pth')
-        load_bn = torch.load(f'{save_path}/{config.modality}/{config.name}_bn_.pth')
-        return load_dec, load_bn
+        names = [f'{config.name}_dec_.pth', f'{config.name}_bn_.pth']
 
     elif config.method == 'AMCons':
-
-        load_enc = torch.load(f'{save_path}/{config.modality}/{config.name}_enc_.pth')
-        load_dec = torch.load(f'{save_path}/{config.modality}/{config.name}_dec_.pth')
-        return load_enc, load_dec
+        names = [f'{config.name}_enc_.pth', f'{config.name}_dec_.pth']
 
     elif config.method == 'f-anoGAN':
 
         if config.modality in ['CXR', 'RF']:
-            generator_name = f'f-anoGAN_{config.modality}__seed:10_netG.pth'
-            discriminator_name = f'f-anoGAN_{config.modality}__seed:10_netD.pth'
+            names = [f'f-anoGAN_{config.modality}__seed:10_netG.pth',
+                     f'f-anoGAN_{config.modality}__seed:10_netD.pth']
         elif config.modality == 'MRI':
-            generator_name = f'f-anoGAN_{config.modality}_{config.sequence}__seed:10_netG.pth'
-            discriminator_name = f'f-anoGAN_{config.modality}_{config.sequence}__seed:10_netD.pth'
-
-        load_g = torch.load(os.path.join(save_path,
-                                         config.modality,
-                                         generator_name))
-
-        load_d = torch.load(os.path.join(save_path,
-                                         config.modality,
-                                         discriminator_name))
-        if config.eval:
-            load_e = torch.load(f'{save_path}/{config.modality}/{config.name}_netE.pth')
-            return load_g, load_d, load_e
+            names = [f'f-anoGAN_{config.modality}_{config.sequence}__seed:10_netG.pth',
+                     f'f-anoGAN_{config.modality}_{config.sequence}__seed:10_netD.pth']
 
         # for the 2 run scenario where wgan is already trained and we want to train encoder
-        else:
-            return load_g, load_d
+        # only generator and discriminator are loaded
+        if config.eval:
+            names.append(f'{config.name}_netE.pth')
 
     else:
-        return torch.load(f'{save_path}/{config.modality}/{config.name}_.pth')
+        names = [f'{config.name}_.pth']
+
+    return [os.path.join(save_path, name) for name in names]
+
+
+def load_model(config: Namespace) -> Tuple[nn.Module, ...]:
+    """
+    Handles model loading for every method.
+
+    Args:
+        config (Namespace): configuration object.
+    Returns:
+        nn.Module model instances for every method, loaded with saved weights
+    """
+    state_dicts = [torch.load(path) for path in checkpoint_paths(config)]
+    if len(state_dicts) == 1:
+        return state_dicts[0]
+    return tuple(state_dicts)
 
 
 def misc_settings(config: Namespace) -> None:
@@ -256,6 +254,10 @@ def misc_settings(config: Namespace) -> None:
         config.batch_size = 1
         config.num_images_log = config.batch_size
 
+    # rescoring evaluates the stored outputs of a saved model
+    if 'rescore' in config and config.rescore:
+        config.eval = True
+
     if not config.eval:
         config.no_dice = True
 
@@ -344,57 +346,125 @@ def ssim_map(batch1: Tensor, batch2: Tensor) -> torch.Tensor:
     return anomaly_map
 
 
+def to_uint8_mask(mask: Tensor) -> Tensor:
+    """
+    Convert a binary segmentation batch of any dtype to uint8, 1 byte per pixel,
+    so that accumulating the masks of the evaluation set stays compact.
+    """
+    if mask.dtype == torch.uint8:
+        return mask
+    if ((mask != 0) & (mask != 1)).any():
+        raise RuntimeError("segmentations must be binary")
+    return mask.to(torch.uint8)
+
+
+def target_labels(target: Tensor) -> Tensor:
+    """
+    Per-sample anomaly labels of a test batch target, which is either a label tensor of
+    shape [b] (image-level datasets) or a segmentation tensor of shape [b,c,h,w].
+    """
+    if target.dim() == 1:
+        return target.long()
+    return torch.where(target.sum(dim=(1, 2, 3)) > 0, 1, 0)
+
+
+def get_pixel_metrics(config: Namespace) -> Optional[PixelMetrics]:
+    """
+    Streaming pixel-wise metrics with the resolution given by config.metric_bins,
+    or None if they are computed exactly from the stored anomaly maps (metric_bins 0).
+    """
+    if 'metric_bins' not in config or config.metric_bins == 0:
+        return None
+    return PixelMetrics(config.metric_bins)
+
+
 def metrics(config: Namespace, anomaly_maps: list = None, segmentations: list = None,
-            anomaly_scores: list = None, labels: list = None) -> Union[None, float]:
+            anomaly_scores: list = None, labels: list = None,
+            pixel_metrics: PixelMetrics = None, results: dict = None) -> Union[None, float]:
     """
     Computes evaluation metrics, prints and logs the results.
 
-    For pixel-level evaluation, both anomaly_maps and segmentations should be provided.
+    For pixel-level evaluation, either pixel_metrics updated with every batch, or both
+    anomaly_maps and segmentations should be provided. The metrics are exact when computed
+    from anomaly_maps and segmentations, and histogram estimates when from pixel_metrics.
     For image-level evaluation, both anomaly_scores and labels should be provided.
 
     Args:
         anomaly_maps (list): list of anomaly map tensor batches of shape [b,c,h,w]
-        segmentations (list): list of segmentation tensor batches of shape [b,c,h,w]
+        segmentations (list): list of binary (uint8) segmentation tensor batches of shape [b,c,h,w]
         anomaly_scores (list): list of anomaly score tensors of shape [b, 1]
         labels (list): list of label tensors of shape [b, 1]
+        pixel_metrics (PixelMetrics): pixel-wise metrics accumulated during inference
+        results (dict): Optional. Updated with the logged metrics
     """
 
+    def log_metrics(values: Dict[str, float]) -> None:
+        log(values, config)
+        if results is not None:
+            results.update(values)
+
     print("\nEvaluation results: \n")
 
-    # disables pixel level evaluation for CXR
+    # disables pixel level evaluation for CXR, which has image-level labels only
     if config.modality == 'CXR':
         segmentations = None
+        pixel_metrics = None
 
     # image-wise metrics
     if labels is not None:
 
-        sample_ap = compute_average_precision(torch.cat(anomaly_scores), torch.cat(labels))
+        # both from a single sort of the scores
+        curve = BinaryCurve(torch.cat(anomaly_scores), torch.cat(labels))
+        sample_ap = curve.average_precision()
         print(f"sample-wise average precision: {sample_ap:.4f}")
-        sample_auroc = compute_auroc(torch.cat(anomaly_scores), torch.cat(labels))
+        sample_auroc = curve.auroc()
         print(f"sample-wise AUROC: {sample_auroc:.4f}\n")
 
-        log({'anom_val/sample_ap': sample_ap,
-            'anom_val/sample-auroc': sample_auroc}, config)
+        log_metrics({'anom_val/sample_ap': sample_ap,
+                     'anom_val/sample-auroc': sample_auroc})
+
+    # exact pixel-wise metrics, from a single sort of the stored anomaly maps
+    if pixel_metrics is None and segmentations is not None:
 
-    # pixel-wise metrics
-    if segmentations is not None:
+        curve = BinaryCurve(torch.cat(anomaly_maps), torch.cat(segmentations))
+        pixel_ap = curve.average_precision()
 
         if config.no_dice:
-            pixel_ap = compute_average_precision(torch.cat(anomaly_maps), torch.cat(segmentations))
             print(f"pixel-wise average precision: {pixel_ap:.4f}\n")
-            log({'anom_val/pixel-ap': pixel_ap}, config)
+            log_metrics({'anom_val/pixel-ap': pixel_ap})
 
         else:
-            pixel_ap = compute_average_precision(torch.cat(anomaly_maps), torch.cat(segmentations))
             print(f"pixel-wise average precision: {pixel_ap:.4f}")
-            best_dice, threshold = compute_best_dice(torch.cat(anomaly_maps), torch.cat(segmentations))
+            best_dice, threshold = curve.best_dice(n_thresh=100)
             print(f"Best Dice score for 100 thresholds: {best_dice:.4f}")
 
-            log({'anom_val/pixel-ap': pixel_ap,
-                 'anom_val/best-dice': best_dice},
-                config)
+            log_metrics({'anom_val/pixel-ap': pixel_ap,
+                         'anom_val/best-dice': best_dice})
+
+    # pixel-wise metrics, from the score histograms of positive and negative pixels
+    elif pixel_metrics is not None:
+
+        bounds = pixel_metrics.error_bounds()
+        pixel_ap = pixel_metrics.average_precision()
+        print(f"pixel-wise average precision: {pixel_ap:.4f} (+-{bounds['ap']:.4f})")
+        pixel_auroc = pixel_metrics.auroc()
+        print(f"pixel-wise AUROC: {pixel_auroc:.4f} (+-{bounds['auroc']:.4f})")
+
+        if config.no_dice:
+            print()
+            log_metrics({'anom_val/pixel-ap': pixel_ap,
+                         'anom_val/pixel-auroc': pixel_auroc})
+
+        else:
+            best_dice, threshold = pixel_metrics.best_dice()
+            print(f"Best Dice score for {pixel_metrics.num_bins} thresholds: {best_dice:.4f}"
+                  f" (+{bounds['dice']:.4f})\n")
 
-    if segmentations is not None and not config.no_dice:
+            log_metrics({'anom_val/pixel-ap': pixel_ap,
+                         'anom_val/pixel-auroc': pixel_auroc,
+                         'anom_val/best-dice': best_dice})
+
+    if (pixel_metrics is not None or segmentations is not None) and not config.no_dice:
         return threshold
     else:
         return None
@@ -449,24 +519,175 @@ def seed_everything(seed: int) -> None:
     torch.backends.cudnn.benchmark = True
 
 
+class BatchedDataset(Dataset):
+    """
+    Adapter of a dataset with a get_batch(indices) method, which returns a whole collated
+    batch, to a dataset indexed by lists of indices, for use with a BatchSampler.
+    For RepeatedDataset, indices are mapped to the repeated dataset.
+    """
+
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices: list):
+        dataset, indices = self.dataset, np.asarray(indices)
+        while isinstance(dataset, RepeatedDataset):
+            indices = (dataset.offset + indices) % len(dataset.dataset)
+            dataset = dataset.dataset
+        return dataset.get_batch(indices)
+
+    @staticmethod
+    def supports(dataset: Dataset) -> bool:
+        while isinstance(dataset, RepeatedDataset):
+            dataset = dataset.dataset
+        return hasattr(dataset, 'get_batch')
+
+
+def get_num_workers(dataset: Dataset, config: Namespace) -> int:
+    """
+    Number of dataloader workers. config.num_workers >= 0 is used as is, otherwise it is
+    chosen from the available cores and the dataset: batches of in-memory datasets with
+    get_batch() are cheap to read and need few workers, datasets that decode or augment
+    every sample get as many as there are cores, up to 8.
+    """
+    if 'num_workers' in config and config.num_workers >= 0:
+        return config.num_workers
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if BatchedDataset.supports(dataset):
+        return min(2, cores)
+    return max(1, min(cores - 1, 8))
+
+
 class GenericDataloader(DataLoader):
     """
     Generic Dataloader class to reduce boilerplate.
     Requires only Dataset object and configuration object for instantiation.
 
+    Datasets with a get_batch(indices) method (in-memory arrays) are read a whole batch
+    at a time, without per-sample tensors and collation, unless config.batched_loading is False.
+
+    Optionally, workers are kept alive between epochs (config.persistent_workers) and batches
+    are pinned when training on GPU (config.pin_memory); workers prefetch
+    config.prefetch_factor batches each. With config.log_data_time, the time spent waiting for batches and
+    the time spent between them (compute) are printed every config.log_frequency batches.
+
     Args:
         dataset (Dataset): dataset from which to load the data.
         config (Namespace): configuration object.
+        shuffle (bool): reshuffle the data every epoch.
+        drop_last (bool): drop the last incomplete batch.
     """
 
     def __init__(self, dataset: Dataset, config: Namespace, shuffle: bool = True, drop_last: bool = False):
-        super().__init__(
-            dataset,
-            batch_size=config.batch_size,
-            shuffle=shuffle,
-            pin_memory=False,
-            num_workers=config.num_workers,
-            drop_last=False)
+        num_workers = get_num_workers(dataset, config)
+        loader_kwargs = {
+            'num_workers': num_workers,
+            'pin_memory': 'pin_memory' in config and config.pin_memory and torch.cuda.is_available(),
+        }
+        # both are only valid with worker processes
+        if num_workers > 0:
+            loader_kwargs['persistent_workers'] = 'persistent_workers' in config and config.persistent_workers
+            if 'prefetch_factor' in config:
+                loader_kwargs['prefetch_factor'] = config.prefetch_factor
+
+        batched = 'batched_loading' in config and config.batched_loading and BatchedDataset.supports(dataset)
+        if batched:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            super().__init__(
+                BatchedDataset(dataset),
+                batch_size=None,
+                sampler=BatchSampler(sampler, config.batch_size, drop_last=drop_last),
+                **loader_kwargs)
+        else:
+            super().__init__(
+                dataset,
+                batch_size=config.batch_size,
+                shuffle=shuffle,
+                drop_last=drop_last,
+                **loader_kwargs)
+
+        log_data_time = 'log_data_time' in config and config.log_data_time
+        self.log_frequency = config.log_frequency if log_data_time and 'log_frequency' in config else 0
+        self.reset_timing()
+
+    def reset_timing(self) -> None:
+        self.data_time = 0.
+        self.compute_time = 0.
+        self.timed_batches = 0
+
+    def print_timing(self) -> None:
+        total = self.data_time + self.compute_time
+        print(f'Data loading: {self.data_time:.2f}s waiting for {self.timed_batches} batches, '
+              f'{self.compute_time:.2f}s compute '
+              f'({100 * self.data_time / max(total, 1e-9):.1f}% of the time waiting for data)')
+
+    def __iter__(self):
+        batches = super().__iter__()
+        if not self.log_frequency:
+            return batches
+        return self._timed(batches)
+
+    def _timed(self, batches):
+        resumed = None
+        while True:
+            start = perf_counter()
+            if resumed is not None:
+                self.compute_time += start - resumed
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.data_time += perf_counter() - start
+            self.timed_batches += 1
+            if self.timed_batches % self.log_frequency == 0:
+                self.print_timing()
+                self.reset_timing()
+
+            yield batch
+            resumed = perf_counter()
+
+
+class RepeatedDataset(Dataset):
+    """
+    Virtual repetition of a dataset, without duplicating its samples: item i is
+    dataset[(offset + i) % len(dataset)], for a virtual length of length items.
+
+    Args:
+        dataset (Dataset): dataset to repeat.
+        length (int): virtual length.
+        offset (int): position of the first item in the infinitely repeated dataset.
+    """
+
+    def __init__(self, dataset: Dataset, length: int, offset: int = 0):
+        self.dataset = dataset
+        self.length = length
+        self.offset = offset
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError(f'index {idx} out of range for dataset of length {self.length}')
+        return self.dataset[(self.offset + idx) % len(self.dataset)]
+
+
+def split_repeated(dataset: Dataset, repeats: int, split: float) -> Tuple[RepeatedDataset, RepeatedDataset]:
+    """
+    Split dataset, repeated repeats times, at the fraction split, exactly as if its samples
+    had been repeated (e.g. files * repeats) and then split, but without duplicating them.
+
+    Returns: Tuple(first part, second part)
+    """
+    total = len(dataset) * repeats
+    split_idx = int(total * split)
+    return RepeatedDataset(dataset, split_idx), RepeatedDataset(dataset, total - split_idx, split_idx)
 
 
 def load_data(config: Namespace) -> Tuple[DataLoader, ...]:
@@ -521,6 +742,11 @@ def load_data(config: Namespace) -> Tuple[DataLoader, ...]:
     if not config.restoration:
         config.batch_size = config.num_images_log
 
+    # rescoring a complete cache of the outputs of the model does not read any data
+    if 'cached_outputs' in config and config.cached_outputs:
+        print('Rescoring cached outputs, no data loaded.')
+        return None, None, None, None
+
     big_testloader, small_testloader = get_dataloaders(config, train=False)
 
     print('Big test-set: {} samples, Small test-set: set: {} samples.'.format(